@@ -0,0 +1,53 @@
+from flask import Response, jsonify, request
+
+from shewhart_app.components.service import ingest, metrics
+from shewhart_app.components.service.session import pool_status
+
+# Формат тела определяется по Content-Type или параметру ?format=
+FORMATS = {
+    "application/json": "json",
+    "application/x-ndjson": "jsonl",
+    "application/jsonl": "jsonl",
+    "text/csv": "csv",
+}
+
+
+def _parse_request(row_parser):
+    fmt = request.args.get("format") or FORMATS.get(request.mimetype, "json")
+    records = ingest.parse_records(request.get_data(as_text=True), fmt)
+    return [row_parser(record) for record in records]
+
+
+def register_api(server):
+    @server.route("/api/measurements", methods=["POST"])
+    def post_measurements():
+        try:
+            rows = _parse_request(ingest.measurement_row)
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+        inserted = ingest.ingest_measurements(
+            rows, use_copy=request.args.get("copy") == "1"
+        )
+        return jsonify(inserted=inserted)
+
+    @server.route("/api/individual_measurements", methods=["POST"])
+    def post_individual_measurements():
+        try:
+            rows = _parse_request(ingest.individual_row)
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+        inserted = ingest.ingest_individual_values(
+            rows, use_copy=request.args.get("copy") == "1"
+        )
+        return jsonify(inserted=inserted)
+
+    @server.route("/api/pool", methods=["GET"])
+    def get_pool_status():
+        return jsonify(pool_status())
+
+    @server.route("/metrics", methods=["GET"])
+    def get_metrics():
+        return Response(
+            metrics.render(pool_status()),
+            mimetype="text/plain; version=0.0.4",
+        )
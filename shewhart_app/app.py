@@ -2,6 +2,9 @@ import dash
 from dash import dcc, html
 import dash_bootstrap_components as dbc
 from shewhart_app.components.navbar import Navbar
+from shewhart_app.api import register_api
+from shewhart_app.components.service.migrations import upgrade
+from shewhart_app.components.service.session import engine
 
 app = dash.Dash(
     __name__,
@@ -10,6 +13,8 @@ app = dash.Dash(
     use_pages=True,
 )
 app.layout = html.Div([Navbar(), dash.page_container])
+register_api(app.server)
 
 if __name__ == "__main__":
+    upgrade(engine)
     app.run(debug=True)
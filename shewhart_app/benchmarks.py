@@ -0,0 +1,149 @@
+import datetime
+import json
+import platform
+import statistics
+import time
+
+import numpy as np
+
+from shewhart_app.components.service import constants
+from shewhart_app.components.service.detectors import StreamingDetector, detect_rules
+from shewhart_app.components.service.spc import (
+    p_chart_limits,
+    r_limits,
+    s_limits,
+    subgroup_stats,
+    xbar_limits,
+)
+
+# Размеры синтетических рядов и подгрупп по умолчанию; модуль не трогает БД,
+# так что запускается без Postgres
+SIZES = [10**2, 10**3, 10**4, 10**5, 10**6]
+# Подгруппы - те же размеры, для которых приложение ведет статистики
+SUBGROUP_SIZES = constants.SUBGROUP_SIZES
+# Сколько новых точек приходит между двумя обновлениями графика
+STREAM_TICKS = 10
+# Во сколько раз медленнее прошлого прогона считается регрессией
+REGRESSION_THRESHOLD = 1.25
+
+
+def _series(size, seed=0):
+    # Нормальный шум со ступенчатыми сдвигами уровня, чтобы правила
+    # срабатывали примерно как на реальных данных
+    rng = np.random.default_rng(seed)
+    levels = np.repeat(rng.normal(0, 1, size // 50 + 1), 50)[:size]
+    return rng.normal(10, 2, size) + levels
+
+
+def _proportions(size, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_sizes = rng.integers(50, 500, size)
+    return rng.binomial(sample_sizes, 0.1) / sample_sizes, sample_sizes
+
+
+def _time(function, make_args, repeat):
+    # make_args выполняется вне замера и отдает аргументы для function
+    timings = []
+    for _ in range(repeat):
+        args = make_args()
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), statistics.median(timings)
+
+
+def _fixed(*args):
+    return lambda: args
+
+
+def _streaming_args(keys, values, center):
+    # Детектор, который уже видел окно без последних STREAM_TICKS точек
+    def make_args():
+        detector = StreamingDetector()
+        detector.sync(keys[:-STREAM_TICKS], values[:-STREAM_TICKS], center)
+        return detector, keys[STREAM_TICKS:], values[STREAM_TICKS:], center
+
+    return make_args
+
+
+def _streaming_sync(detector, keys, values, center):
+    detector.sync(keys, values, center)
+
+
+def _xrs_limits(stats, subgroup_size):
+    xbar_limits(stats.means, stats.stddevs, subgroup_size)
+    r_limits(stats.ranges, subgroup_size)
+    s_limits(stats.stddevs, subgroup_size)
+
+
+def _cases(size, subgroup_sizes):
+    # (название, размер подгруппы, функция, фабрика аргументов)
+    values = _series(size)
+    center = values.mean()
+    proportions, sample_sizes = _proportions(size)
+    yield "detect_rules", None, detect_rules, _fixed(values, center)
+    yield "streaming_sync", None, _streaming_sync, _streaming_args(
+        np.arange(size), values, center
+    )
+    yield "p_chart_limits", None, p_chart_limits, _fixed(proportions, sample_sizes)
+    for subgroup_size in subgroup_sizes:
+        if size < subgroup_size:
+            continue
+        stats = subgroup_stats(values, subgroup_size)
+        yield "subgroup_stats", subgroup_size, subgroup_stats, _fixed(
+            values, subgroup_size
+        )
+        yield "xrs_limits", subgroup_size, _xrs_limits, _fixed(stats, subgroup_size)
+
+
+def run(sizes=None, subgroup_sizes=None, repeat=5):
+    results = []
+    for size in sizes or SIZES:
+        for name, subgroup_size, function, make_args in _cases(
+            size, subgroup_sizes or SUBGROUP_SIZES
+        ):
+            best, median = _time(function, make_args, repeat)
+            results.append(
+                {
+                    "benchmark": name,
+                    "size": size,
+                    "subgroup_size": subgroup_size,
+                    "repeat": repeat,
+                    "min_s": best,
+                    "median_s": median,
+                    "ns_per_point": best / size * 1e9,
+                }
+            )
+    return {
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def _key(result):
+    return result["benchmark"], result["size"], result["subgroup_size"]
+
+
+def compare(previous, current, threshold=REGRESSION_THRESHOLD):
+    # Отношение min_s к прошлому прогону для совпадающих замеров; в
+    # регрессии попадают те, что медленнее порога
+    before = {_key(result): result["min_s"] for result in previous["results"]}
+    ratios = []
+    for result in current["results"]:
+        if _key(result) in before and before[_key(result)] > 0:
+            ratios.append((_key(result), result["min_s"] / before[_key(result)]))
+    regressions = [(key, ratio) for key, ratio in ratios if ratio > threshold]
+    return ratios, regressions
+
+
+def save(report, path):
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(report, stream, indent=2)
+
+
+def load(path):
+    with open(path, encoding="utf-8") as stream:
+        return json.load(stream)
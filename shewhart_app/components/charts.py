@@ -0,0 +1,419 @@
+from collections import namedtuple
+
+import numpy as np
+from dash.exceptions import PreventUpdate
+
+from shewhart_app.components.figures import (
+    band_traces,
+    constant_trace,
+    control_figure,
+    figure_state,
+    patch_figure,
+    rule_annotations,
+    sample_points,
+    time_axis,
+    time_figure,
+    values_trace,
+)
+from shewhart_app.components.service import cache, timeline
+from shewhart_app.components.service.detectors import drop_detector, get_detector
+from shewhart_app.components.service.limits import frozen_limits
+from shewhart_app.components.service.scheduler import chart_scheduler
+from shewhart_app.components.service.spc import (
+    p_chart_limits,
+    p_limits_from,
+    r_limits,
+    r_limits_from,
+    s_limits,
+    s_limits_from,
+    subgroup_stats,
+    xbar_limits,
+    xbar_limits_from,
+)
+
+# Плавающие границы p-карты в порядке трасс: поле PChartLimits, подпись, цвет
+P_CHART_BANDS = [
+    ("ucl", "UCL (+3σ)", "red"),
+    ("upper2", "2σ", "orange"),
+    ("upper1", "σ", "purple"),
+    ("lower1", "-σ", "purple"),
+    ("lower2", "-2σ", "orange"),
+    ("lcl", "LCL (-3σ)", "red"),
+]
+
+# Готовая к отправке карта: состояние клиента, ряды для patch_figure,
+# подписи правил и полный figure для клиентов без состояния
+ChartPart = namedtuple("ChartPart", ["state", "series", "annotations", "figure"])
+# Снимок, который публикует chart_scheduler: версия ряда, ключи точек окна,
+# строки окна из кэша, действующая замороженная фаза (или None) и карты по
+# имени ("p" или "x", "r", "s")
+ChartSnapshot = namedtuple(
+    "ChartSnapshot", ["version", "ids", "rows", "frozen", "parts"]
+)
+
+
+def _state(ids, limits, index, frozen):
+    # Фаза в состоянии клиента: при ее смене меняется заголовок карты
+    state = figure_state(ids, limits, index)
+    state["phase"] = frozen.phase if frozen else None
+    return state
+
+
+def _title(title, frozen):
+    if frozen is None:
+        return title
+    return f"{title} (phase {frozen.phase} limits)"
+
+
+def _unchanged(previous, version, frozen):
+    if previous is None:
+        return False
+    return previous.version == version and previous.frozen == frozen
+
+
+def render(snapshot, name, shown):
+    part = snapshot.parts[name]
+    if shown and shown.get("phase") != part.state["phase"]:
+        return part.figure
+    # Пока клиент в курсе окна, шлем только новые точки и сдвинутые границы
+    patch = patch_figure(shown, part.state, snapshot.ids, part.series, part.annotations)
+    return part.figure if patch is None else patch
+
+
+def build_p_chart(key, previous):
+    _, binding_id = key
+    measurements = cache.recent_measurements(binding_id)
+    measurement_ids = measurements["id"]
+    version = cache.series_version(measurement_ids)
+    frozen = frozen_limits(key)
+    if _unchanged(previous, version, frozen):
+        return previous
+
+    proportions = measurements["proportion"]
+    # С замороженной фазой центр не зависит от окна, и детектор только
+    # дописывает новые точки
+    if frozen is None:
+        limits = p_chart_limits(proportions, measurements["sample_size"])
+    else:
+        limits = p_limits_from(frozen.p_bar, measurements["sample_size"])
+    bands = [getattr(limits, field) for field, _, _ in P_CHART_BANDS]
+
+    hits = get_detector(("p", binding_id)).sync(
+        measurement_ids, proportions, limits.center
+    )
+    annotations = rule_annotations(proportions, hits)
+    index = sample_points(proportions, hits)
+
+    traces = [
+        values_trace(
+            proportions,
+            "Proportion",
+            index=index,
+            mode="lines+markers",
+            line=dict(color="blue"),
+        ),
+        constant_trace(limits.center, len(proportions), "Mean Proportion"),
+    ]
+    for values, (_, name, color) in zip(bands, P_CHART_BANDS):
+        traces.append(
+            values_trace(
+                values,
+                name,
+                index=index,
+                mode="lines",
+                line=dict(dash="dash", color=color),
+            )
+        )
+    part = ChartPart(
+        _state(measurement_ids, [limits.center], index, frozen),
+        [proportions, limits.center] + bands,
+        annotations,
+        control_figure(
+            traces,
+            _title("Custom p-Chart with Floating Control Limits", frozen),
+            "Proportion",
+            annotations,
+        ),
+    )
+    return ChartSnapshot(version, measurement_ids, measurements, frozen, {"p": part})
+
+
+def limit_traces(values, name, center, ucl, lcl, index):
+    return [
+        values_trace(
+            values, name, index=index, mode="lines+markers", line=dict(color="blue")
+        ),
+        constant_trace(center, len(values), "Mean Value"),
+        constant_trace(ucl, len(values), "UCL", line=dict(dash="dash", color="red")),
+        constant_trace(lcl, len(values), "LCL", line=dict(dash="dash", color="red")),
+    ]
+
+
+def _limit_chart(detector_key, keys, values, limits, frozen, name, title, y_title):
+    center, ucl, lcl = limits
+    hits = get_detector(detector_key).sync(keys, values, center)
+    annotations = rule_annotations(values, hits)
+    index = sample_points(values, hits)
+    return ChartPart(
+        _state(keys, [center, ucl, lcl], index, frozen),
+        [values, center, ucl, lcl],
+        annotations,
+        control_figure(
+            limit_traces(values, name, center, ucl, lcl, index),
+            _title(title, frozen),
+            y_title,
+            annotations,
+        ),
+    )
+
+
+def _subgroup_limits(means, ranges, stddevs, subgroup_size, frozen):
+    if frozen is None:
+        return (
+            xbar_limits(means, stddevs, subgroup_size),
+            r_limits(ranges, subgroup_size),
+            s_limits(stddevs, subgroup_size),
+        )
+    return (
+        xbar_limits_from(frozen.x_bar, frozen.s_bar, subgroup_size),
+        r_limits_from(frozen.r_bar, subgroup_size),
+        s_limits_from(frozen.s_bar, subgroup_size),
+    )
+
+
+def build_subgroup_charts(key, previous):
+    # Статистики подгрупп считаются при вставке измерений
+    _, chart_id, subgroup_size = key
+    stats = cache.recent_subgroup_stats([chart_id], subgroup_size)[chart_id]
+    subgroup_keys = stats["id"]
+    version = cache.series_version(subgroup_keys)
+    frozen = frozen_limits(key)
+    if _unchanged(previous, version, frozen):
+        return previous
+
+    limits = _subgroup_limits(
+        stats["mean"], stats["range"], stats["stddev"], subgroup_size, frozen
+    )
+    parts = {
+        "x": _limit_chart(
+            ("x", chart_id, subgroup_size),
+            subgroup_keys,
+            stats["mean"],
+            limits[0],
+            frozen,
+            "Value",
+            "X-Chart",
+            "Value",
+        ),
+        "r": _limit_chart(
+            ("r", chart_id, subgroup_size),
+            subgroup_keys,
+            stats["range"],
+            limits[1],
+            frozen,
+            "Standard Deviation",
+            "R-Chart",
+            "Standart Deviation",
+        ),
+        "s": _limit_chart(
+            ("s", chart_id, subgroup_size),
+            subgroup_keys,
+            stats["stddev"],
+            limits[2],
+            frozen,
+            "Standard Deviation",
+            "S-Chart",
+            "Standart Deviation",
+        ),
+    }
+    return ChartSnapshot(version, subgroup_keys, stats, frozen, parts)
+
+
+def _drop_subgroup_detectors(key):
+    _, chart_id, subgroup_size = key
+    for name in ("x", "r", "s"):
+        drop_detector((name, chart_id, subgroup_size))
+
+
+# Детекторы живут, пока планировщик держит снимок карты
+chart_scheduler.register("p", build_p_chart, drop_detector)
+chart_scheduler.register("s", build_subgroup_charts, _drop_subgroup_detectors)
+
+
+def p_chart(binding_id, shown):
+    # p-карта связки для страниц ввода и просмотра: (измерения окна,
+    # figure или Patch, новое состояние клиента). Если у клиента уже то же
+    # окно с теми же границами - PreventUpdate
+    snapshot = chart_scheduler.get(("p", binding_id))
+    if shown == snapshot.parts["p"].state:
+        raise PreventUpdate
+    return snapshot.rows, render(snapshot, "p", shown), snapshot.parts["p"].state
+
+
+def subgroup_charts(chart_id, subgroup_size):
+    return chart_scheduler.get(("s", chart_id, subgroup_size))
+
+
+def time_window(preset, relayout, window):
+    # Окно выбора по времени для хранилища страницы: relayout - зум графика
+    # (None - выбран пресет). None - режим последних точек
+    if relayout is None:
+        return timeline.preset_window(preset)
+    # В режиме последних точек ось - номера точек, а не время
+    if not window:
+        raise PreventUpdate
+    if "xaxis.range[0]" in relayout:
+        return {
+            "preset": window["preset"],
+            "start": relayout["xaxis.range[0]"],
+            "end": relayout["xaxis.range[1]"],
+        }
+    if relayout.get("xaxis.autorange"):
+        return timeline.preset_window(window["preset"])
+    raise PreventUpdate
+
+
+def time_range_options():
+    return [
+        {"label": label, "value": value}
+        for value, (label, _) in timeline.TIME_RANGES.items()
+    ]
+
+
+def _time_title(title, series, frozen):
+    if not series.raw:
+        title = f"{title} ({timeline.describe_width(series.width)} buckets)"
+    return _title(title, frozen)
+
+
+def time_p_chart(binding_id, window):
+    # p-карта за период: широкий диапазон приходит корзинами из базы,
+    # граница корзины считается по ее суммарному объему выборок
+    series = timeline.measurement_series(binding_id, window["start"], window["end"])
+    rows = series.rows
+    title = "Custom p-Chart with Floating Control Limits"
+    frozen = frozen_limits(("p", binding_id))
+    if not len(rows):
+        return time_figure([], f"{title} (no data in range)", "Proportion")
+    if frozen is None:
+        limits = p_chart_limits(rows["value"], rows["weight"])
+    else:
+        limits = p_limits_from(frozen.p_bar, rows["weight"])
+
+    x = time_axis(rows["time"])
+    traces = [] if series.raw else band_traces(x, rows["low"], rows["high"], "Min/Max")
+    traces += [
+        values_trace(
+            rows["value"],
+            "Proportion",
+            x=x,
+            mode="lines+markers",
+            line=dict(color="blue"),
+        ),
+        constant_trace(limits.center, len(rows), "Mean Proportion", x=x),
+    ]
+    for field, name, color in P_CHART_BANDS:
+        traces.append(
+            values_trace(
+                getattr(limits, field),
+                name,
+                x=x,
+                mode="lines",
+                line=dict(dash="dash", color=color),
+            )
+        )
+    return time_figure(traces, _time_title(title, series, frozen), "Proportion")
+
+
+def _time_limit_figure(x, values, limits, band, name, title, y_title):
+    traces = [] if band is None else band_traces(x, *band, "Min/Max")
+    traces.append(
+        values_trace(values, name, x=x, mode="lines+markers", line=dict(color="blue"))
+    )
+    center, ucl, lcl = limits
+    traces.append(constant_trace(center, len(values), "Mean Value", x=x))
+    if ucl is not None:
+        traces += [
+            constant_trace(
+                ucl, len(values), "UCL", x=x, line=dict(dash="dash", color="red")
+            ),
+            constant_trace(
+                lcl, len(values), "LCL", x=x, line=dict(dash="dash", color="red")
+            ),
+        ]
+    return time_figure(traces, title, y_title)
+
+
+def time_subgroup_charts(binding_id, chart_id, subgroup_size, window):
+    # X/R/S за период, словарь figure по имени карты. Узкий диапазон -
+    # подгруппы из значений диапазона с обычными границами; широкий -
+    # корзины: среднее с полосой min/max, размах и стандартное отклонение
+    # корзины и только центральные линии, потому что число значений в
+    # корзинах разное
+    series = timeline.individual_series(
+        binding_id, chart_id, window["start"], window["end"]
+    )
+    rows = series.rows
+    frozen = frozen_limits(("s", chart_id, subgroup_size))
+    titles = {"x": "X-Chart", "r": "R-Chart", "s": "S-Chart"}
+    if series.raw:
+        stats = subgroup_stats(rows["value"], subgroup_size)
+        if not len(stats.means):
+            return {
+                name: time_figure([], f"{title} (no data in range)", "Value")
+                for name, title in titles.items()
+            }
+        # Время подгруппы - время ее последнего значения
+        x = time_axis(rows["time"][subgroup_size - 1 :: subgroup_size])
+        limits = _subgroup_limits(
+            stats.means, stats.ranges, stats.stddevs, subgroup_size, frozen
+        )
+        values = (stats.means, stats.ranges, stats.stddevs)
+        band = None
+    else:
+        x = time_axis(rows["time"])
+        values = (rows["value"], rows["high"] - rows["low"], rows["spread"])
+        if frozen is None:
+            centers = (
+                np.average(rows["value"], weights=rows["weight"]),
+                np.mean(values[1]),
+                np.mean(values[2]),
+            )
+        else:
+            # Центры замороженной фазы - те же X̄-bar, R-bar и S-bar, что на
+            # картах последних точек
+            centers = [
+                limits.center
+                for limits in _subgroup_limits(None, None, None, subgroup_size, frozen)
+            ]
+        limits = [(center, None, None) for center in centers]
+        band = (rows["low"], rows["high"])
+    return {
+        "x": _time_limit_figure(
+            x,
+            values[0],
+            limits[0],
+            band,
+            "Value",
+            _time_title(titles["x"], series, frozen),
+            "Value",
+        ),
+        "r": _time_limit_figure(
+            x,
+            values[1],
+            limits[1],
+            None,
+            "Standard Deviation",
+            _time_title(titles["r"], series, frozen),
+            "Standart Deviation",
+        ),
+        "s": _time_limit_figure(
+            x,
+            values[2],
+            limits[2],
+            None,
+            "Standard Deviation",
+            _time_title(titles["s"], series, frozen),
+            "Standart Deviation",
+        ),
+    }
@@ -1,4 +1,80 @@
+import getpass
+import os
+import tempfile
+
 MAX_POINTS = 20
-DB_USER = 'postgres'
-DB_NAME = 'shewhart'
-DB_PASS = '72metra'
\ No newline at end of file
+# Сколько последних точек держится в кэше и участвует в расчете карт
+HISTORY_POINTS = int(os.environ.get('SHEWHART_HISTORY_POINTS', str(MAX_POINTS)))
+# Более длинная история прореживается до стольких точек ('lttb' или 'minmax')
+RENDER_POINTS = int(os.environ.get('SHEWHART_RENDER_POINTS', '2000'))
+DOWNSAMPLE_METHOD = os.environ.get('SHEWHART_DOWNSAMPLE_METHOD', 'lttb')
+# Карта за период: до TIME_RAW_POINTS строк рисуются как есть, больше -
+# агрегируются в базе до TIME_BUCKETS корзин по времени
+TIME_RAW_POINTS = int(os.environ.get('SHEWHART_TIME_RAW_POINTS', '2000'))
+TIME_BUCKETS = int(os.environ.get('SHEWHART_TIME_BUCKETS', '500'))
+# Хранение (manage.py retention): сырые строки старше RETENTION_MAX_AGE_DAYS
+# дней сворачиваются в корзины по RETENTION_BUCKET_SECONDS секунд и
+# удаляются; последние HISTORY_POINTS строк каждого ряда не трогаются
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('SHEWHART_RETENTION_MAX_AGE_DAYS', '90'))
+RETENTION_BUCKET_SECONDS = int(
+    os.environ.get('SHEWHART_RETENTION_BUCKET_SECONDS', '3600')
+)
+# Сколько месяцев вперед держать готовые партиции на Postgres
+RETENTION_PARTITIONS_AHEAD = int(
+    os.environ.get('SHEWHART_RETENTION_PARTITIONS_AHEAD', '2')
+)
+CACHE_MAX_ENTRIES = 256
+# 'memory' - кэш рядов в памяти процесса, 'disk' - общий файл для всех
+# воркеров хоста (включается в gunicorn_conf.py)
+CACHE_BACKEND = os.environ.get('SHEWHART_CACHE_BACKEND', 'memory')
+CACHE_PATH = os.environ.get(
+    'SHEWHART_CACHE_PATH',
+    os.path.join(tempfile.gettempdir(), f'shewhart-cache-{getpass.getuser()}.sqlite'),
+)
+INGEST_BATCH_SIZE = 5000
+# Сколько секунд воркер верит закэшированной фазе замороженных границ -
+# за это время он увидит заморозку, сделанную в другом процессе
+FROZEN_LIMITS_TTL = float(os.environ.get('SHEWHART_FROZEN_LIMITS_TTL', '10'))
+# Снимки карт пересобираются в фоне раз в CHART_REFRESH_INTERVAL секунд и
+# сразу после вставок; карту, которую никто не открывал CHART_IDLE_TIMEOUT
+# секунд, перестаем считать
+CHART_REFRESH_INTERVAL = float(os.environ.get('SHEWHART_CHART_REFRESH_INTERVAL', '10'))
+CHART_IDLE_TIMEOUT = float(os.environ.get('SHEWHART_CHART_IDLE_TIMEOUT', '60'))
+# Ввод с форм пишется фоновым потоком пачками до WRITE_BATCH_SIZE строк, не
+# дольше WRITE_FLUSH_INTERVAL секунд ожидания; запрос ждет подтверждения
+# записи не дольше WRITE_ACK_TIMEOUT секунд
+WRITE_BATCH_SIZE = int(os.environ.get('SHEWHART_WRITE_BATCH_SIZE', '500'))
+WRITE_FLUSH_INTERVAL = float(os.environ.get('SHEWHART_WRITE_FLUSH_INTERVAL', '0.01'))
+WRITE_ACK_TIMEOUT = float(os.environ.get('SHEWHART_WRITE_ACK_TIMEOUT', '10'))
+# Ряды от стольких точек уходят в браузер base64-массивом, а не JSON-текстом
+FIGURE_BINARY_MIN_POINTS = int(
+    os.environ.get('SHEWHART_FIGURE_BINARY_MIN_POINTS', '100')
+)
+# С этого числа рисуемых точек ряды строятся через WebGL (Scattergl)
+WEBGL_MIN_POINTS = int(os.environ.get('SHEWHART_WEBGL_MIN_POINTS', '1000'))
+# Точность рисуемых рядов: float32 вдвое компактнее, float64 - без потерь
+FIGURE_DTYPE = os.environ.get('SHEWHART_FIGURE_DTYPE', 'float32')
+DB_USER = os.environ.get('SHEWHART_DB_USER', 'postgres')
+DB_NAME = os.environ.get('SHEWHART_DB_NAME', 'shewhart')
+DB_PASS = os.environ.get('SHEWHART_DB_PASS', '72metra')
+DB_HOST = os.environ.get('SHEWHART_DB_HOST', 'localhost')
+DB_PORT = os.environ.get('SHEWHART_DB_PORT', '1337')
+# Сколько разных связок получают свою метку в /metrics, остальные - "other"
+METRICS_MAX_BINDINGS = int(os.environ.get('SHEWHART_METRICS_MAX_BINDINGS', '50'))
+# Полный URL перекрывает параметры выше, например sqlite:///shewhart.db
+DB_URL = os.environ.get(
+    'SHEWHART_DB_URL',
+    f'postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}',
+)
+# Боевой запуск: gunicorn -c python:shewhart_app.gunicorn_conf
+SERVER_BIND = os.environ.get('SHEWHART_BIND', '0.0.0.0:8050')
+SERVER_WORKERS = int(
+    os.environ.get('SHEWHART_WORKERS', str(2 * (os.cpu_count() or 1) + 1))
+)
+SERVER_THREADS = int(os.environ.get('SHEWHART_THREADS', '4'))
+SERVER_TIMEOUT = int(os.environ.get('SHEWHART_TIMEOUT', '60'))
+DB_POOL_SIZE = int(os.environ.get('SHEWHART_DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('SHEWHART_DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = int(os.environ.get('SHEWHART_DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.environ.get('SHEWHART_DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.environ.get('SHEWHART_DB_POOL_PRE_PING', '1') == '1'
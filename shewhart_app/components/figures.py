@@ -0,0 +1,208 @@
+import base64
+
+import numpy as np
+import plotly.graph_objs as go
+from dash import Patch
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import cache
+from shewhart_app.components.service.detectors import describe_hit
+from shewhart_app.components.service.downsample import downsample_indices
+
+# Смещение подписи по вертикали, чтобы подписи разных правил не накладывались
+ANNOTATION_OFFSETS = {"trend": -40, "shift": -70, "asterisk": -100}
+# Короткие имена типов для typed array в plotly.js
+_PLOTLY_DTYPES = {"float32": "f4", "float64": "f8", "int32": "i4"}
+
+
+def rule_annotations(values, hits):
+    annotations = []
+    for hit in hits:
+        annotations.append(
+            dict(
+                x=hit.end,
+                y=values[hit.end],
+                xref="x",
+                yref="y",
+                text=describe_hit(hit),
+                showarrow=True,
+                arrowhead=7,
+                ax=0,
+                ay=ANNOTATION_OFFSETS[hit.rule],
+            )
+        )
+    return annotations
+
+
+def _binary(size):
+    return size >= content.FIGURE_BINARY_MIN_POINTS
+
+
+def _webgl(size):
+    return size >= content.WEBGL_MIN_POINTS
+
+
+def encode_values(values, dtype=None):
+    # Короткие ряды - обычным списком (их можно дописывать Patch'ем),
+    # длинные - base64 typed array, который plotly.js читает без разбора
+    # текста
+    dtype = dtype or content.FIGURE_DTYPE
+    values = np.asarray(values)
+    if not _binary(len(values)):
+        return values.tolist()
+    values = values.astype("<" + _PLOTLY_DTYPES[dtype])
+    return {
+        "dtype": _PLOTLY_DTYPES[dtype],
+        "bdata": base64.b64encode(values.tobytes()).decode("ascii"),
+    }
+
+
+def sample_points(values, hits):
+    # Индексы точек для отрисовки длинной истории или None, если рисуем все.
+    # Точки правил, отмеченные детектором, не выбрасываются
+    if len(values) <= content.RENDER_POINTS:
+        return None
+    flagged = [np.arange(hit.start, hit.end + 1) for hit in hits]
+    return downsample_indices(
+        values,
+        content.RENDER_POINTS,
+        keep=np.concatenate(flagged) if flagged else (),
+        method=content.DOWNSAMPLE_METHOD,
+    )
+
+
+def values_trace(values, name, index=None, webgl=None, **kwargs):
+    # index из sample_points: рисуются только эти точки, x - их номера в окне.
+    # webgl=None - SVG или WebGL выбирается по числу рисуемых точек
+    if webgl is None:
+        webgl = _webgl(len(values) if index is None else len(index))
+    trace = go.Scattergl if webgl else go.Scatter
+    if index is None:
+        return trace(y=encode_values(values), name=name, **kwargs)
+    return trace(
+        x=encode_values(index, "int32"),
+        y=encode_values(np.asarray(values)[index]),
+        name=name,
+        **kwargs,
+    )
+
+
+def constant_trace(value, length, name, x=None, **kwargs):
+    # Постоянная линия - две точки на краях окна вместо значения на каждую;
+    # x - ось времени, если карта строится по времени, а не по номерам
+    return go.Scatter(
+        x=[0, max(length - 1, 0)] if x is None else [x[0], x[-1]],
+        y=[float(value), float(value)],
+        mode="lines",
+        name=name,
+        **kwargs,
+    )
+
+
+def control_figure(traces, title, y_title, annotations):
+    return {
+        "data": traces,
+        "layout": go.Layout(
+            title=title,
+            xaxis=dict(title="Sample Number"),
+            yaxis=dict(title=y_title),
+            showlegend=True,
+            annotations=annotations,
+        ),
+    }
+
+
+def time_axis(seconds):
+    # Секунды эпохи -> строки дат, которые plotly понимает как ось времени
+    milliseconds = np.round(np.asarray(seconds, dtype=float) * 1000)
+    return np.datetime_as_string(milliseconds.astype("datetime64[ms]")).tolist()
+
+
+def band_traces(x, low, high, name):
+    # Заливка между минимумом и максимумом корзин
+    return [
+        go.Scatter(
+            x=x,
+            y=encode_values(high),
+            mode="lines",
+            line=dict(width=0),
+            showlegend=False,
+            hoverinfo="skip",
+        ),
+        go.Scatter(
+            x=x,
+            y=encode_values(low),
+            mode="lines",
+            line=dict(width=0),
+            fill="tonexty",
+            fillcolor="rgba(0, 0, 255, 0.15)",
+            name=name,
+        ),
+    ]
+
+
+def time_figure(traces, title, y_title):
+    figure = control_figure(traces, title, y_title, [])
+    figure["layout"].xaxis.title.text = "Time"
+    return figure
+
+
+def figure_state(ids, limits, index=None):
+    # Что уже нарисовано у клиента: первый и последний id, число точек,
+    # границы и было ли окно прорежено. Нечисловые границы (NaN пустого окна)
+    # - None: после JSON у клиента они приходят как null, и состояние должно
+    # совпасть с тем, что он прислал обратно
+    first, version, size = cache.series_version(ids)
+    return {
+        "version": version,
+        "first": first,
+        "size": size,
+        "limits": [float(limit) if np.isfinite(limit) else None for limit in limits],
+        "sampled": index is not None,
+    }
+
+
+def patch_figure(shown, state, ids, series, annotations):
+    # Вместо полного figure отправляем Patch: новые точки дописываются в
+    # хвост трасс, вышедшие из окна удаляются из головы. series - y всех
+    # трасс в порядке figure["data"]: первая - сами значения, дальше линии
+    # центра и границ; число вместо массива - постоянная линия из
+    # constant_trace. None - состояние клиента не сходится с окном (первая
+    # отрисовка, пропуск больше окна) или окно прорежено и набор точек
+    # меняется целиком, нужна полная перестройка
+    if not shown or not len(ids) or shown["version"] not in ids:
+        return None
+    if shown.get("sampled") or state["sampled"]:
+        return None
+    if _webgl(shown["size"]) != _webgl(state["size"]):
+        # Patch не меняет тип трасс, при переходе на WebGL строим заново
+        return None
+    fresh = len(ids) - 1 - int(np.flatnonzero(ids == shown["version"])[0])
+    drop = shown["size"] + fresh - len(ids)
+    if drop < 0:
+        return None
+    # Опоздавшая строка с меньшим id встала внутрь окна: без сдвига головы
+    # первый id должен остаться прежним, со сдвигом - вырасти
+    first = shown.get("first")
+    if first is None or (ids[0] != first if drop == 0 else ids[0] <= first):
+        return None
+    limits_moved = shown["limits"] != state["limits"]
+    patch = Patch()
+    for i, values in enumerate(series):
+        if np.ndim(values) == 0:
+            if limits_moved or drop != fresh:
+                patch["data"][i]["x"] = [0, max(len(ids) - 1, 0)]
+                patch["data"][i]["y"] = [float(values), float(values)]
+            continue
+        values = np.asarray(values, dtype=float)
+        if (i and limits_moved) or _binary(shown["size"]) or _binary(len(values)):
+            # Границы сдвинулись или у клиента typed array, который нельзя
+            # дописать по элементам - трассу перезаписываем целиком
+            patch["data"][i]["y"] = encode_values(values)
+            continue
+        trace = patch["data"][i]["y"]
+        for _ in range(drop):
+            del trace[0]
+        trace.extend(values[len(values) - fresh :].tolist())
+    patch["layout"]["annotations"] = annotations
+    return patch
@@ -6,6 +6,7 @@ def Navbar():
         children=[
             dbc.NavItem(dbc.NavLink("Home", href="/")),
             dbc.NavItem(dbc.NavLink("Manage Bindings", href="/manage_bindings")),
+            dbc.NavItem(dbc.NavLink("Benchmark", href="/benchmark")),
         ],
         brand="Shewhart cards",
         brand_href="/",
@@ -0,0 +1,119 @@
+import csv
+import json
+from collections import namedtuple
+
+from sqlalchemy import delete, func, insert, select
+
+from shewhart_app.components.service.detectors import ChunkedDetector
+from shewhart_app.components.service.models import (
+    BacktestHit,
+    IndividualMeasurement,
+    Measurement,
+)
+from shewhart_app.components.service.queries import VALUE_DTYPE, iter_arrays
+from shewhart_app.components.service.session import session_scope
+
+BACKTEST_CHUNK_SIZE = 50000
+HIT_FIELDS = [
+    "series",
+    "binding_id",
+    "chart_id",
+    "rule",
+    "direction",
+    "start_index",
+    "end_index",
+    "start_measurement_id",
+    "end_measurement_id",
+    "center",
+]
+
+BacktestSummary = namedtuple("BacktestSummary", ["series", "points", "hits", "center"])
+
+
+def _series_statements(binding_id, chart_id):
+    # Без chart_id - p-карта связки, центр - p_bar по всей истории; с chart_id
+    # - значения чарта, центр - их среднее
+    if chart_id is None:
+        where = [Measurement.binding_id == binding_id]
+        center = select(
+            func.sum(Measurement.proportion * Measurement.sample_size)
+            / func.sum(Measurement.sample_size)
+        ).where(*where)
+        rows = select(Measurement.id, Measurement.proportion).where(*where)
+        return "p", center, rows.order_by(Measurement.id)
+    where = [
+        IndividualMeasurement.binding_id == binding_id,
+        IndividualMeasurement.chart_id == chart_id,
+    ]
+    center = select(func.avg(IndividualMeasurement.value)).where(*where)
+    rows = select(IndividualMeasurement.id, IndividualMeasurement.value).where(*where)
+    return "x", center, rows.order_by(IndividualMeasurement.id)
+
+
+def _file_writer(stream, path):
+    if path.endswith(".csv"):
+        writer = csv.DictWriter(stream, HIT_FIELDS)
+        writer.writeheader()
+        return writer.writerows
+    return lambda rows: stream.writelines(json.dumps(row) + "\n" for row in rows)
+
+
+def _backtest(binding_id, chart_id, write, chunk_size):
+    series, center_statement, rows_statement = _series_statements(binding_id, chart_id)
+    with session_scope() as session:
+        center = session.execute(center_statement).scalar()
+        if center is None:
+            return BacktestSummary(series, 0, 0, None)
+        center = float(center)
+        if write is None:
+            # Прошлый прогон того же ряда заменяется целиком
+            session.execute(
+                delete(BacktestHit).where(
+                    BacktestHit.series == series,
+                    BacktestHit.binding_id == binding_id,
+                    BacktestHit.chart_id == chart_id,
+                )
+            )
+
+            def write(rows):
+                session.execute(insert(BacktestHit), rows)
+
+        def flush(hits):
+            if hits:
+                write(
+                    [
+                        {
+                            "series": series,
+                            "binding_id": binding_id,
+                            "chart_id": chart_id,
+                            "rule": hit.rule,
+                            "direction": hit.direction,
+                            "start_index": hit.start,
+                            "end_index": hit.end,
+                            "start_measurement_id": hit.start_key,
+                            "end_measurement_id": hit.end_key,
+                            "center": center,
+                        }
+                        for hit in hits
+                    ]
+                )
+            return len(hits)
+
+        # Серверный курсор: в памяти один кусок строк и открытые
+        # серии детектора
+        detector = ChunkedDetector(center)
+        total = 0
+        for chunk in iter_arrays(session, rows_statement, VALUE_DTYPE, chunk_size):
+            total += flush(detector.feed(chunk["id"], chunk["value"]))
+        total += flush(detector.close())
+        return BacktestSummary(series, detector.count, total, center)
+
+
+def run_backtest(binding_id, chart_id=None, output=None, chunk_size=None):
+    # Все срабатывания правил по полной истории ряда. Без output результат
+    # пишется в backtest_hits, иначе в файл: .csv или JSON lines
+    chunk_size = chunk_size or BACKTEST_CHUNK_SIZE
+    if output is None:
+        return _backtest(binding_id, chart_id, None, chunk_size)
+    with open(output, "w", newline="") as stream:
+        return _backtest(binding_id, chart_id, _file_writer(stream, output), chunk_size)
@@ -0,0 +1,468 @@
+import io
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import queries
+from shewhart_app.components.service.queries import MEASUREMENT_DTYPE, SUBGROUP_DTYPE
+from shewhart_app.components.service.scheduler import chart_scheduler
+from shewhart_app.components.service.session import session_scope
+
+MEASUREMENT_CAPACITY = content.HISTORY_POINTS
+SUBGROUP_CAPACITY = content.HISTORY_POINTS
+
+
+def merge_rows(current, rows, capacity):
+    # Последние capacity строк объединения по возрастанию id; current - окно
+    # (по возрастанию id без повторов), при повторе id остается его строка
+    ids = rows["id"]
+    if np.all(ids[1:] > ids[:-1]) and (
+        not len(current) or not len(ids) or ids[0] > current["id"][-1]
+    ):
+        # Обычный случай - строки новее окна: сортировать нечего
+        keep = max(capacity - len(rows), 0)
+        merged = np.concatenate(
+            (current[len(current) - min(keep, len(current)) :], rows)
+        )
+    else:
+        merged = np.concatenate((current, rows))
+        _, first = np.unique(merged["id"], return_index=True)
+        merged = merged[first]
+    return merged[len(merged) - min(capacity, len(merged)) :]
+
+
+class RingBuffer:
+    def __init__(self, capacity, dtype):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.start = 0
+        self.size = 0
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    @property
+    def last_id(self):
+        if not self.size:
+            return None
+        return int(self.data["id"][(self.start + self.size - 1) % self.capacity])
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.data.dtype)
+        if self.size and len(rows) and rows["id"].min() <= self.last_id:
+            # Пачки коммитятся не по порядку id: опоздавшие строки встают на
+            # свое место в окне, уже лежащие в буфере не дублируются
+            merged = merge_rows(self.latest(), rows, self.capacity)
+            self.data[: len(merged)] = merged
+            self.start = 0
+            self.size = len(merged)
+            return
+        if len(rows) >= self.capacity:
+            self.data[:] = rows[-self.capacity :]
+            self.start = 0
+            self.size = self.capacity
+            return
+        positions = (self.start + self.size + np.arange(len(rows))) % self.capacity
+        self.data[positions] = rows
+        overflow = max(0, self.size + len(rows) - self.capacity)
+        self.start = (self.start + overflow) % self.capacity
+        self.size = min(self.capacity, self.size + len(rows))
+
+    def latest(self, n=None):
+        n = self.size if n is None else min(n, self.size)
+        positions = (self.start + np.arange(self.size - n, self.size)) % self.capacity
+        return self.data[positions]
+
+
+class SeriesCache:
+    # LRU-кэш кольцевых буферов. Буфер создается при первом чтении из БД,
+    # дальше пополняется при вставках и отдает данные без запросов.
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, n=None):
+        with self._lock:
+            buffer = self._entries.get(key)
+            if buffer is None:
+                return None
+            self._entries.move_to_end(key)
+            return buffer.latest(n)
+
+    def begin_load(self, key):
+        with self._lock:
+            self._loading[key] = False
+
+    def finish_load(self, key, rows, capacity, dtype):
+        with self._lock:
+            # Если во время загрузки пришла вставка, загруженные строки могли
+            # ее не увидеть - такой результат в кэш не кладем
+            stale = self._loading.pop(key, True)
+            if stale or key in self._entries:
+                return
+            buffer = RingBuffer(capacity, dtype)
+            buffer.extend(rows)
+            self._entries[key] = buffer
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def append(self, key, rows):
+        with self._lock:
+            if key in self._loading:
+                self._loading[key] = True
+            buffer = self._entries.get(key)
+            if buffer is not None:
+                buffer.extend(rows)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._loading:
+                self._loading[key] = True
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+
+
+def _key(key):
+    return ":".join(str(part) for part in key)
+
+
+def _dump(rows):
+    buffer = io.BytesIO()
+    np.save(buffer, rows, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _load(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+# Дописанные строки ряда лежат в файле отдельными чанками; когда их больше
+# COMPACT_CHUNKS, читатель сливает их в один. Ряд, который никто не читает,
+# после DROP_CHUNKS дописок выбрасывается и при следующем чтении
+# загрузится из БД
+COMPACT_CHUNKS = 64
+DROP_CHUNKS = 1024
+
+
+class DiskSeriesCache:
+    # Общий для процессов одного хоста кэш в файле SQLite: воркеры gunicorn
+    # видят ряды, загруженные и пополненные соседями. Межпроцессная
+    # блокировка - BEGIN IMMEDIATE, счетчик изменений ключа заменяет флаг
+    # _loading из SeriesCache. Вставка пишет только свои строки новым чанком
+    # (seq = версия ряда), поэтому ее цена не зависит от глубины истории.
+    # Разобранное окно держим локально и дочитываем только чанки новее него;
+    # generation меняется при каждой загрузке ряда из БД
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._decoded = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # После fork соединения и разобранные копии родителя не используем
+            self._local = threading.local()
+            with self._lock:
+                self._decoded.clear()
+                self._loading.clear()
+            self._pid = os.getpid()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # Окна целиком одним BLOB хранила прежняя версия кэша
+            connection.execute("DROP TABLE IF EXISTS series")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS windows (key TEXT PRIMARY KEY,"
+                " generation INTEGER NOT NULL, version INTEGER NOT NULL,"
+                " chunks INTEGER NOT NULL, capacity INTEGER NOT NULL,"
+                " used_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (key TEXT NOT NULL,"
+                " seq INTEGER NOT NULL, data BLOB NOT NULL,"
+                " PRIMARY KEY (key, seq)) WITHOUT ROWID"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS changes"
+                " (key TEXT PRIMARY KEY, counter INTEGER NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _write(self, function):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _bump(connection, key):
+        connection.execute(
+            "INSERT INTO changes (key, counter) VALUES (?, 1) ON CONFLICT(key)"
+            " DO UPDATE SET counter = counter + 1",
+            (key,),
+        )
+
+    @staticmethod
+    def _counter(connection, key):
+        row = connection.execute(
+            "SELECT counter FROM changes WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _drop(connection, key):
+        connection.execute("DELETE FROM windows WHERE key = ?", (key,))
+        connection.execute("DELETE FROM chunks WHERE key = ?", (key,))
+
+    def _read(self, connection, key):
+        # Заголовок и чанки одним снимком WAL; None - ряда в файле нет
+        with self._lock:
+            decoded = self._decoded.get(key)
+        connection.execute("BEGIN")
+        try:
+            header = connection.execute(
+                "SELECT generation, version, chunks, capacity FROM windows"
+                " WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if header is None:
+                return None, None
+            generation, version, chunks, capacity = header
+            if decoded is not None and decoded[:2] == (generation, version):
+                return decoded, chunks
+            if decoded is None or decoded[0] != generation or decoded[1] > version:
+                decoded = None
+            fresh = [
+                _load(data)
+                for (data,) in connection.execute(
+                    "SELECT data FROM chunks WHERE key = ? AND seq > ?" " ORDER BY seq",
+                    (key, -1 if decoded is None else decoded[1]),
+                )
+            ]
+        finally:
+            connection.execute("COMMIT")
+        current = fresh[0][:0] if decoded is None else decoded[2]
+        rows = merge_rows(current, np.concatenate(fresh), capacity)
+        return (generation, version, rows), chunks
+
+    def _compact(self, key, decoded):
+        generation, version, rows = decoded
+
+        def compact(connection):
+            # Пока окно читали, ряд могли дописать или перезагрузить
+            row = connection.execute(
+                "SELECT generation, version FROM windows WHERE key = ?", (key,)
+            ).fetchone()
+            if row != (generation, version):
+                return
+            connection.execute("DELETE FROM chunks WHERE key = ?", (key,))
+            connection.execute(
+                "INSERT INTO chunks (key, seq, data) VALUES (?, ?, ?)",
+                (key, version, _dump(rows)),
+            )
+            connection.execute("UPDATE windows SET chunks = 1 WHERE key = ?", (key,))
+
+        self._write(compact)
+
+    def get(self, key, n=None):
+        key = _key(key)
+        decoded, chunks = self._read(self._connection(), key)
+        if decoded is None:
+            return None
+        with self._lock:
+            self._decoded[key] = decoded
+            self._decoded.move_to_end(key)
+            while len(self._decoded) > self.max_entries:
+                self._decoded.popitem(last=False)
+        if chunks > COMPACT_CHUNKS:
+            self._compact(key, decoded)
+        rows = decoded[2]
+        return rows if n is None else rows[len(rows) - min(n, len(rows)) :]
+
+    def begin_load(self, key):
+        key = _key(key)
+        counter = self._counter(self._connection(), key)
+        with self._lock:
+            self._loading[key] = counter
+
+    def finish_load(self, key, rows, capacity, dtype):
+        key = _key(key)
+        with self._lock:
+            started = self._loading.pop(key, None)
+        rows = merge_rows(np.zeros(0, dtype=dtype), rows, capacity)
+
+        def store(connection):
+            # Изменения ключа во время загрузки (в любом процессе) делают
+            # загруженные строки устаревшими
+            if started is None or self._counter(connection, key) != started:
+                return
+            exists = connection.execute(
+                "SELECT 1 FROM windows WHERE key = ?", (key,)
+            ).fetchone()
+            if exists:
+                return
+            connection.execute(
+                "INSERT INTO windows (key, generation, version, chunks, capacity,"
+                " used_at) VALUES (?, ?, 0, 1, ?, ?)",
+                (key, secrets.randbits(62), capacity, time.time()),
+            )
+            connection.execute(
+                "INSERT INTO chunks (key, seq, data) VALUES (?, 0, ?)",
+                (key, _dump(rows)),
+            )
+            for (evicted,) in connection.execute(
+                "SELECT key FROM windows ORDER BY used_at DESC LIMIT -1 OFFSET ?",
+                (self.max_entries,),
+            ).fetchall():
+                self._drop(connection, evicted)
+
+        self._write(store)
+
+    def append(self, key, rows):
+        key = _key(key)
+        rows = np.asarray(rows)
+
+        def extend(connection):
+            self._bump(connection, key)
+            row = connection.execute(
+                "SELECT version, chunks FROM windows WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return
+            version, chunks = row
+            if chunks >= DROP_CHUNKS:
+                self._drop(connection, key)
+                return
+            connection.execute(
+                "INSERT INTO chunks (key, seq, data) VALUES (?, ?, ?)",
+                (key, version + 1, _dump(rows)),
+            )
+            connection.execute(
+                "UPDATE windows SET version = ?, chunks = ?, used_at = ?"
+                " WHERE key = ?",
+                (version + 1, chunks + 1, time.time(), key),
+            )
+
+        self._write(extend)
+
+    def invalidate(self, key):
+        key = _key(key)
+
+        def drop(connection):
+            self._bump(connection, key)
+            self._drop(connection, key)
+
+        self._write(drop)
+
+    def clear(self):
+        def drop_all(connection):
+            connection.execute("DELETE FROM windows")
+            connection.execute("DELETE FROM chunks")
+            connection.execute("UPDATE changes SET counter = counter + 1")
+
+        self._write(drop_all)
+        with self._lock:
+            self._decoded.clear()
+            self._loading.clear()
+
+
+def _series_cache():
+    if content.CACHE_BACKEND == "disk":
+        return DiskSeriesCache(content.CACHE_PATH, content.CACHE_MAX_ENTRIES)
+    return SeriesCache(content.CACHE_MAX_ENTRIES)
+
+
+series_cache = _series_cache()
+
+
+def series_version(ids):
+    # Маркер изменений окна ряда: первый и последний id и длина. Одного
+    # последнего id мало - опоздавшая строка с меньшим id меняет окно, не
+    # трогая хвост: в неполном окне растет длина, в полном вытесняется первая
+    if not len(ids):
+        return (0, 0, 0)
+    return (int(ids[0]), int(ids[-1]), len(ids))
+
+
+def recent_measurements(binding_id):
+    key = ("p", binding_id)
+    rows = series_cache.get(key)
+    if rows is not None:
+        return rows
+    series_cache.begin_load(key)
+    with session_scope() as session:
+        rows = queries.recent_measurements(session, binding_id, MEASUREMENT_CAPACITY)
+    series_cache.finish_load(key, rows, MEASUREMENT_CAPACITY, MEASUREMENT_DTYPE)
+    return rows
+
+
+def recent_subgroup_stats(chart_ids, subgroup_size):
+    series = {}
+    missing = []
+    for chart_id in chart_ids:
+        rows = series_cache.get(("s", chart_id, subgroup_size))
+        if rows is None:
+            missing.append(chart_id)
+        else:
+            series[chart_id] = rows
+    if missing:
+        # Все промахи догружаем одним запросом
+        for chart_id in missing:
+            series_cache.begin_load(("s", chart_id, subgroup_size))
+        with session_scope() as session:
+            loaded = queries.recent_subgroup_stats(
+                session, missing, subgroup_size, SUBGROUP_CAPACITY
+            )
+        for chart_id, rows in loaded.items():
+            series_cache.finish_load(
+                ("s", chart_id, subgroup_size),
+                rows,
+                SUBGROUP_CAPACITY,
+                SUBGROUP_DTYPE,
+            )
+            series[chart_id] = rows
+    return series
+
+
+def add_measurements(binding_id, rows):
+    # rows - кортежи (id, proportion, sample_size) уже закоммиченных строк
+    series_cache.append(("p", binding_id), np.array(rows, dtype=MEASUREMENT_DTYPE))
+    chart_scheduler.notify(("p", binding_id))
+
+
+def invalidate(key):
+    series_cache.invalidate(key)
+    chart_scheduler.notify(key)
+
+
+def add_subgroup_stats(chart_id, subgroup_size, rows):
+    # rows - кортежи (subgroup_index, last_measurement_id, mean, range, stddev)
+    series_cache.append(
+        ("s", chart_id, subgroup_size), np.array(rows, dtype=SUBGROUP_DTYPE)
+    )
+    chart_scheduler.notify(("s", chart_id, subgroup_size))
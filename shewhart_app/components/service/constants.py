@@ -64,3 +64,5 @@ B4_values = {
     9: 1.840,
     10: 1.803,
 }
+# Размеры подгрупп, для которых есть коэффициенты и ведутся статистики
+SUBGROUP_SIZES = sorted(D4_values)
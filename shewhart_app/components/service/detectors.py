@@ -1,121 +1,349 @@
-def detect_trends(proportions):
-    increasing_trend = 0
-    decreasing_trend = 0
-    for i in range(1, len(proportions)):
-        if proportions[i] > proportions[i - 1]:
-            increasing_trend += 1
-            decreasing_trend = 0
-        elif proportions[i] < proportions[i - 1]:
-            decreasing_trend += 1
-            increasing_trend = 0
-        else:
-            increasing_trend = 0
-            decreasing_trend = 0
-        if increasing_trend >= 7:
-            return True, f"Increasing trend detected starting at point {i - 6}"
-        if decreasing_trend >= 7:
-            return True, f"Decreasing trend detected starting at point {i - 6}"
-    return False, ""
-
-
-def detect_shifts(proportions, p_bar):
-    above_mean = 0
-    below_mean = 0
-    for i in range(len(proportions)):
-        if proportions[i] > p_bar:
-            above_mean += 1
-            below_mean = 0
-        elif proportions[i] < p_bar:
-            below_mean += 1
-            above_mean = 0
-        else:
-            above_mean = 0
-            below_mean = 0
-        if above_mean >= 8:
-            return True, f"Shift above the mean detected starting at point {i - 7}"
-        if below_mean >= 8:
-            return True, f"Shift below the mean detected starting at point {i - 7}"
-    return False, ""
-
-
-def detect_asterisks(proportions, p_bar):
-    above_mean = 0
-    for i in range(len(proportions)):
-        if proportions[i] > p_bar:
-            above_mean += 1
-        else:
-            above_mean = 0
-        if above_mean >= 7:
-            return (
-                True,
-                f"Asterisk pattern detected above the mean starting at point {i - 6}",
-            )
-    return False, ""
-
-
-def detect_trends_x(data_points):
-    increasing_trend = 0
-    decreasing_trend = 0
-    for i in range(1, len(data_points)):
-        if data_points[i] > data_points[i - 1]:
-            increasing_trend += 1
-            decreasing_trend = 0
-        elif data_points[i] < data_points[i - 1]:
-            decreasing_trend += 1
-            increasing_trend = 0
-        else:
-            increasing_trend = 0
-            decreasing_trend = 0
-
-        if (
-            increasing_trend >= 7
-        ):  # значение 7 может быть изменено в зависимости от ваших потребностей
-            return True, f"Increasing trend detected starting at point {i - 6}"
-        if decreasing_trend >= 7:
-            return True, f"Decreasing trend detected starting at point {i - 6}"
-
-    return False, ""
-
-
-# Функция для определения сдвигов в данных
-def detect_shifts_x(data_points, mean_value):
-    above_mean = 0
-    below_mean = 0
-    for point in data_points:
-        if point > mean_value:
-            above_mean += 1
-            below_mean = 0
-        elif point < mean_value:
-            below_mean += 1
-            above_mean = 0
-        else:
-            above_mean = 0
-            below_mean = 0
-
-        if (
-            above_mean >= 8
-        ):  # значение 8 может быть изменено в зависимости от ваших потребностей
-            return True, "Shift above the mean detected"
-        if below_mean >= 8:
-            return True, "Shift below the mean detected"
-
-    return False, ""
-
-
-def detect_asterisks_x(data_points, mean_value):
-    above_mean = 0
-    for point in data_points:
-        if point > mean_value:
-            above_mean += 1
-        else:
-            above_mean = 0  # сброс счетчика, если точка ниже среднего
-
-        if (
-            above_mean >= 7
-        ):  # значение 7 может быть изменено в зависимости от ваших потребностей
-            return (
-                True,
-                f"Asterisk pattern detected above the mean starting at point {len(data_points) - above_mean}",
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Длины серий, при которых срабатывает правило
+TREND_LENGTH = 7  # подряд идущих возрастаний/убываний
+SHIFT_LENGTH = 8  # точек подряд по одну сторону от центральной линии
+ASTERISK_LENGTH = 7  # точек подряд выше центральной линии
+
+RULES = ("trend", "shift", "asterisk")
+_THRESHOLDS = {
+    "trend": TREND_LENGTH,
+    "shift": SHIFT_LENGTH,
+    "asterisk": ASTERISK_LENGTH,
+}
+
+# start/end - индексы первой и последней точки серии (включительно),
+# direction - "up" или "down"
+RuleHit = namedtuple("RuleHit", ["rule", "start", "end", "direction"])
+
+_MESSAGES = {
+    ("trend", "up"): "Increasing trend detected starting at point {}",
+    ("trend", "down"): "Decreasing trend detected starting at point {}",
+    ("shift", "up"): "Shift above the mean detected starting at point {}",
+    ("shift", "down"): "Shift below the mean detected starting at point {}",
+    ("asterisk", "up"): "Asterisk pattern detected above the mean starting at point {}",
+}
+
+
+def _runs(mask, min_length):
+    # Начала и концы (включительно) серий True длиной не меньше min_length
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    starts, stops = edges[::2], edges[1::2]
+    keep = stops - starts >= min_length
+    return starts[keep], stops[keep] - 1
+
+
+def _trend_hits(values):
+    # Тренды: серии одинаковых знаков первой разности. Серия разностей
+    # [s, e] покрывает точки [s, e + 1].
+    steps = np.sign(np.diff(values))
+    hits = []
+    for direction, sign in (("up", 1), ("down", -1)):
+        starts, ends = _runs(steps == sign, TREND_LENGTH)
+        hits.extend(
+            RuleHit("trend", int(s), int(e) + 1, direction)
+            for s, e in zip(starts, ends)
+        )
+    return hits
+
+
+def _side_hits(values, center):
+    # Сдвиги и звездочки: серии одинаковых знаков отклонения от центра
+    sides = np.sign(values - center)
+    hits = []
+    for direction, sign in (("up", 1), ("down", -1)):
+        starts, ends = _runs(sides == sign, SHIFT_LENGTH)
+        hits.extend(
+            RuleHit("shift", int(s), int(e), direction) for s, e in zip(starts, ends)
+        )
+    starts, ends = _runs(sides == 1, ASTERISK_LENGTH)
+    hits.extend(RuleHit("asterisk", int(s), int(e), "up") for s, e in zip(starts, ends))
+    return hits
+
+
+def _sort_hits(hits):
+    return sorted(hits, key=lambda hit: (hit.end, RULES.index(hit.rule)))
+
+
+def detect_rules(values, center):
+    values = np.asarray(values, dtype=float)
+    return _sort_hits(_trend_hits(values) + _side_hits(values, center))
+
+
+def detect_rules_batch(values, centers):
+    # values - 2-D (ряды x точки), короткие ряды дополнены NaN в конце,
+    # centers - центр на ряд. Ряды склеиваются через NaN, который рвет любую
+    # серию, и просматриваются одним проходом; индексы в попаданиях - внутри
+    # своего ряда
+    values = np.asarray(values, dtype=float)
+    rows, width = values.shape
+    padded = np.full((rows, width + 1), np.nan)
+    padded[:, :width] = values
+    flat = padded.ravel()
+    flat_centers = np.repeat(np.asarray(centers, dtype=float), width + 1)
+    hits = [[] for _ in range(rows)]
+    for hit in _trend_hits(flat) + _side_hits(flat, flat_centers):
+        row, start = divmod(hit.start, width + 1)
+        hits[row].append(hit._replace(start=start, end=hit.end - row * (width + 1)))
+    return [_sort_hits(row_hits) for row_hits in hits]
+
+
+def _tail_run(mask):
+    # Длина серии True в конце массива
+    breaks = np.flatnonzero(~mask)
+    return len(mask) - 1 - breaks[-1] if breaks.size else len(mask)
+
+
+class StreamingDetector:
+    # Потоковый вариант detect_rules: хранит счетчики серий и продвигает их
+    # на каждую новую точку. Индексы точек в self.hits абсолютные (от первой
+    # точки, увиденной детектором), self.count - число увиденных точек.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.center = None
+        self.last_key = None
+        self.count = 0
+        self.last_value = None
+        self.up = self.down = 0
+        self.above = self.below = 0
+        self.hits = []
+
+    def reset(self, values, center):
+        values = np.asarray(values, dtype=float)
+        self.count = len(values)
+        self.last_value = values[-1] if len(values) else None
+        steps = np.sign(np.diff(values))
+        self.up = _tail_run(steps == 1)
+        self.down = _tail_run(steps == -1)
+        self.hits = _trend_hits(values)
+        self.reset_center(values, center)
+
+    def reset_center(self, values, center):
+        # Пересчитываем только правила, зависящие от центральной линии
+        values = np.asarray(values, dtype=float)
+        offset = self.count - len(values)
+        sides = np.sign(values - center)
+        self.center = center
+        self.above = _tail_run(sides == 1)
+        self.below = _tail_run(sides == -1)
+        self.hits = [hit for hit in self.hits if hit.rule == "trend"] + [
+            hit._replace(start=hit.start + offset, end=hit.end + offset)
+            for hit in _side_hits(values, center)
+        ]
+
+    def push(self, value, track_center=True):
+        index = self.count
+        if self.last_value is not None:
+            if value > self.last_value:
+                self.up += 1
+                self.down = 0
+            elif value < self.last_value:
+                self.down += 1
+                self.up = 0
+            else:
+                self.up = self.down = 0
+        self.last_value = value
+        self._advance("trend", "up", self.up, TREND_LENGTH, index - self.up, index)
+        self._advance(
+            "trend", "down", self.down, TREND_LENGTH, index - self.down, index
+        )
+        if track_center:
+            if value > self.center:
+                self.above += 1
+                self.below = 0
+            elif value < self.center:
+                self.below += 1
+                self.above = 0
+            else:
+                self.above = self.below = 0
+            start = index - self.above + 1
+            self._advance("shift", "up", self.above, SHIFT_LENGTH, start, index)
+            self._advance("asterisk", "up", self.above, ASTERISK_LENGTH, start, index)
+            start = index - self.below + 1
+            self._advance("shift", "down", self.below, SHIFT_LENGTH, start, index)
+        self.count += 1
+
+    def _advance(self, rule, direction, length, threshold, start, end):
+        if length < threshold:
+            return
+        if length > threshold:
+            # Серия продолжается - продлеваем уже найденное срабатывание
+            for i in range(len(self.hits) - 1, -1, -1):
+                hit = self.hits[i]
+                if (hit.rule, hit.direction, hit.end) == (rule, direction, end - 1):
+                    self.hits[i] = hit._replace(end=end)
+                    return
+        self.hits.append(RuleHit(rule, start, end, direction))
+
+    def window_hits(self, size):
+        # Срабатывания в последних size точках, индексы относительно окна.
+        # Серии, обрезанные началом окна, учитываются, только если их
+        # оставшаяся часть все еще дотягивает до порога - как у detect_rules.
+        offset = self.count - size
+        hits = []
+        for hit in self.hits:
+            start = max(hit.start, offset)
+            length = hit.end - start + (0 if hit.rule == "trend" else 1)
+            if hit.end >= offset and length >= _THRESHOLDS[hit.rule]:
+                hits.append(hit._replace(start=start - offset, end=hit.end - offset))
+        return _sort_hits(hits)
+
+    def sync(self, keys, values, center):
+        # keys - возрастающие ключи точек окна (id измерений). Если последняя
+        # виденная точка все еще в окне, достаточно прогнать только новые.
+        with self.lock:
+            keys = np.asarray(keys)
+            values = np.asarray(values, dtype=float)
+            if self.last_key is None or self.last_key not in keys:
+                self.reset(values, center)
+            else:
+                fresh = values[keys > self.last_key]
+                same_center = center == self.center
+                for value in fresh:
+                    self.push(value, track_center=same_center)
+                if not same_center:
+                    self.reset_center(values, center)
+            self.last_key = keys[-1] if len(keys) else None
+            # Забываем срабатывания, целиком ушедшие из окна
+            offset = self.count - len(values)
+            self.hits = [hit for hit in self.hits if hit.end >= offset]
+            return self.window_hits(len(values))
+
+
+# Срабатывание с ключами (id) первой и последней точки серии; start/end -
+# номера точек от начала всей истории
+KeyedHit = namedtuple(
+    "KeyedHit", ["rule", "start", "end", "direction", "start_key", "end_key"]
+)
+
+
+class _RunTracker:
+    # Серии True в маске, приходящей кусками: серия, дошедшая до конца куска,
+    # остается открытой и продолжается в следующем
+
+    def __init__(self, rule, direction, threshold, lead):
+        self.rule = rule
+        self.direction = direction
+        self.threshold = threshold
+        # lead=1 для трендов: маска - по шагам, шаг в точке p идет от p - 1
+        self.lead = lead
+        self.open = None
+        self.length = 0
+
+    def _hit(self, start, start_key, length, end, end_key):
+        if length < self.threshold:
+            return []
+        return [
+            KeyedHit(
+                self.rule,
+                int(start),
+                int(end),
+                self.direction,
+                int(start_key),
+                int(end_key),
             )
+        ]
+
+    def feed(self, mask, offset, start_keys, keys, previous_key):
+        # start_keys[i] - ключ первой точки серии, начатой в позиции i маски
+        hits = []
+        starts, ends = _runs(mask, 1)
+        if self.open is not None and not (len(starts) and starts[0] == 0):
+            hits += self._hit(*self.open, self.length, offset - 1, previous_key)
+            self.open = None
+        lengths = ends - starts + 1
+        last = len(mask) - 1
+        keep = (lengths >= self.threshold) | (starts == 0) | (ends == last)
+        for start, end, length in zip(starts[keep], ends[keep], lengths[keep]):
+            if start == 0 and self.open is not None:
+                run_start, run_key = self.open
+                length += self.length
+                self.open = None
+            else:
+                run_start, run_key = offset + start - self.lead, start_keys[start]
+            if end == last:
+                self.open, self.length = (run_start, run_key), length
+            else:
+                hits += self._hit(run_start, run_key, length, offset + end, keys[end])
+        return hits
+
+    def close(self, end, end_key):
+        hits = []
+        if self.open is not None:
+            hits = self._hit(*self.open, self.length, end, end_key)
+        self.open = None
+        return hits
+
+
+class ChunkedDetector:
+    # detect_rules с постоянным центром по ряду, который читается кусками:
+    # между кусками переносятся только последняя точка и открытые серии, так
+    # что память не зависит от длины истории. Серия отдается, когда
+    # закончилась, целиком - как одно срабатывание detect_rules.
+
+    def __init__(self, center):
+        self.center = center
+        self.count = 0
+        self.last_value = None
+        self.last_key = None
+        self._trackers = [
+            _RunTracker("trend", "up", TREND_LENGTH, 1),
+            _RunTracker("trend", "down", TREND_LENGTH, 1),
+            _RunTracker("shift", "up", SHIFT_LENGTH, 0),
+            _RunTracker("shift", "down", SHIFT_LENGTH, 0),
+            _RunTracker("asterisk", "up", ASTERISK_LENGTH, 0),
+        ]
+
+    def feed(self, keys, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return []
+        previous = np.concatenate(([np.nan], values[:-1]))
+        previous_keys = np.concatenate(([self.last_key], keys[:-1]))
+        if self.last_value is not None:
+            previous[0] = self.last_value
+        # У первой точки истории шага нет - NaN не дает ни одного знака
+        steps = np.sign(values - previous)
+        sides = np.sign(values - self.center)
+        masks = [steps == 1, steps == -1, sides == 1, sides == -1, sides == 1]
+        hits = []
+        for tracker, mask in zip(self._trackers, masks):
+            start_keys = previous_keys if tracker.lead else keys
+            hits += tracker.feed(mask, self.count, start_keys, keys, self.last_key)
+        self.count += len(values)
+        self.last_value = values[-1]
+        self.last_key = keys[-1]
+        return _sort_hits(hits)
+
+    def close(self):
+        hits = []
+        for tracker in self._trackers:
+            hits += tracker.close(self.count - 1, self.last_key)
+        return _sort_hits(hits)
+
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def get_detector(key):
+    with _detectors_lock:
+        detector = _detectors.get(key)
+        if detector is None:
+            detector = _detectors[key] = StreamingDetector()
+        return detector
+
+
+def drop_detector(key):
+    # Вызывается, когда chart_scheduler выбрасывает снимок карты
+    with _detectors_lock:
+        _detectors.pop(key, None)
+
 
-    return False, ""
+def describe_hit(hit):
+    return _MESSAGES[hit.rule, hit.direction].format(hit.start)
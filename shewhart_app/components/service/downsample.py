@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def lttb_indices(values, n_out):
+    # Largest-Triangle-Three-Buckets: первая и последняя точки остаются,
+    # из каждой корзины между ними берется точка с наибольшей площадью
+    # треугольника с предыдущей выбранной точкой и средним следующей корзины
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    means = np.add.reduceat(values[: n - 1], edges[:-1]) / counts
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 1 < n_out - 2:
+            next_x = (edges[i + 1] + edges[i + 2] - 1) / 2
+            next_y = means[i + 1]
+        else:
+            next_x, next_y = n - 1, values[-1]
+        candidates = np.arange(lo, hi)
+        areas = np.abs(
+            (previous - next_x) * (values[lo:hi] - values[previous])
+            - (previous - candidates) * (next_y - values[previous])
+        )
+        previous = lo + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+def minmax_indices(values, n_out):
+    # Минимум и максимум каждой корзины - сохраняет выбросы, считается без
+    # цикла по корзинам
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    n_buckets = max(n_out // 2, 1)
+    if n <= n_out:
+        return np.arange(n)
+    bucket = -(-n // n_buckets)
+    padded = np.full(n_buckets * bucket, np.nan)
+    padded[:n] = values
+    matrix = padded.reshape(n_buckets, bucket)
+    filled = ~np.isnan(matrix).all(axis=1)
+    offsets = np.arange(n_buckets)[filled] * bucket
+    lows = offsets + np.nanargmin(matrix[filled], axis=1)
+    highs = offsets + np.nanargmax(matrix[filled], axis=1)
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
+
+
+METHODS = {"lttb": lttb_indices, "minmax": minmax_indices}
+
+
+def downsample_indices(values, n_out, keep=(), method="lttb"):
+    # Индексы точек для отрисовки; точки из keep (например, отмеченные
+    # детекторами) остаются всегда. None - прореживать нечего
+    if len(values) <= n_out:
+        return None
+    indices = METHODS[method](values, n_out)
+    if len(keep):
+        indices = np.union1d(indices, keep)
+    return indices
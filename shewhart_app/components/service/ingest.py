@@ -0,0 +1,193 @@
+import csv
+import datetime
+import io
+import itertools
+import json
+from collections import defaultdict
+
+from sqlalchemy import insert
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import cache
+from shewhart_app.components.service.models import IndividualMeasurement, Measurement
+from shewhart_app.components.service.session import session_scope
+from shewhart_app.components.service.subgroups import update_subgroup_stats
+
+
+def parse_records(text, fmt):
+    # fmt: "json" (массив объектов), "jsonl" (объект в строке) или "csv"
+    if fmt == "json":
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("JSON payload must be an array of objects")
+        return records
+    if fmt == "jsonl":
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(text)))
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def read_records(stream, fmt):
+    # Построчное чтение файла, чтобы большие выгрузки не грузить целиком
+    if fmt == "jsonl":
+        return (json.loads(line) for line in stream if line.strip())
+    if fmt == "csv":
+        return csv.DictReader(stream)
+    return iter(parse_records(stream.read(), fmt))
+
+
+def _measurement_time(record):
+    if record.get("measurement_time"):
+        return datetime.datetime.fromisoformat(str(record["measurement_time"]))
+    return datetime.datetime.utcnow()
+
+
+def measurement_row(record):
+    try:
+        row = {
+            "binding_id": int(record["binding_id"]),
+            "proportion": float(record["proportion"]),
+            "sample_size": int(record["sample_size"]),
+        }
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid measurement {record!r}: {error}") from error
+    row["measurement_time"] = _measurement_time(record)
+    return row
+
+
+def individual_row(record):
+    try:
+        row = {
+            "binding_id": int(record["binding_id"]),
+            "chart_id": int(record["chart_id"]),
+            "value": float(record["value"]),
+        }
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(
+            f"Invalid individual measurement {record!r}: {error}"
+        ) from error
+    row["measurement_time"] = _measurement_time(record)
+    return row
+
+
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_rows(session, table, columns, rows):
+    # COPY ... FROM STDIN через psycopg2, только для Postgres
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+    )
+
+
+def _use_copy(session, use_copy):
+    return use_copy and session.get_bind().dialect.name == "postgresql"
+
+
+def _write_measurements(session, batch, use_copy):
+    # Вставка и коммит пачки; id строк или None после COPY
+    if _use_copy(session, use_copy):
+        _copy_rows(
+            session,
+            Measurement.__tablename__,
+            ["binding_id", "proportion", "sample_size", "measurement_time"],
+            batch,
+        )
+        session.commit()
+        return None
+    ids = session.scalars(
+        insert(Measurement).returning(Measurement.id, sort_by_parameter_order=True),
+        batch,
+    ).all()
+    session.commit()
+    return ids
+
+
+def publish_measurements(batch, ids):
+    # Побочные эффекты уже закоммиченной пачки: буферы кэша рядов
+    if ids is None:
+        # COPY не возвращает id - буферы затронутых связок сбрасываем
+        for binding_id in {row["binding_id"] for row in batch}:
+            cache.invalidate(("p", binding_id))
+        return
+    by_binding = defaultdict(list)
+    for id_, row in zip(ids, batch):
+        by_binding[row["binding_id"]].append(
+            (id_, row["proportion"], row["sample_size"])
+        )
+    for binding_id, binding_rows in by_binding.items():
+        try:
+            cache.add_measurements(binding_id, binding_rows)
+        except Exception:
+            # Буфер мог остаться без этих строк - пусть перечитается из базы
+            cache.invalidate(("p", binding_id))
+            raise
+
+
+def write_measurements(batch):
+    # Только вставка и коммит одной пачки, без publish_measurements
+    with session_scope() as session:
+        return _write_measurements(session, batch, False)
+
+
+def ingest_measurements(rows, batch_size=None, use_copy=False):
+    # rows - словари, прошедшие measurement_row; коммит один на пачку
+    batch_size = batch_size or content.INGEST_BATCH_SIZE
+    total = 0
+    with session_scope() as session:
+        for batch in _batches(rows, batch_size):
+            publish_measurements(batch, _write_measurements(session, batch, use_copy))
+            total += len(batch)
+    return total
+
+
+def _write_individual_values(session, batch, use_copy):
+    if _use_copy(session, use_copy):
+        _copy_rows(
+            session,
+            IndividualMeasurement.__tablename__,
+            ["binding_id", "chart_id", "value", "measurement_time"],
+            batch,
+        )
+    else:
+        session.execute(insert(IndividualMeasurement), batch)
+    session.commit()
+
+
+def publish_individual_values(batch, ids=None):
+    # Подгруппы, заполненные пачкой, дописываем один раз на пачку
+    charts = defaultdict(set)
+    for row in batch:
+        charts[row["binding_id"]].add(row["chart_id"])
+    for binding_id, chart_ids in charts.items():
+        update_subgroup_stats(binding_id, sorted(chart_ids))
+
+
+def write_individual_values(batch):
+    with session_scope() as session:
+        _write_individual_values(session, batch, False)
+
+
+def ingest_individual_values(rows, batch_size=None, use_copy=False):
+    # rows - словари, прошедшие individual_row
+    batch_size = batch_size or content.INGEST_BATCH_SIZE
+    total = 0
+    with session_scope() as session:
+        for batch in _batches(rows, batch_size):
+            _write_individual_values(session, batch, use_copy)
+            publish_individual_values(batch)
+            total += len(batch)
+    return total
@@ -0,0 +1,194 @@
+import datetime
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import func, select, update
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import cache
+from shewhart_app.components.service.models import ControlLimit
+from shewhart_app.components.service.scheduler import chart_scheduler
+from shewhart_app.components.service.session import session_scope
+from shewhart_app.components.service.spc import p_chart_limits
+
+# Действующая фаза ряда; для p-карты заполнен только p_bar, для подгрупп -
+# x_bar, r_bar и s_bar
+FrozenLimits = namedtuple(
+    "FrozenLimits",
+    ["phase", "p_bar", "x_bar", "r_bar", "s_bar", "baseline_points", "frozen_at"],
+)
+
+
+class FrozenLimitsCache:
+    # Действующие фазы всех рядов одним словарем по ключам рядов кэша
+    # (("p", binding_id), ("s", chart_id, subgroup_size)): все карты тика
+    # берут фазы из одной загрузки. Заморозка в этом процессе сбрасывает
+    # словарь сразу, в соседних воркерах - через ttl секунд
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._loaded = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            loaded = self._loaded
+            generation = self._generation
+        if loaded is not None and time.monotonic() - loaded[0] < self.ttl:
+            return loaded[1].get(key)
+        phases = load()
+        with self._lock:
+            # Чтение, начатое до invalidate, могло увидеть старую фазу - его
+            # результат не кэшируем
+            if generation == self._generation:
+                self._loaded = (time.monotonic(), phases)
+        return phases.get(key)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+            self._generation += 1
+
+
+frozen_cache = FrozenLimitsCache(content.FROZEN_LIMITS_TTL)
+
+
+def _where(key):
+    if key[0] == "p":
+        return [ControlLimit.series == "p", ControlLimit.binding_id == key[1]]
+    return [
+        ControlLimit.series == "s",
+        ControlLimit.chart_id == key[1],
+        ControlLimit.subgroup_size == key[2],
+    ]
+
+
+def _load():
+    # Одним запросом по всем рядам; при нескольких незакрытых фазах ряда
+    # действует последняя
+    phases = {}
+    with session_scope() as session:
+        for row in session.execute(
+            select(
+                ControlLimit.series,
+                ControlLimit.binding_id,
+                ControlLimit.chart_id,
+                ControlLimit.subgroup_size,
+                ControlLimit.phase,
+                ControlLimit.p_bar,
+                ControlLimit.x_bar,
+                ControlLimit.r_bar,
+                ControlLimit.s_bar,
+                ControlLimit.baseline_points,
+                ControlLimit.frozen_at,
+            )
+            .where(ControlLimit.unfrozen_at.is_(None))
+            .order_by(ControlLimit.phase)
+        ):
+            if row.series == "p":
+                key = ("p", row.binding_id)
+            else:
+                key = ("s", row.chart_id, row.subgroup_size)
+            phases[key] = FrozenLimits(*row[4:])
+    return phases
+
+
+def frozen_limits(key):
+    return frozen_cache.get(key, _load)
+
+
+def _changed(key):
+    frozen_cache.invalidate()
+    chart_scheduler.notify(key)
+
+
+def _freeze(key, binding_id, values):
+    # Новая фаза закрывает действующую; номера фаз ряда растут
+    with session_scope() as session:
+        session.execute(
+            update(ControlLimit)
+            .where(*_where(key), ControlLimit.unfrozen_at.is_(None))
+            .values(unfrozen_at=datetime.datetime.utcnow())
+        )
+        phase = session.execute(
+            select(func.max(ControlLimit.phase)).where(*_where(key))
+        ).scalar()
+        session.add(
+            ControlLimit(
+                series=key[0],
+                binding_id=binding_id,
+                chart_id=key[1] if key[0] == "s" else None,
+                subgroup_size=key[2] if key[0] == "s" else None,
+                phase=(phase or 0) + 1,
+                **values,
+            )
+        )
+    _changed(key)
+    return frozen_limits(key)
+
+
+def freeze_p_limits(binding_id):
+    # Базовая фаза - текущее окно связки; пустое окно не замораживаем
+    measurements = cache.recent_measurements(binding_id)
+    if not len(measurements):
+        return None
+    limits = p_chart_limits(measurements["proportion"], measurements["sample_size"])
+    return _freeze(
+        ("p", binding_id),
+        binding_id,
+        dict(
+            p_bar=float(limits.center),
+            baseline_points=len(measurements),
+            baseline_start_id=int(measurements["id"][0]),
+            baseline_end_id=int(measurements["id"][-1]),
+        ),
+    )
+
+
+def freeze_subgroup_limits(binding_id, chart_id, subgroup_size):
+    stats = cache.recent_subgroup_stats([chart_id], subgroup_size)[chart_id]
+    if not len(stats):
+        return None
+    return _freeze(
+        ("s", chart_id, subgroup_size),
+        binding_id,
+        dict(
+            x_bar=float(np.mean(stats["mean"])),
+            r_bar=float(np.mean(stats["range"])),
+            s_bar=float(np.mean(stats["stddev"])),
+            baseline_points=len(stats),
+            baseline_start_id=int(stats["id"][0]),
+            baseline_end_id=int(stats["id"][-1]),
+        ),
+    )
+
+
+def unfreeze(key):
+    with session_scope() as session:
+        session.execute(
+            update(ControlLimit)
+            .where(*_where(key), ControlLimit.unfrozen_at.is_(None))
+            .values(unfrozen_at=datetime.datetime.utcnow())
+        )
+    _changed(key)
+
+
+def binding_keys(binding_id, chart_ids, subgroup_size):
+    return [("p", binding_id)] + [
+        ("s", chart_id, subgroup_size) for chart_id in chart_ids
+    ]
+
+
+def freeze_binding(binding_id, chart_ids, subgroup_size):
+    # p-карта и X/R/S всех чартов связки при выбранном размере подгруппы
+    freeze_p_limits(binding_id)
+    for chart_id in chart_ids:
+        freeze_subgroup_limits(binding_id, chart_id, subgroup_size)
+
+
+def unfreeze_binding(binding_id, chart_ids, subgroup_size):
+    for key in binding_keys(binding_id, chart_ids, subgroup_size):
+        unfreeze(key)
@@ -0,0 +1,212 @@
+import contextvars
+import functools
+from contextlib import contextmanager
+import inspect
+import threading
+import time
+
+from dash.exceptions import PreventUpdate
+from sqlalchemy import event
+
+import shewhart_app.components.content as content
+
+CALLBACK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+# Счетчики пула из session.pool_status(); остальные его поля - текущие значения
+POOL_COUNTERS = ("connects", "checkouts", "checkins", "invalidations")
+
+# Метки текущего колбэка: по ним запросы к БД относятся к своему колбэку.
+# Запросы вне колбэков (фоновая запись, миграции) идут с метками "none"
+_labels = contextvars.ContextVar("metrics_labels", default=("none", "none"))
+_lock = threading.Lock()
+_bindings = set()
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+                )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, labels, value):
+        with _lock:
+            # [счетчики по корзинам..., сумма, количество]
+            state = self.values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        names = self.label_names + ("le",)
+        with _lock:
+            for labels, state in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, state):
+                    lines.append(
+                        f"{self.name}_bucket"
+                        f"{_format_labels(names, labels + (repr(float(bound)),))} "
+                        f"{count}"
+                    )
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(names, labels + ('+Inf',))} "
+                    f"{state[-1]}"
+                )
+                label_text = _format_labels(self.label_names, labels)
+                lines.append(f"{self.name}_sum{label_text} {state[-2]}")
+                lines.append(f"{self.name}_count{label_text} {state[-1]}")
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+callback_seconds = Histogram(
+    "shewhart_callback_seconds",
+    "Dash callback latency",
+    ("callback", "binding"),
+    CALLBACK_BUCKETS,
+)
+callback_total = Counter(
+    "shewhart_callback_total",
+    "Dash callback calls by outcome (ok, skipped, error)",
+    ("callback", "binding", "outcome"),
+)
+query_seconds = Histogram(
+    "shewhart_db_query_seconds",
+    "SQL statement latency",
+    ("callback", "binding"),
+    QUERY_BUCKETS,
+)
+query_rows = Counter(
+    "shewhart_db_rows_total",
+    "Rows reported by the driver for SQL statements",
+    ("callback", "binding"),
+)
+METRICS = [callback_seconds, callback_total, query_seconds, query_rows]
+
+
+def binding_label(binding_id):
+    # Число разных связок в метках ограничено, остальные сливаются в "other"
+    label = str(binding_id)
+    with _lock:
+        if label in _bindings:
+            return label
+        if len(_bindings) < content.METRICS_MAX_BINDINGS:
+            _bindings.add(label)
+            return label
+    return "other"
+
+
+def timed_callback(function):
+    # Ставится под @callback; связка берется из аргумента bid, если он есть
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+        binding = "none"
+        if arguments.get("bid") is not None:
+            binding = binding_label(arguments["bid"])
+        labels = (function.__name__, binding)
+        token = _labels.set(labels)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = function(*args, **kwargs)
+            outcome = "ok"
+            return result
+        except PreventUpdate:
+            outcome = "skipped"
+            raise
+        finally:
+            _labels.reset(token)
+            callback_seconds.observe(labels, time.perf_counter() - started)
+            callback_total.inc(labels + (outcome,))
+
+    return wrapper
+
+
+@contextmanager
+def background(name):
+    # Метки для фоновой работы вне колбэков, например пачек отложенной записи
+    token = _labels.set((name, "none"))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_started"].pop()
+    labels = _labels.get()
+    query_seconds.observe(labels, time.perf_counter() - started)
+    # Для SELECT число строк известно не всем драйверам (psycopg2 - да)
+    if cursor.rowcount > 0:
+        query_rows.inc(labels, cursor.rowcount)
+
+
+def _handle_error(context):
+    started = context.connection and context.connection.info.get("metrics_started")
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def render(pool_status):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, value in sorted(pool_status.items()):
+        if name in POOL_COUNTERS:
+            metric_name = f"shewhart_db_pool_{name}_total"
+            lines.append(f"# TYPE {metric_name} counter")
+        else:
+            metric_name = f"shewhart_db_pool_{name}"
+            lines.append(f"# TYPE {metric_name} gauge")
+        lines.append(f"{metric_name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    select,
+)
+from sqlalchemy.schema import CreateIndex
+
+from shewhart_app.components.service import models
+
+# Применённые миграции; схема меняется только через MIGRATIONS ниже,
+# каждый шаг идемпотентен, чтобы его можно было безопасно повторить
+_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+
+def _create_tables(engine, *tables):
+    # Существующие таблицы пропускаются вместе с их индексами
+    models.Base.metadata.create_all(
+        engine, tables=[table.__table__ for table in tables]
+    )
+
+
+def _create_indexes(engine, *indexes):
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as connection:
+            for index in indexes:
+                index.create(connection, checkfirst=True)
+        return
+    # На Postgres строим CONCURRENTLY, чтобы не блокировать запись в большие
+    # таблицы; такой DDL не может выполняться внутри транзакции
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for index in indexes:
+            ddl = str(
+                CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect)
+            )
+            connection.exec_driver_sql(
+                ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+            )
+
+
+def _add_column(engine, model, name):
+    # Новая колонка без значения по умолчанию: на Postgres это правка только
+    # каталога, без переписывания таблицы
+    table = model.__table__
+    if name in {column["name"] for column in inspect(engine).get_columns(table.name)}:
+        return
+    column_type = table.c[name].type.compile(dialect=engine.dialect)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"
+        )
+
+
+def _index(model, name):
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def _initial_schema(engine):
+    _create_tables(
+        engine,
+        models.Binding,
+        models.Chart,
+        models.Measurement,
+        models.IndividualMeasurement,
+    )
+
+
+def _read_path_indexes(engine):
+    _create_indexes(
+        engine,
+        _index(models.Measurement, "ix_results_binding_id_id"),
+        _index(models.Measurement, "ix_results_measurement_time"),
+        _index(
+            models.IndividualMeasurement,
+            "ix_individual_measurements_binding_id_chart_id_id",
+        ),
+    )
+
+
+def _subgroup_statistics(engine):
+    from shewhart_app.components.service.subgroups import rebuild_subgroup_stats
+
+    _create_tables(engine, models.SubgroupStatistic)
+    # Заполняем по уже накопленной истории, дальше таблица ведется при вставках
+    rebuild_subgroup_stats(bind=engine)
+
+
+def _backtest_hits(engine):
+    _create_tables(engine, models.BacktestHit)
+
+
+def _control_limits(engine):
+    _create_tables(engine, models.ControlLimit)
+
+
+def _measurement_times(engine):
+    # Старые значения чартов остаются без времени и в выборки за период
+    # не попадают
+    _add_column(engine, models.IndividualMeasurement, "measurement_time")
+    _create_indexes(
+        engine,
+        _index(models.Measurement, "ix_results_binding_id_measurement_time"),
+        _index(
+            models.IndividualMeasurement,
+            "ix_individual_measurements_chart_id_measurement_time",
+        ),
+    )
+
+
+def _rollups(engine):
+    _create_tables(engine, models.MeasurementRollup, models.IndividualRollup)
+
+
+def _covering_indexes(engine):
+    indexes = [_index(models.SubgroupStatistic, "ix_subgroup_statistics_covering")]
+    if engine.dialect.name == "sqlite":
+        # На Postgres окно измерений покрывает INCLUDE индекса из шага 2
+        indexes.append(_index(models.Measurement, "ix_results_binding_id_id_covering"))
+    _create_indexes(engine, *indexes)
+
+
+MIGRATIONS = [
+    (1, "initial schema", _initial_schema),
+    (2, "indexes for refresh queries", _read_path_indexes),
+    (3, "subgroup statistics", _subgroup_statistics),
+    (4, "backtest hits", _backtest_hits),
+    (5, "frozen control limits", _control_limits),
+    (6, "measurement times for time ranges", _measurement_times),
+    (7, "retention rollups", _rollups),
+    (8, "covering indexes for refresh queries", _covering_indexes),
+]
+
+
+def current_version(engine):
+    _metadata.create_all(engine)
+    with engine.connect() as connection:
+        return (
+            connection.execute(select(func.max(schema_version.c.version))).scalar() or 0
+        )
+
+
+def upgrade(engine):
+    applied = []
+    version = current_version(engine)
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        step(engine)
+        with engine.begin() as connection:
+            connection.execute(
+                schema_version.insert().values(
+                    version=step_version, description=description
+                )
+            )
+        applied.append((step_version, description))
+    return applied
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, DateTime, Float, String, ForeignKey
+from sqlalchemy import Column, Integer, DateTime, Float, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import datetime
@@ -15,16 +15,194 @@ class Measurement(Base):
     binding_id = Column(Integer, ForeignKey("bindings.id"))
     binding = relationship("Binding", back_populates="measurements")
 
+    # Чтение окна по связке - обратный проход по (binding_id, id); INCLUDE
+    # позволяет Postgres отвечать только из индекса. В SQLite INCLUDE нет,
+    # там те же колонки идут в ключ отдельного индекса
+    __table_args__ = (
+        Index(
+            "ix_results_binding_id_id",
+            "binding_id",
+            "id",
+            postgresql_include=["proportion", "sample_size"],
+        ),
+        Index(
+            "ix_results_binding_id_id_covering",
+            "binding_id",
+            "id",
+            "proportion",
+            "sample_size",
+        ).ddl_if(dialect="sqlite"),
+        Index("ix_results_measurement_time", "measurement_time"),
+        # Выборка связки за период на страницах с выбором диапазона
+        Index(
+            "ix_results_binding_id_measurement_time", "binding_id", "measurement_time"
+        ),
+    )
+
 
 class IndividualMeasurement(Base):
     __tablename__ = "individual_measurements"
     id = Column(Integer, primary_key=True)
     value = Column(Float, nullable=False)
+    measurement_time = Column(DateTime, default=datetime.datetime.utcnow)
     binding_id = Column(Integer, ForeignKey("bindings.id"))
     binding = relationship("Binding", back_populates="i_measurements")
     chart_id = Column(Integer, ForeignKey("charts.id"))
     chart = relationship("Chart", back_populates="measurements")
 
+    __table_args__ = (
+        Index(
+            "ix_individual_measurements_binding_id_chart_id_id",
+            "binding_id",
+            "chart_id",
+            "id",
+            postgresql_include=["value"],
+        ),
+        # Значения чарта за период (чарт принадлежит одной связке)
+        Index(
+            "ix_individual_measurements_chart_id_measurement_time",
+            "chart_id",
+            "measurement_time",
+        ),
+    )
+
+
+class SubgroupStatistic(Base):
+    # Статистики заполненных подгрупп; подгруппа subgroup_index чарта -
+    # его измерения с номерами [index * size, (index + 1) * size) по порядку id
+    __tablename__ = "subgroup_statistics"
+    chart_id = Column(Integer, ForeignKey("charts.id"), primary_key=True)
+    subgroup_size = Column(Integer, primary_key=True)
+    subgroup_index = Column(Integer, primary_key=True)
+    last_measurement_id = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    range = Column(Float, nullable=False)
+    stddev = Column(Float, nullable=False)
+
+    # Окно последних подгрупп читается только из индекса, без обращения
+    # к строкам таблицы
+    __table_args__ = (
+        Index(
+            "ix_subgroup_statistics_covering",
+            "chart_id",
+            "subgroup_size",
+            "subgroup_index",
+            "last_measurement_id",
+            "mean",
+            "range",
+            "stddev",
+        ),
+    )
+
+
+class BacktestHit(Base):
+    # Срабатывания правил по всей истории ряда (manage.py backtest);
+    # series - "p" (измерения связки) или "x" (значения чарта), start/end -
+    # номера точек от начала истории, *_measurement_id - их id
+    __tablename__ = "backtest_hits"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    series = Column(String, nullable=False)
+    binding_id = Column(Integer, ForeignKey("bindings.id"), nullable=False)
+    chart_id = Column(Integer, ForeignKey("charts.id"))
+    rule = Column(String, nullable=False)
+    direction = Column(String, nullable=False)
+    start_index = Column(Integer, nullable=False)
+    end_index = Column(Integer, nullable=False)
+    start_measurement_id = Column(Integer, nullable=False)
+    end_measurement_id = Column(Integer, nullable=False)
+    center = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index(
+            "ix_backtest_hits_binding_id_chart_id",
+            "binding_id",
+            "chart_id",
+            "start_index",
+        ),
+    )
+
+
+class MeasurementRollup(Base):
+    # Свертки измерений p-карты старше срока хранения (manage.py retention):
+    # суммы по корзине [bucket_start, bucket_start + bucket_seconds). У одной
+    # корзины бывает несколько строк - при чтении их суммы складываются
+    __tablename__ = "results_rollups"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    binding_id = Column(Integer, ForeignKey("bindings.id"), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    bucket_seconds = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    sample_size = Column(Integer, nullable=False)
+    # Суммы p * n и p * p * n
+    weighted_proportion = Column(Float, nullable=False)
+    weighted_squares = Column(Float, nullable=False)
+    min_proportion = Column(Float, nullable=False)
+    max_proportion = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "ix_results_rollups_binding_id_bucket_start", "binding_id", "bucket_start"
+        ),
+    )
+
+
+class IndividualRollup(Base):
+    # То же для значений чартов: число значений, их сумма и сумма квадратов
+    __tablename__ = "individual_measurement_rollups"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    binding_id = Column(Integer, ForeignKey("bindings.id"), nullable=False)
+    chart_id = Column(Integer, ForeignKey("charts.id"), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    bucket_seconds = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    squares = Column(Float, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index(
+            "ix_individual_measurement_rollups_chart_id_bucket_start",
+            "chart_id",
+            "bucket_start",
+        ),
+    )
+
+
+class ControlLimit(Base):
+    # Замороженные границы фазы: series "p" - p_bar связки (chart_id пуст),
+    # "s" - X̄-bar, R-bar и S-bar чарта при subgroup_size. Действует
+    # последняя фаза ряда с пустым unfrozen_at; baseline_* - первый и
+    # последний id (измерения или индекса подгруппы) базового окна
+    __tablename__ = "control_limits"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    series = Column(String, nullable=False)
+    binding_id = Column(Integer, ForeignKey("bindings.id"), nullable=False)
+    chart_id = Column(Integer, ForeignKey("charts.id"))
+    subgroup_size = Column(Integer)
+    phase = Column(Integer, nullable=False)
+    p_bar = Column(Float)
+    x_bar = Column(Float)
+    r_bar = Column(Float)
+    s_bar = Column(Float)
+    baseline_points = Column(Integer, nullable=False)
+    baseline_start_id = Column(Integer)
+    baseline_end_id = Column(Integer)
+    frozen_at = Column(DateTime, default=datetime.datetime.utcnow)
+    unfrozen_at = Column(DateTime)
+
+    __table_args__ = (
+        Index(
+            "ix_control_limits_series",
+            "series",
+            "binding_id",
+            "chart_id",
+            "subgroup_size",
+            "phase",
+        ),
+    )
+
 
 class Chart(Base):
     __tablename__ = "charts"
@@ -0,0 +1,207 @@
+import numpy as np
+from sqlalchemy import select, text, union_all
+
+from shewhart_app.components.service.constants import SUBGROUP_SIZES
+from shewhart_app.components.service.models import Measurement, SubgroupStatistic
+
+MEASUREMENT_DTYPE = np.dtype(
+    [("id", np.int64), ("proportion", float), ("sample_size", np.int64)]
+)
+# id - индекс подгруппы, по нему буфер отбрасывает уже известные строки
+SUBGROUP_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("last_measurement_id", np.int64),
+        ("mean", float),
+        ("range", float),
+        ("stddev", float),
+    ]
+)
+CHART_SUBGROUP_DTYPE = np.dtype([("chart_id", np.int64)] + SUBGROUP_DTYPE.descr)
+VALUE_DTYPE = np.dtype([("id", np.int64), ("value", float)])
+FETCH_CHUNK_SIZE = 10000
+
+
+def _execute(session, statement, stream):
+    # Core-запрос на соединении сессии: без ORM-контекста и identity map
+    if stream:
+        statement = statement.execution_options(stream_results=True)
+    result = session.connection().execute(statement)
+    # При stream_results SQLAlchemy заранее читает первую строку в свой
+    # буфер - ее забираем через Result, остальные прямо из курсора DBAPI
+    return result, [tuple(row) for row in result.fetchmany(1)]
+
+
+def _fill(result, array, rows):
+    # Кортежи курсора numpy раскладывает по полям структурного массива сам,
+    # без Row-объектов и промежуточных списков значений
+    count = 0
+    while count < len(array):
+        if not rows:
+            rows = result.cursor.fetchmany(min(len(array) - count, FETCH_CHUNK_SIZE))
+            if not rows:
+                break
+        array[count : count + len(rows)] = rows
+        count += len(rows)
+        rows = None
+    return count
+
+
+def iter_arrays(session, statement, dtype, chunk_size, stream=True):
+    # Результат запроса кусками по chunk_size строк; колонки по порядку -
+    # поля dtype. stream - серверный курсор, память на один кусок
+    result, rows = _execute(session, statement, stream)
+    try:
+        while rows:
+            array = np.empty(chunk_size, dtype=dtype)
+            count = _fill(result, array, rows)
+            yield array[:count]
+            if count < chunk_size:
+                return
+            rows = result.cursor.fetchmany(min(chunk_size, FETCH_CHUNK_SIZE))
+    finally:
+        result.close()
+
+
+def fetch_array(session, statement, dtype, size=None):
+    # size - верхняя граница числа строк (LIMIT запроса): массив выделяется
+    # один раз; без нее строки читаются кусками и склеиваются
+    if size is None:
+        chunks = list(
+            iter_arrays(session, statement, dtype, FETCH_CHUNK_SIZE, stream=False)
+        )
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+    result, rows = _execute(session, statement, stream=False)
+    try:
+        array = np.empty(size, dtype=dtype)
+        return array[: _fill(result, array, rows) if rows else 0]
+    finally:
+        result.close()
+
+
+def recent_measurements_statement(binding_id, limit):
+    return (
+        select(Measurement.id, Measurement.proportion, Measurement.sample_size)
+        .where(Measurement.binding_id == binding_id)
+        .order_by(Measurement.id.desc())
+        .limit(limit)
+    )
+
+
+def recent_subgroup_stats_statement(chart_ids, subgroup_size, limit):
+    # По ветке UNION ALL на чарт: каждая ветка - обратный проход по первичному
+    # ключу (chart_id, subgroup_size, subgroup_index) с LIMIT
+    branches = [
+        select(
+            SubgroupStatistic.chart_id,
+            SubgroupStatistic.subgroup_index,
+            SubgroupStatistic.last_measurement_id,
+            SubgroupStatistic.mean,
+            SubgroupStatistic.range,
+            SubgroupStatistic.stddev,
+        )
+        .where(
+            SubgroupStatistic.chart_id == chart_id,
+            SubgroupStatistic.subgroup_size == subgroup_size,
+        )
+        .order_by(SubgroupStatistic.subgroup_index.desc())
+        .limit(limit)
+        .subquery()
+        for chart_id in chart_ids
+    ]
+    return union_all(*[select(branch) for branch in branches])
+
+
+def recent_measurements(session, binding_id, limit):
+    # Массив MEASUREMENT_DTYPE последних limit измерений, по возрастанию id
+    rows = fetch_array(
+        session,
+        recent_measurements_statement(binding_id, limit),
+        MEASUREMENT_DTYPE,
+        limit,
+    )
+    return rows[::-1].copy()
+
+
+def recent_subgroup_stats(session, chart_ids, subgroup_size, limit):
+    # Последние limit подгрупп каждого чарта одним запросом, по возрастанию
+    # индекса: {chart_id: массив SUBGROUP_DTYPE}
+    if not chart_ids:
+        return {}
+    rows = fetch_array(
+        session,
+        recent_subgroup_stats_statement(chart_ids, subgroup_size, limit),
+        CHART_SUBGROUP_DTYPE,
+        limit * len(chart_ids),
+    )
+    rows = rows[np.lexsort((rows["id"], rows["chart_id"]))]
+    fields = list(SUBGROUP_DTYPE.names)
+    return {
+        chart_id: rows[rows["chart_id"] == chart_id][fields].astype(SUBGROUP_DTYPE)
+        for chart_id in chart_ids
+    }
+
+
+def refresh_statements(binding_id, chart_ids, limit):
+    return {
+        "recent measurements": recent_measurements_statement(binding_id, limit),
+        "recent subgroup statistics": recent_subgroup_stats_statement(
+            chart_ids, SUBGROUP_SIZES[0], limit
+        ),
+    }
+
+
+def explain(session, statement):
+    dialect = session.get_bind().dialect
+    sql = str(
+        statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    )
+    if dialect.name == "sqlite":
+        rows = session.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+        return [row[-1] for row in rows]
+    return [row[0] for row in session.execute(text("EXPLAIN " + sql)).all()]
+
+
+def plan_verdict(dialect_name, plan):
+    # Самый слабый доступ к таблице в плане: "index-only" - читается только
+    # индекс, "index" - индекс + строки таблицы, "scan" - полный проход или
+    # сортировка, т.е. индекс не используется
+    plan_text = "\n".join(plan)
+    if dialect_name == "sqlite":
+        # SCAN anon_N - проход по результату подзапроса, а не по таблице;
+        # SCAN таблицы, даже по индексу, - проход целиком, а не по диапазону
+        accesses = [
+            line
+            for line in plan
+            if line.startswith(("SCAN ", "SEARCH "))
+            and not line.split()[1].startswith("anon_")
+        ]
+        if "TEMP B-TREE" in plan_text or not accesses:
+            return "scan"
+        if any(line.startswith("SCAN ") for line in accesses):
+            return "scan"
+        # USING INDEX без COVERING - за строками идем в таблицу; поиск по
+        # PRIMARY KEY читает саму таблицу, ее ключ и есть индекс
+        if any("USING INDEX" in line for line in accesses):
+            return "index"
+        return "index-only"
+    if "Seq Scan" in plan_text or "Sort" in plan_text:
+        return "scan"
+    if "Index Scan" in plan_text or "Bitmap" in plan_text:
+        return "index"
+    return "index-only" if "Index Only Scan" in plan_text else "scan"
+
+
+def check_refresh_plans(session, binding_id=1, chart_ids=(1, 2), limit=100):
+    # Поиск порогов хранения - тот же обратный проход по индексу ряда, по
+    # разу на ряд за прогон retention
+    from shewhart_app.components.service.retention import threshold_statements
+
+    dialect_name = session.get_bind().dialect.name
+    statements = refresh_statements(binding_id, list(chart_ids), limit)
+    statements.update(threshold_statements(binding_id, chart_ids[0]))
+    report = []
+    for name, statement in statements.items():
+        plan = explain(session, statement)
+        report.append((name, plan_verdict(dialect_name, plan), plan))
+    return report
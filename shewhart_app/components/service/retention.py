@@ -0,0 +1,462 @@
+import csv
+import datetime
+import os
+from collections import namedtuple
+
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    delete,
+    func,
+    insert,
+    literal,
+    literal_column,
+    not_,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.schema import AddConstraint
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import metrics, timeline
+from shewhart_app.components.service.models import (
+    Binding,
+    Chart,
+    IndividualMeasurement,
+    IndividualRollup,
+    Measurement,
+    MeasurementRollup,
+)
+from shewhart_app.components.service.queries import FETCH_CHUNK_SIZE
+from shewhart_app.components.service.session import engine, session_scope
+
+# Итог прогона по таблице: rows - удаленные сырые строки, rollup_rows -
+# добавленные строки сверток, partitions - отсоединенные и удаленные
+# партиции, reclaimed_bytes - место под удаленными строками (None, если
+# база не умеет его посчитать)
+RetentionReport = namedtuple(
+    "RetentionReport",
+    ["table", "rows", "rollup_rows", "partitions", "reclaimed_bytes"],
+)
+
+# Таблица под хранением: модель, модель сверток, колонки ключа ряда (как в
+# keys), источник корзин из timeline, поля свертки в порядке его сумм,
+# запрос ключей всех рядов и колонки архива (совместимые с manage.py ingest)
+_Retained = namedtuple(
+    "_Retained",
+    ["model", "rollup", "series", "source", "fields", "keys", "archive_columns"],
+)
+
+RETAINED = [
+    _Retained(
+        Measurement,
+        MeasurementRollup,
+        ["binding_id"],
+        timeline.measurement_sources(([], []))[0],
+        [
+            "weighted_proportion",
+            "weighted_squares",
+            "sample_size",
+            "min_proportion",
+            "max_proportion",
+        ],
+        select(Binding.id),
+        ["binding_id", "proportion", "sample_size", "measurement_time"],
+    ),
+    _Retained(
+        IndividualMeasurement,
+        IndividualRollup,
+        ["binding_id", "chart_id"],
+        timeline.individual_sources(([], []))[0],
+        ["total", "squares", "count", "min_value", "max_value"],
+        select(Chart.binding_id, Chart.id),
+        ["binding_id", "chart_id", "value", "measurement_time"],
+    ),
+]
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month):
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def _partition_name(table, month):
+    return f"{table}_p{month.year}_{month.month:02d}"
+
+
+def _series_columns(retained):
+    return [getattr(retained.model, name) for name in retained.series]
+
+
+def threshold_statement(retained, key):
+    # id HISTORY_POINTS-й с конца строки ряда key - обратный проход по
+    # индексу ряда, без чтения остальной истории
+    model = retained.model
+    return (
+        select(model.id)
+        .where(
+            *[column == value for column, value in zip(_series_columns(retained), key)]
+        )
+        .order_by(model.id.desc())
+        .offset(content.HISTORY_POINTS - 1)
+        .limit(1)
+    )
+
+
+def threshold_statements(binding_id, chart_id):
+    # Для manage.py check-plans: поиск порога одного ряда каждой таблицы
+    keys = [(binding_id,), (binding_id, chart_id)]
+    return {
+        f"retention threshold ({retained.model.__tablename__})": threshold_statement(
+            retained, key
+        )
+        for retained, key in zip(RETAINED, keys)
+    }
+
+
+def _thresholds_table(retained):
+    # Пороги рядов на время прогона; NULL - ряд короче HISTORY_POINTS
+    name = f"{retained.model.__tablename__}_retention_thresholds"
+    columns = [Column(column, Integer) for column in retained.series]
+    return Table(
+        name,
+        MetaData(),
+        *columns,
+        Column("threshold_id", Integer),
+        Index(f"{name}_series", *columns),
+        prefixes=["TEMPORARY"],
+    )
+
+
+def _fill_thresholds(connection, retained, thresholds):
+    # Один раз за прогон: по запросу с поиском по индексу на каждый ряд
+    keys = retained.keys.subquery("keys")
+    threshold = threshold_statement(retained, list(keys.c)).scalar_subquery()
+    thresholds.create(connection)
+    connection.execute(
+        insert(thresholds).from_select(
+            [*retained.series, "threshold_id"], select(*keys.c, threshold)
+        )
+    )
+
+
+def _protected(retained, thresholds):
+    # Последние HISTORY_POINTS строк каждого ряда остаются: на них держатся
+    # окна страниц и кэш рядов, даже если ряд давно не пополнялся
+    model = retained.model
+    return (
+        select(literal(1))
+        .where(
+            *[thresholds.c[name] == getattr(model, name) for name in retained.series],
+            or_(
+                thresholds.c.threshold_id.is_(None),
+                model.id >= thresholds.c.threshold_id,
+            ),
+        )
+        .exists()
+    )
+
+
+def _rollup(session, retained, where, width):
+    # Корзины считает база, по ряду и номеру корзины; возвращает число
+    # свернутых сырых строк и добавленных строк сверток
+    series = _series_columns(retained)
+    bucket = timeline.bucket_expression(
+        session.get_bind().dialect.name, retained.source.column, width
+    )
+    rows = []
+    for row in session.execute(
+        select(*series, bucket, *retained.source.bucket_columns, func.count())
+        .where(*where)
+        .group_by(*series, bucket)
+    ):
+        values = dict(zip(retained.series, row))
+        values.update(zip(retained.fields, row[len(series) + 1 : -1]))
+        values["count"] = row[-1]
+        values["bucket_start"] = _EPOCH + datetime.timedelta(
+            seconds=int(row[len(series)]) * width
+        )
+        values["bucket_seconds"] = width
+        rows.append(values)
+    if rows:
+        session.execute(insert(retained.rollup), rows)
+    return sum(row["count"] for row in rows), len(rows)
+
+
+def _archive(session, retained, where, writer):
+    columns = [getattr(retained.model, name) for name in retained.archive_columns]
+    result = session.execute(
+        select(*columns)
+        .where(*where)
+        .order_by(retained.model.id)
+        .execution_options(yield_per=FETCH_CHUNK_SIZE)
+    )
+    for rows in result.partitions():
+        writer.writerows(rows)
+
+
+def _sqlite_free_bytes(session):
+    connection = session.connection()
+    pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    return pages * connection.exec_driver_sql("PRAGMA page_size").scalar()
+
+
+def _delete_rows(session, retained, where):
+    # Размер удаляемых строк: на Postgres - сумма размеров кортежей (место
+    # вернется после VACUUM), на SQLite - прирост свободных страниц файла
+    dialect_name = session.get_bind().dialect.name
+    reclaimed = None
+    if dialect_name == "postgresql":
+        reclaimed = session.execute(
+            select(
+                func.sum(
+                    func.pg_column_size(literal_column(retained.model.__tablename__))
+                )
+            ).where(*where)
+        ).scalar()
+    elif dialect_name == "sqlite":
+        free_before = _sqlite_free_bytes(session)
+    rows = session.execute(delete(retained.model).where(*where)).rowcount
+    if dialect_name == "sqlite":
+        reclaimed = _sqlite_free_bytes(session) - free_before
+    return rows, reclaimed and int(reclaimed)
+
+
+def _partitioned(connection, table):
+    if engine.dialect.name != "postgresql":
+        return False
+    return (
+        connection.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = to_regclass(:name)"
+            ),
+            {"name": table},
+        ).first()
+        is not None
+    )
+
+
+def _partition_exists(session, name):
+    return (
+        session.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+        is not None
+    )
+
+
+def _create_partition(connection, table, month):
+    connection.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {_partition_name(table, month)} "
+            f"PARTITION OF {table} FOR VALUES FROM ('{month.isoformat()}') "
+            f"TO ('{_next_month(month).isoformat()}')"
+        )
+    )
+
+
+def _drop_partition(session, table, month):
+    name = _partition_name(table, month)
+    size = session.execute(
+        text("SELECT pg_total_relation_size(to_regclass(:name))"), {"name": name}
+    ).scalar()
+    session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+    session.execute(text(f"DROP TABLE {name}"))
+    return size
+
+
+def _retain_month(connection, retained, protected, month, lower, upper, archive, width):
+    # Один месяц - одна транзакция: свертка, архив и удаление либо видны
+    # вместе, либо не видны совсем
+    table = retained.model.__tablename__
+    column = retained.source.column
+    in_range = [column < upper] if lower is None else [column >= lower, column < upper]
+    with session_scope(connection) as session:
+        drop = (
+            lower is not None
+            and _partitioned(session, table)
+            and _partition_exists(session, _partition_name(table, month))
+            and upper == _next_month(month)
+            and session.execute(
+                select(literal(1)).where(*in_range, protected).limit(1)
+            ).first()
+            is None
+        )
+        where = in_range if drop else in_range + [not_(protected)]
+        rows, rollup_rows = _rollup(session, retained, where, width)
+        if not rows and not drop:
+            return RetentionReport(table, 0, 0, 0, 0)
+        if archive is not None:
+            _archive(session, retained, where, archive)
+        # Целиком старая партиция без защищенных строк отсоединяется и
+        # удаляется без построчного DELETE
+        if drop:
+            return RetentionReport(
+                table, rows, rollup_rows, 1, _drop_partition(session, table, month)
+            )
+        deleted, reclaimed = _delete_rows(session, retained, where)
+        return RetentionReport(table, deleted, rollup_rows, 0, reclaimed)
+
+
+def _ensure_partitions(retained, now):
+    # Партиции на текущий и следующие месяцы, чтобы новые строки не
+    # копились в партиции по умолчанию
+    table = retained.model.__tablename__
+    with session_scope() as session:
+        if not _partitioned(session, table):
+            return
+        month = _month_start(now)
+        for _ in range(content.RETENTION_PARTITIONS_AHEAD + 1):
+            _create_partition(session, table, month)
+            month = _next_month(month)
+
+
+def _retain_table(retained, cutoff, archive, width):
+    # Все месяцы идут через одно соединение: на нем живет временная таблица
+    # порогов, посчитанная один раз за прогон
+    column = retained.source.column
+    thresholds = _thresholds_table(retained)
+    protected = _protected(retained, thresholds)
+    total = RetentionReport(retained.model.__tablename__, 0, 0, 0, 0)
+    with engine.connect() as connection:
+        with connection.begin():
+            _fill_thresholds(connection, retained, thresholds)
+            # Время первой по id строки - только отправная точка: первый
+            # месяц забирает и все строки раньше него
+            first = connection.execute(
+                select(column)
+                .where(column.is_not(None))
+                .order_by(retained.model.id)
+                .limit(1)
+            ).scalar()
+        try:
+            if first is None:
+                return total
+            month, lower = _month_start(min(first, cutoff)), None
+            while lower is None or lower < cutoff:
+                upper = min(_next_month(month), cutoff)
+                report = _retain_month(
+                    connection, retained, protected, month, lower, upper, archive, width
+                )
+                reclaimed = total.reclaimed_bytes
+                if reclaimed is not None:
+                    reclaimed = (
+                        None
+                        if report.reclaimed_bytes is None
+                        else reclaimed + report.reclaimed_bytes
+                    )
+                total = RetentionReport(
+                    total.table,
+                    total.rows + report.rows,
+                    total.rollup_rows + report.rollup_rows,
+                    total.partitions + report.partitions,
+                    reclaimed,
+                )
+                month = lower = _next_month(month)
+            return total
+        finally:
+            with connection.begin():
+                thresholds.drop(connection)
+
+
+def run_retention(max_age_days=None, archive_dir=None, now=None):
+    # Сворачивает и удаляет сырые строки старше max_age_days дней; граница
+    # выравнивается по корзине, чтобы корзины не делились между прогонами.
+    # С archive_dir удаляемые строки сначала пишутся в CSV, который можно
+    # загрузить обратно через manage.py ingest
+    now = now or datetime.datetime.utcnow()
+    width = content.RETENTION_BUCKET_SECONDS
+    age = datetime.timedelta(days=max_age_days or content.RETENTION_MAX_AGE_DAYS)
+    seconds = (now - age - _EPOCH).total_seconds()
+    cutoff = _EPOCH + datetime.timedelta(seconds=seconds // width * width)
+
+    reports = []
+    with metrics.background("retention"):
+        for retained in RETAINED:
+            _ensure_partitions(retained, now)
+            if archive_dir is None:
+                reports.append(_retain_table(retained, cutoff, None, width))
+                continue
+            path = os.path.join(
+                archive_dir,
+                f"{retained.model.__tablename__}-{now:%Y%m%dT%H%M%S}.csv",
+            )
+            with open(path, "w", newline="") as stream:
+                writer = csv.writer(stream)
+                writer.writerow(retained.archive_columns)
+                reports.append(_retain_table(retained, cutoff, writer, width))
+    return reports
+
+
+def partition_tables(months_ahead=None):
+    # Разовый перевод results и individual_measurements (Postgres) в таблицы,
+    # секционированные по месяцам measurement_time. Таблица копируется под
+    # эксклюзивной блокировкой - запускать в окно обслуживания. Строки без
+    # времени попадают в партицию по умолчанию. Первичного ключа у
+    # секционированной таблицы нет (он должен был бы включать время), id
+    # по-прежнему выдает та же последовательность
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("Partitioning is only supported on PostgreSQL")
+    months_ahead = (
+        content.RETENTION_PARTITIONS_AHEAD if months_ahead is None else months_ahead
+    )
+    converted = []
+    for retained in RETAINED:
+        model = retained.model
+        table = model.__tablename__
+        with engine.begin() as connection:
+            if _partitioned(connection, table):
+                continue
+            old = f"{table}_unpartitioned"
+            connection.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+            first, last = connection.execute(
+                select(
+                    func.min(model.measurement_time), func.max(model.measurement_time)
+                )
+            ).one()
+            sequence = connection.execute(
+                text(f"SELECT pg_get_serial_sequence('{table}', 'id')")
+            ).scalar()
+            connection.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+            # Имена индексов общие на схему - освобождаем их для новой таблицы
+            for index in model.__table__.indexes:
+                connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            connection.execute(
+                text(
+                    f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) "
+                    f"PARTITION BY RANGE (measurement_time)"
+                )
+            )
+            connection.execute(
+                text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+            )
+            now = _month_start(datetime.datetime.utcnow())
+            month = _month_start(first or now)
+            end = max(_month_start(last or now), now)
+            for _ in range(months_ahead):
+                end = _next_month(end)
+            while month <= end:
+                _create_partition(connection, table, month)
+                month = _next_month(month)
+            connection.execute(text(f"INSERT INTO {table} SELECT * FROM {old}"))
+            if sequence:
+                connection.execute(
+                    text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+                )
+            connection.execute(text(f"DROP TABLE {old}"))
+            connection.execute(text(f"CREATE INDEX {table}_id ON {table} (id)"))
+            for index in model.__table__.indexes:
+                index.create(connection)
+            for constraint in model.__table__.foreign_key_constraints:
+                connection.execute(AddConstraint(constraint))
+            connection.execute(text(f"ANALYZE {table}"))
+        converted.append(table)
+    return converted
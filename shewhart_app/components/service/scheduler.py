@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import metrics
+
+
+class ChartScheduler:
+    # Опубликованные снимки карт по ключам кэша рядов (("p", binding_id),
+    # ("s", chart_id, subgroup_size)). Колбэки только читают снимок; фоновый
+    # поток раз в interval секунд (и сразу после notify) пересобирает снимки
+    # ключей, которые кто-то смотрел за последние idle_timeout секунд, так что
+    # работа растет с числом карт, а не открытых вкладок.
+
+    def __init__(self, interval, idle_timeout):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        # Сборщик снимка по первому элементу ключа: build(key, previous)
+        # возвращает previous, если ряд не изменился; evict(key) освобождает
+        # то, что сборщик держит для ключа вне снимка
+        self._builders = {}
+        self._evictors = {}
+        self._snapshots = {}
+        self._viewed = {}
+        self._dirty = set()
+        # Ключи, снимок которых собирается прямо сейчас
+        self._building = set()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def register(self, kind, build, evict=None):
+        self._builders[kind] = build
+        if evict is not None:
+            self._evictors[kind] = evict
+
+    def get(self, key):
+        self._ensure_started()
+        with self._lock:
+            self._viewed[key] = time.monotonic()
+            snapshot = self._snapshots.get(key)
+            fresh = (
+                snapshot is not None
+                and key not in self._dirty
+                and key not in self._building
+            )
+        if fresh:
+            return snapshot
+        # Первый зритель или новые данные: собираем сразу, остальные вкладки
+        # (и идущая фоновая сборка) отдадут результат через блокировку ключа
+        return self._refresh(key)
+
+    def notify(self, key):
+        with self._lock:
+            if key not in self._viewed:
+                return
+            self._dirty.add(key)
+        self._wakeup.set()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _refresh(self, key, force=False):
+        with self._key_lock(key):
+            with self._lock:
+                previous = self._snapshots.get(key)
+                if previous is not None and not force and key not in self._dirty:
+                    return previous
+                # notify во время сборки снова пометит ключ
+                self._dirty.discard(key)
+                self._building.add(key)
+            try:
+                snapshot = self._builders[key[0]](key, previous)
+            except Exception:
+                with self._lock:
+                    self._dirty.add(key)
+                raise
+            else:
+                with self._lock:
+                    self._snapshots[key] = snapshot
+                return snapshot
+            finally:
+                with self._lock:
+                    self._building.discard(key)
+
+    def _ensure_started(self):
+        with self._lock:
+            # Как у отложенной записи: после fork поток запускается заново,
+            # снимки родителя не используем
+            if self._thread is None or self._pid != os.getpid():
+                self._snapshots.clear()
+                self._viewed.clear()
+                self._dirty.clear()
+                self._building.clear()
+                self._key_locks.clear()
+                self._wakeup = threading.Event()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        wakeup = self._wakeup
+        deadline = time.monotonic() + self.interval
+        while True:
+            wakeup.wait(max(0, deadline - time.monotonic()))
+            wakeup.clear()
+            now = time.monotonic()
+            # По таймеру проверяем все ключи (данные могли прийти через другой
+            # процесс), по notify - только помеченные
+            scheduled = now >= deadline
+            if scheduled:
+                deadline = now + self.interval
+            evicted = []
+            with self._lock:
+                for key, viewed in list(self._viewed.items()):
+                    if now - viewed > self.idle_timeout:
+                        del self._viewed[key]
+                        self._snapshots.pop(key, None)
+                        self._dirty.discard(key)
+                        self._key_locks.pop(key, None)
+                        evicted.append(key)
+                keys = list(self._viewed) if scheduled else list(self._dirty)
+            for key in evicted:
+                evict = self._evictors.get(key[0])
+                if evict is not None:
+                    evict(key)
+            with metrics.background("chart_scheduler"):
+                for key in keys:
+                    try:
+                        self._refresh(key, force=scheduled)
+                    except Exception:
+                        # Ключ остается помеченным, ошибку увидит колбэк
+                        continue
+
+
+chart_scheduler = ChartScheduler(
+    content.CHART_REFRESH_INTERVAL, content.CHART_IDLE_TIMEOUT
+)
@@ -0,0 +1,143 @@
+from collections import namedtuple
+
+import numpy as np
+
+from shewhart_app.components.service.constants import (
+    A2_values,
+    B3_values,
+    B4_values,
+    D3_values,
+    D4_values,
+)
+from shewhart_app.components.service.detectors import detect_rules, detect_rules_batch
+
+SubgroupStats = namedtuple("SubgroupStats", ["means", "ranges", "stddevs"])
+# Плавающие границы p-карты: center - число, остальное - массивы на точку.
+# Для 2-D входа (ряды x точки) center - массив на ряд, остальное - 2-D
+PChartLimits = namedtuple(
+    "PChartLimits", ["center", "ucl", "upper2", "upper1", "lower1", "lower2", "lcl"]
+)
+ControlLimits = namedtuple("ControlLimits", ["center", "ucl", "lcl"])
+# Границы и попадания правил одной карты (или списки попаданий по рядам)
+ChartEvaluation = namedtuple("ChartEvaluation", ["limits", "hits"])
+
+
+def subgroup_matrix(values, subgroup_size):
+    # Неполная последняя подгруппа отбрасывается
+    values = np.asarray(values, dtype=float)
+    n_subgroups = len(values) // subgroup_size
+    return values[: n_subgroups * subgroup_size].reshape(n_subgroups, subgroup_size)
+
+
+def subgroup_stats(values, subgroup_size):
+    matrix = subgroup_matrix(values, subgroup_size)
+    return SubgroupStats(
+        means=matrix.mean(axis=1),
+        ranges=np.ptp(matrix, axis=1),
+        stddevs=matrix.std(axis=1, ddof=1),
+    )
+
+
+def pad_series(series):
+    # Ряды разной длины -> 2-D массив, хвосты коротких рядов - NaN
+    width = max((len(values) for values in series), default=0)
+    matrix = np.full((len(series), width), np.nan)
+    for row, values in enumerate(series):
+        matrix[row, : len(values)] = values
+    return matrix
+
+
+def _row_value(values):
+    # Для 1-D входа - число, для 2-D - массив на ряд
+    return values[()] if np.ndim(values) == 0 else values
+
+
+def p_chart_limits(proportions, sample_sizes):
+    # Работает и для одного ряда, и для 2-D (ряды x точки) за один проход;
+    # NaN - отсутствующие точки, в p_bar они не входят
+    proportions = np.asarray(proportions, dtype=float)
+    sample_sizes = np.asarray(sample_sizes, dtype=float)
+    weights = np.where(np.isnan(proportions), 0, sample_sizes)
+    p_bar = np.nansum(proportions * weights, axis=-1) / np.nansum(weights, axis=-1)
+    return p_limits_from(p_bar, sample_sizes)
+
+
+def p_limits_from(p_bar, sample_sizes):
+    # Границы по готовому p_bar (замороженному или посчитанному по окну):
+    # число для одного ряда или массив на ряд для 2-D
+    p_bar = np.asarray(p_bar, dtype=float)
+    sample_sizes = np.asarray(sample_sizes, dtype=float)
+    bars = p_bar[..., np.newaxis]
+    sigmas = np.sqrt(bars * (1 - bars) / sample_sizes)
+    return PChartLimits(
+        center=_row_value(p_bar),
+        ucl=bars + 3 * sigmas,
+        upper2=bars + 2 * sigmas,
+        upper1=bars + sigmas,
+        lower1=np.maximum(0, bars - sigmas),
+        lower2=np.maximum(0, bars - 2 * sigmas),
+        lcl=np.maximum(0, bars - 3 * sigmas),
+    )
+
+
+def xbar_limits(means, stddevs, subgroup_size):
+    return xbar_limits_from(
+        np.nanmean(means, axis=-1), np.nanmean(stddevs, axis=-1), subgroup_size
+    )
+
+
+def r_limits(ranges, subgroup_size):
+    return r_limits_from(np.nanmean(ranges, axis=-1), subgroup_size)
+
+
+def s_limits(stddevs, subgroup_size):
+    return s_limits_from(np.nanmean(stddevs, axis=-1), subgroup_size)
+
+
+# Те же границы по готовым средним (X̄-bar, R-bar, S-bar) - для
+# замороженных фаз, где окно на них не влияет
+def xbar_limits_from(x_bar, s_bar, subgroup_size):
+    center = _row_value(np.asarray(x_bar, dtype=float))
+    spread = A2_values.get(subgroup_size, A2_values[5]) * np.asarray(s_bar)
+    return ControlLimits(center=center, ucl=center + spread, lcl=center - spread)
+
+
+def r_limits_from(r_bar, subgroup_size):
+    center = _row_value(np.asarray(r_bar, dtype=float))
+    return ControlLimits(
+        center=center,
+        ucl=D4_values[subgroup_size] * center,
+        lcl=D3_values[subgroup_size] * center,
+    )
+
+
+def s_limits_from(s_bar, subgroup_size):
+    center = _row_value(np.asarray(s_bar, dtype=float))
+    return ControlLimits(
+        center=center,
+        ucl=B4_values[subgroup_size] * center,
+        lcl=B3_values[subgroup_size] * center,
+    )
+
+
+def _hits(values, center):
+    if np.ndim(values) == 2:
+        return detect_rules_batch(values, center)
+    return detect_rules(values, center)
+
+
+def evaluate_p_chart(proportions, sample_sizes):
+    limits = p_chart_limits(proportions, sample_sizes)
+    return ChartEvaluation(limits, _hits(proportions, limits.center))
+
+
+def evaluate_subgroup_charts(means, ranges, stddevs, subgroup_size):
+    # X, R и S-карты по статистикам подгрупп, 1-D или 2-D (чарты x подгруппы)
+    x = xbar_limits(means, stddevs, subgroup_size)
+    r = r_limits(ranges, subgroup_size)
+    s = s_limits(stddevs, subgroup_size)
+    return {
+        "x": ChartEvaluation(x, _hits(means, x.center)),
+        "r": ChartEvaluation(r, _hits(ranges, r.center)),
+        "s": ChartEvaluation(s, _hits(stddevs, s.center)),
+    }
@@ -0,0 +1,232 @@
+import math
+
+import numpy as np
+from sqlalchemy import and_, delete, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import cache
+from shewhart_app.components.service.constants import SUBGROUP_SIZES
+from shewhart_app.components.service.models import (
+    Chart,
+    IndividualMeasurement,
+    SubgroupStatistic,
+)
+from shewhart_app.components.service.queries import (
+    VALUE_DTYPE,
+    fetch_array,
+    iter_arrays,
+)
+from shewhart_app.components.service.session import session_scope
+from shewhart_app.components.service.spc import subgroup_stats
+
+REBUILD_CHUNK_SIZE = 50000
+# Сколько последних измерений чарта сверяется с подгруппами при каждой
+# дописке: пачка, закоммиченная позже соседних, получила id до их курсора,
+# но не глубже, чем на размер параллельно записанных пачек
+RECHECK_POINTS = content.INGEST_BATCH_SIZE
+
+
+def _stat_rows(chart_id, subgroup_size, first_index, ids, values):
+    stats = subgroup_stats(values, subgroup_size)
+    last_ids = ids[subgroup_size - 1 :: subgroup_size][: len(stats.means)]
+    return [
+        {
+            "chart_id": chart_id,
+            "subgroup_size": subgroup_size,
+            "subgroup_index": first_index + i,
+            "last_measurement_id": int(last_ids[i]),
+            "mean": float(stats.means[i]),
+            "range": float(stats.ranges[i]),
+            "stddev": float(stats.stddevs[i]),
+        }
+        for i in range(len(stats.means))
+    ]
+
+
+def _late_sizes(session, binding_id, chart_id, state):
+    # Размеры, в подгруппы которых не попали измерения с id ниже курсора,
+    # закоммиченные позже него. Опорная подгруппа размера - на RECHECK_POINTS
+    # измерений раньше курсора: до курсора после нее должно быть ровно
+    # (next_index - 1 - anchor_index) * size измерений, лишние - опоздавшие.
+    # Возвращает {size: (anchor_index, anchor_id)}
+    targets = {
+        size: next_index - 1 - math.ceil(RECHECK_POINTS / size)
+        for size, (next_index, _) in state.items()
+    }
+    anchors = {size: (-1, 0) for size in state}
+    checked = [
+        and_(
+            SubgroupStatistic.subgroup_size == size,
+            SubgroupStatistic.subgroup_index == index,
+        )
+        for size, index in targets.items()
+        if index >= 0
+    ]
+    if checked:
+        for size, index, last_id in session.execute(
+            select(
+                SubgroupStatistic.subgroup_size,
+                SubgroupStatistic.subgroup_index,
+                SubgroupStatistic.last_measurement_id,
+            ).where(SubgroupStatistic.chart_id == chart_id, or_(*checked))
+        ):
+            anchors[size] = (index, last_id)
+
+    measurement_id = IndividualMeasurement.id
+    counts = session.execute(
+        select(
+            *[
+                func.count().filter(
+                    measurement_id > anchors[size][1],
+                    measurement_id <= state[size][1],
+                )
+                for size in state
+            ]
+        ).where(
+            IndividualMeasurement.binding_id == binding_id,
+            IndividualMeasurement.chart_id == chart_id,
+            measurement_id > min(anchor_id for _, anchor_id in anchors.values()),
+        )
+    ).one()
+    return {
+        size: anchors[size]
+        for size, count in zip(state, counts)
+        if count > (state[size][0] - 1 - anchors[size][0]) * size
+    }
+
+
+def _pending_stats(session, binding_id, chart_id):
+    # Для каждого размера - следующий индекс подгруппы и id последнего
+    # измерения, уже попавшего в подгруппу
+    state = {size: (0, 0) for size in SUBGROUP_SIZES}
+    for size, last_index, last_id in session.execute(
+        select(
+            SubgroupStatistic.subgroup_size,
+            func.max(SubgroupStatistic.subgroup_index),
+            func.max(SubgroupStatistic.last_measurement_id),
+        )
+        .where(SubgroupStatistic.chart_id == chart_id)
+        .group_by(SubgroupStatistic.subgroup_size)
+    ):
+        state[size] = (last_index + 1, last_id)
+
+    # Хвост с опоздавшими измерениями пересчитывается от опорной подгруппы
+    late = _late_sizes(session, binding_id, chart_id, state)
+    for size, (anchor_index, anchor_id) in late.items():
+        session.execute(
+            delete(SubgroupStatistic).where(
+                SubgroupStatistic.chart_id == chart_id,
+                SubgroupStatistic.subgroup_size == size,
+                SubgroupStatistic.subgroup_index > anchor_index,
+            )
+        )
+        state[size] = (anchor_index + 1, anchor_id)
+
+    # Измерения, еще не вошедшие хотя бы в одну подгруппу
+    after_id = min(last_id for _, last_id in state.values())
+    rows = fetch_array(
+        session,
+        select(IndividualMeasurement.id, IndividualMeasurement.value)
+        .where(
+            IndividualMeasurement.binding_id == binding_id,
+            IndividualMeasurement.chart_id == chart_id,
+            IndividualMeasurement.id > after_id,
+        )
+        .order_by(IndividualMeasurement.id),
+        VALUE_DTYPE,
+    )
+    ids, values = rows["id"], rows["value"]
+
+    stat_rows = []
+    for size, (next_index, last_id) in state.items():
+        fresh = ids > last_id
+        stat_rows.extend(
+            _stat_rows(chart_id, size, next_index, ids[fresh], values[fresh])
+        )
+    return stat_rows, set(late)
+
+
+def _publish(chart_id, stat_rows, rebuilt):
+    # Пересчитанный хвост в буфер кэша не дописать - окно перечитается
+    by_key = {}
+    for row in stat_rows:
+        if row["subgroup_size"] not in rebuilt:
+            by_key.setdefault(row["subgroup_size"], []).append(
+                (
+                    row["subgroup_index"],
+                    row["last_measurement_id"],
+                    row["mean"],
+                    row["range"],
+                    row["stddev"],
+                )
+            )
+    for subgroup_size, rows in by_key.items():
+        cache.add_subgroup_stats(chart_id, subgroup_size, rows)
+    for subgroup_size in rebuilt:
+        cache.invalidate(("s", chart_id, subgroup_size))
+
+
+def update_subgroup_stats(binding_id, chart_ids):
+    # Вызывается после коммита новых измерений: дописывает подгруппы,
+    # которые они заполнили
+    for chart_id in chart_ids:
+        try:
+            with session_scope() as session:
+                stat_rows, rebuilt = _pending_stats(session, binding_id, chart_id)
+                if stat_rows:
+                    session.execute(insert(SubgroupStatistic), stat_rows)
+        except IntegrityError:
+            # Те же подгруппы уже записал параллельный запрос
+            continue
+        _publish(chart_id, stat_rows, rebuilt)
+
+
+def rebuild_subgroup_stats(chart_ids=None, chunk_size=REBUILD_CHUNK_SIZE, bind=None):
+    # Полный пересчет по истории: значения читаются кусками, хвост неполной
+    # подгруппы переносится в следующий кусок. bind - база, если это не
+    # основной движок (миграция чужой базы)
+    with session_scope(bind) as session:
+        charts = session.execute(select(Chart.id, Chart.binding_id)).all()
+    if chart_ids is not None:
+        charts = [chart for chart in charts if chart[0] in set(chart_ids)]
+
+    total = 0
+    for chart_id, binding_id in charts:
+        with session_scope(bind) as session:
+            session.execute(
+                delete(SubgroupStatistic).where(SubgroupStatistic.chart_id == chart_id)
+            )
+            next_index = {size: 0 for size in SUBGROUP_SIZES}
+            carry = {
+                size: (np.empty(0, dtype=np.int64), np.empty(0))
+                for size in SUBGROUP_SIZES
+            }
+            chunks = iter_arrays(
+                session,
+                select(IndividualMeasurement.id, IndividualMeasurement.value)
+                .where(
+                    IndividualMeasurement.binding_id == binding_id,
+                    IndividualMeasurement.chart_id == chart_id,
+                )
+                .order_by(IndividualMeasurement.id),
+                VALUE_DTYPE,
+                chunk_size,
+            )
+            for chunk in chunks:
+                chunk_ids, chunk_values = chunk["id"], chunk["value"]
+                stat_rows = []
+                for size in SUBGROUP_SIZES:
+                    ids = np.concatenate((carry[size][0], chunk_ids))
+                    values = np.concatenate((carry[size][1], chunk_values))
+                    rows = _stat_rows(chart_id, size, next_index[size], ids, values)
+                    used = len(rows) * size
+                    carry[size] = (ids[used:], values[used:])
+                    next_index[size] += len(rows)
+                    stat_rows.extend(rows)
+                if stat_rows:
+                    session.execute(insert(SubgroupStatistic), stat_rows)
+                total += len(stat_rows)
+        for size in SUBGROUP_SIZES:
+            cache.invalidate(("s", chart_id, size))
+    return total
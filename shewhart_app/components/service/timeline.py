@@ -0,0 +1,345 @@
+import datetime
+import math
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import Integer, cast, func, literal, select
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service.models import (
+    IndividualMeasurement,
+    IndividualRollup,
+    Measurement,
+    MeasurementRollup,
+)
+from shewhart_app.components.service.queries import fetch_array
+from shewhart_app.components.service.session import session_scope
+
+# Пресеты выбора диапазона: подпись и длина до текущего момента; "latest" -
+# обычный режим последних точек, "all" - вся история
+TIME_RANGES = {
+    "latest": ("Latest points", None),
+    "hour": ("Last hour", datetime.timedelta(hours=1)),
+    "day": ("Last day", datetime.timedelta(days=1)),
+    "week": ("Last week", datetime.timedelta(weeks=1)),
+    "month": ("Last 30 days", datetime.timedelta(days=30)),
+    "quarter": ("Last 90 days", datetime.timedelta(days=90)),
+    "all": ("All history", None),
+}
+
+# time - секунды эпохи (начало корзины или время точки), value - доля или
+# среднее, weight - сумма объемов выборок или число значений, low/high -
+# минимум и максимум, spread - стандартное отклонение значений корзины
+TIME_DTYPE = np.dtype(
+    [
+        ("time", float),
+        ("value", float),
+        ("weight", float),
+        ("low", float),
+        ("high", float),
+        ("spread", float),
+    ]
+)
+RAW_DTYPE = np.dtype([("time", float), ("value", float), ("weight", float)])
+# Суммы по корзине: total - сумма p * n или значений, squares - сумма квадратов
+BUCKET_DTYPE = np.dtype(
+    [
+        ("bucket", np.int64),
+        ("total", float),
+        ("squares", float),
+        ("weight", float),
+        ("low", float),
+        ("high", float),
+    ]
+)
+
+# Ширины корзин в секундах: ширина округляется вверх до ближайшей, чтобы
+# корзины начинались на ровных минутах, часах и сутках (UTC)
+BUCKET_WIDTHS = [
+    1,
+    2,
+    5,
+    10,
+    15,
+    30,
+    60,
+    120,
+    300,
+    600,
+    900,
+    1800,
+    3600,
+    7200,
+    10800,
+    21600,
+    43200,
+    86400,
+    172800,
+    604800,
+]
+
+# Таблица, из которой база считает корзины: колонка времени, условия ряда и
+# суммы в порядке BUCKET_DTYPE (после номера корзины)
+BucketSource = namedtuple("BucketSource", ["column", "where", "bucket_columns"])
+# raw - строки как есть, иначе корзины по width секунд
+TimeSeries = namedtuple("TimeSeries", ["raw", "width", "rows"])
+
+
+def preset_window(preset):
+    # Окно для клиента: None - режим последних точек
+    if preset not in TIME_RANGES or preset == "latest":
+        return None
+    span = TIME_RANGES[preset][1]
+    if span is None:
+        return {"preset": preset, "start": None, "end": None}
+    end = datetime.datetime.utcnow()
+    return {
+        "preset": preset,
+        "start": (end - span).isoformat(),
+        "end": end.isoformat(),
+    }
+
+
+def bucket_width(seconds):
+    for width in BUCKET_WIDTHS:
+        if width >= seconds:
+            return width
+    # Больше недели - целыми неделями
+    return math.ceil(seconds / BUCKET_WIDTHS[-1]) * BUCKET_WIDTHS[-1]
+
+
+def describe_width(width):
+    for unit, name in ((86400, "d"), (3600, "h"), (60, "min")):
+        if width % unit == 0:
+            return f"{width // unit} {name}"
+    return f"{width} s"
+
+
+def _parse(value):
+    return None if value is None else datetime.datetime.fromisoformat(str(value))
+
+
+def _epoch(dialect_name, column):
+    # Секунды эпохи выражением SQL; время хранится наивным UTC
+    if dialect_name == "sqlite":
+        return (func.julianday(column) - 2440587.5) * 86400.0
+    return func.extract("epoch", column)
+
+
+def bucket_expression(dialect_name, column, width):
+    # На SQLite - целые секунды: julianday дает погрешность, и точка ровно на
+    # границе (начало корзины свертки) уходила в предыдущую корзину
+    if dialect_name == "sqlite":
+        return cast(func.strftime("%s", column), Integer) // width
+    return func.floor(_epoch(dialect_name, column) / width)
+
+
+def bucket_rows(session, source, width, where=()):
+    # Суммы по корзинам ширины width секунд, посчитанные базой; where -
+    # условия сверх source.where
+    dialect_name = session.get_bind().dialect.name
+    bucket = bucket_expression(dialect_name, source.column, width)
+    return fetch_array(
+        session,
+        select(bucket, *source.bucket_columns)
+        .where(*source.where, *where)
+        .group_by(bucket)
+        .order_by(bucket),
+        BUCKET_DTYPE,
+    )
+
+
+def _merge_buckets(parts):
+    # Корзины сырых строк и сверток с одним номером складываются
+    buckets = np.concatenate(parts)
+    if not len(buckets):
+        return buckets
+    buckets.sort(order="bucket")
+    starts = np.flatnonzero(np.diff(buckets["bucket"], prepend=np.nan) != 0)
+    merged = np.empty(len(starts), dtype=BUCKET_DTYPE)
+    merged["bucket"] = buckets["bucket"][starts]
+    for field in ("total", "squares", "weight"):
+        merged[field] = np.add.reduceat(buckets[field], starts)
+    merged["low"] = np.minimum.reduceat(buckets["low"], starts)
+    merged["high"] = np.maximum.reduceat(buckets["high"], starts)
+    return merged
+
+
+def _bounds(session, sources):
+    firsts, lasts = [], []
+    for source in sources:
+        first, last = session.execute(
+            select(func.min(source.column), func.max(source.column)).where(
+                *source.where
+            )
+        ).one()
+        if first is not None:
+            firsts.append(first)
+            lasts.append(last)
+    if not firsts:
+        return None, None
+    return min(firsts), max(lasts)
+
+
+def _series(session, raw, rollup, raw_columns, start, end):
+    if start is None or end is None:
+        first, last = _bounds(session, [raw, rollup])
+        if first is None:
+            return TimeSeries(True, 0, np.empty(0, dtype=TIME_DTYPE))
+        start, end = start or first, end or last
+    raw_range = [raw.column >= start, raw.column <= end]
+    rollup_range = [rollup.column >= start, rollup.column <= end]
+    dialect_name = session.get_bind().dialect.name
+    rolled_up = (
+        session.execute(
+            select(rollup.column).where(*rollup.where, *rollup_range).limit(1)
+        ).first()
+        is not None
+    )
+
+    # Узкий диапазон - сырые строки: их не больше TIME_RAW_POINTS, и запрос
+    # с LIMIT останавливается сразу за этой границей. Если часть диапазона
+    # уже свернута, сырых строк за нее нет - тогда только корзины
+    if not rolled_up:
+        rows = fetch_array(
+            session,
+            select(_epoch(dialect_name, raw.column), *raw_columns)
+            .where(*raw.where, *raw_range)
+            .order_by(raw.column)
+            .limit(content.TIME_RAW_POINTS + 1),
+            RAW_DTYPE,
+            content.TIME_RAW_POINTS + 1,
+        )
+        if len(rows) <= content.TIME_RAW_POINTS:
+            series = np.empty(len(rows), dtype=TIME_DTYPE)
+            for field in ("time", "value", "weight"):
+                series[field] = rows[field]
+            series["low"] = series["high"] = rows["value"]
+            series["spread"] = 0
+            return TimeSeries(True, 0, series)
+
+    # Широкий - агрегаты по корзинам считает база, клиенту уходит не больше
+    # TIME_BUCKETS точек при любой ширине диапазона; корзина не уже свертки
+    span = (end - start).total_seconds()
+    width = bucket_width(span / content.TIME_BUCKETS)
+    if rolled_up:
+        width = max(width, content.RETENTION_BUCKET_SECONDS)
+    parts = [bucket_rows(session, raw, width, raw_range)]
+    if rolled_up:
+        parts.append(bucket_rows(session, rollup, width, rollup_range))
+    buckets = _merge_buckets(parts)
+    rows = np.empty(len(buckets), dtype=TIME_DTYPE)
+    rows["time"] = buckets["bucket"] * float(width)
+    rows["weight"] = buckets["weight"]
+    rows["value"] = buckets["total"] / buckets["weight"]
+    rows["low"] = buckets["low"]
+    rows["high"] = buckets["high"]
+    # Дисперсия по суммам; у корзины из одного значения разброса нет
+    counts = np.maximum(buckets["weight"] - 1, 1)
+    variance = (buckets["squares"] - buckets["total"] * rows["value"]) / counts
+    rows["spread"] = np.sqrt(np.maximum(variance, 0))
+    return TimeSeries(False, width, rows)
+
+
+def measurement_sources(where):
+    # Сырые измерения и их свертки как источники корзин; where -
+    # (условия на results, условия на results_rollups)
+    return (
+        BucketSource(
+            Measurement.measurement_time,
+            where[0],
+            [
+                func.sum(Measurement.proportion * Measurement.sample_size),
+                func.sum(
+                    Measurement.proportion
+                    * Measurement.proportion
+                    * Measurement.sample_size
+                ),
+                func.sum(Measurement.sample_size),
+                func.min(Measurement.proportion),
+                func.max(Measurement.proportion),
+            ],
+        ),
+        BucketSource(
+            MeasurementRollup.bucket_start,
+            where[1],
+            [
+                func.sum(MeasurementRollup.weighted_proportion),
+                func.sum(MeasurementRollup.weighted_squares),
+                func.sum(MeasurementRollup.sample_size),
+                func.min(MeasurementRollup.min_proportion),
+                func.max(MeasurementRollup.max_proportion),
+            ],
+        ),
+    )
+
+
+def individual_sources(where):
+    value = IndividualMeasurement.value
+    return (
+        BucketSource(
+            IndividualMeasurement.measurement_time,
+            where[0],
+            [
+                func.sum(value),
+                func.sum(value * value),
+                func.count(),
+                func.min(value),
+                func.max(value),
+            ],
+        ),
+        BucketSource(
+            IndividualRollup.bucket_start,
+            where[1],
+            [
+                func.sum(IndividualRollup.total),
+                func.sum(IndividualRollup.squares),
+                func.sum(IndividualRollup.count),
+                func.min(IndividualRollup.min_value),
+                func.max(IndividualRollup.max_value),
+            ],
+        ),
+    )
+
+
+def measurement_series(binding_id, start=None, end=None):
+    # p-карта за период: доля корзины взвешена объемами выборок, weight -
+    # суммарный объем, так что границы p-карты считаются как обычно
+    raw, rollup = measurement_sources(
+        (
+            [Measurement.binding_id == binding_id],
+            [MeasurementRollup.binding_id == binding_id],
+        )
+    )
+    with session_scope() as session:
+        return _series(
+            session,
+            raw,
+            rollup,
+            [Measurement.proportion, Measurement.sample_size],
+            _parse(start),
+            _parse(end),
+        )
+
+
+def individual_series(binding_id, chart_id, start=None, end=None):
+    # Значения чарта за период; значения без времени (записанные до его
+    # появления) в выборку по времени не попадают
+    raw, rollup = individual_sources(
+        (
+            [
+                IndividualMeasurement.binding_id == binding_id,
+                IndividualMeasurement.chart_id == chart_id,
+            ],
+            [IndividualRollup.chart_id == chart_id],
+        )
+    )
+    with session_scope() as session:
+        return _series(
+            session,
+            raw,
+            rollup,
+            [IndividualMeasurement.value, literal(1.0)],
+            _parse(start),
+            _parse(end),
+        )
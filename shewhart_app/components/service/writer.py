@@ -0,0 +1,144 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service import ingest, metrics
+
+# По виду строки: вставка пачки с коммитом и побочные эффекты после него
+# (кэш рядов, подгруппы)
+FLUSHERS = {
+    "measurement": (ingest.write_measurements, ingest.publish_measurements),
+    "individual": (ingest.write_individual_values, ingest.publish_individual_values),
+}
+_STOP = (None, None, None)
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    # Строки копятся в очереди и пишутся фоновым потоком пачками: как только
+    # набралось batch_size строк или прошло flush_interval секунд с первой.
+    # Future строки завершается только после коммита ее пачки, так что
+    # дождавшийся result() вызывающий знает, что строка уже в БД.
+
+    def __init__(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def submit(self, kind, row):
+        future = Future()
+        self._ensure_started().put((kind, row, future))
+        return future
+
+    def flush(self, timeout=None):
+        # Дожидается записи всего, что было в очереди на момент вызова
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            pending = self._queue
+        future = Future()
+        pending.put((None, None, future))
+        future.result(timeout)
+
+    def close(self, timeout=None):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            thread, pending = self._thread, self._queue
+            self._thread = None
+        pending.put(_STOP)
+        thread.join(timeout)
+
+    def _ensure_started(self):
+        with self._lock:
+            # Поток запускается при первой записи; после fork (gunicorn
+            # --preload) потока родителя в дочернем процессе нет
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,), daemon=True
+                )
+                self._thread.start()
+            return self._queue
+
+    def _run(self, pending):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Маркер flush или остановки пишет накопленное сразу
+            while batch[-1][0] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            with metrics.background("write_behind"):
+                self._write([item for item in batch if item is not _STOP])
+            if stop:
+                return
+
+    def _write(self, batch):
+        by_kind = {}
+        for kind, row, future in batch:
+            if kind is not None:
+                by_kind.setdefault(kind, []).append((row, future))
+        for kind, items in by_kind.items():
+            self._write_rows(kind, items)
+        for kind, _, future in batch:
+            if kind is None:
+                future.set_result(None)
+
+    def _write_rows(self, kind, items):
+        write, publish = FLUSHERS[kind]
+        rows = [row for row, _ in items]
+        try:
+            # Одна пачка - один коммит, иначе повтор по строкам ниже мог бы
+            # задвоить уже записанную часть
+            ids = write(rows)
+        except Exception as error:
+            if len(items) == 1:
+                items[0][1].set_exception(error)
+                return
+            # Пачка не записалась - пишем по строке, чтобы ошибка досталась
+            # только той строке, которая ее вызвала
+            for item in items:
+                self._write_rows(kind, [item])
+            return
+        try:
+            publish(rows, ids)
+        except Exception:
+            # Строки уже в БД, повторять вставку нельзя. Буфер кэша сброшен и
+            # перечитается, подгруппы догонит следующая вставка
+            logger.exception(
+                "Post-commit update failed for %d %s rows", len(rows), kind
+            )
+        for _, future in items:
+            future.set_result(None)
+
+
+writer = WriteBehindQueue(content.WRITE_BATCH_SIZE, content.WRITE_FLUSH_INTERVAL)
+# При остановке процесса дописываем все, что осталось в очереди
+atexit.register(writer.close)
+
+
+def submit_measurement(row):
+    # row - словарь из ingest.measurement_row
+    return writer.submit("measurement", row)
+
+
+def submit_individual_value(row):
+    # row - словарь из ingest.individual_row
+    return writer.submit("individual", row)
@@ -0,0 +1,22 @@
+import os
+
+# Воркеры одного хоста делят кэш рядов через файл; настройку нужно задать
+# до импорта приложения
+os.environ.setdefault("SHEWHART_CACHE_BACKEND", "disk")
+
+import shewhart_app.components.content as content
+
+wsgi_app = "shewhart_app.wsgi:server"
+bind = content.SERVER_BIND
+workers = content.SERVER_WORKERS
+threads = content.SERVER_THREADS
+timeout = content.SERVER_TIMEOUT
+preload_app = True
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    from shewhart_app.components.service.session import engine
+
+    # Пул, скопированный из мастера, не трогаем - у воркера свои соединения
+    engine.dispose(close=False)
@@ -0,0 +1,336 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import shewhart_app.components.content as content
+from shewhart_app.components.service.constants import SUBGROUP_SIZES
+
+ENDPOINTS = {
+    "measurements": "/api/measurements",
+    "individual": "/api/individual_measurements",
+}
+
+
+def _open(path):
+    if path == "-":
+        return sys.stdin
+    return open(path, newline="", encoding="utf-8")
+
+
+def _guess_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    return {".csv": "csv", ".json": "json"}.get(extension, "jsonl")
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(",")]
+
+
+def _subgroup_sizes(value):
+    # Только размеры, для которых есть коэффициенты границ
+    sizes = _int_list(value)
+    unknown = sorted(set(sizes) - set(SUBGROUP_SIZES))
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unsupported subgroup sizes {unknown}, "
+            f"expected {SUBGROUP_SIZES[0]}..{SUBGROUP_SIZES[-1]}"
+        )
+    return sizes
+
+
+def _post_batches(url, kind, records, batch_size):
+    # Отправка пачками в работающий сервер - он сам обновит свои кэши
+    total = 0
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return total
+        request = urllib.request.Request(
+            url.rstrip("/") + ENDPOINTS[kind],
+            data=json.dumps(batch).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as response:
+            total += json.load(response)["inserted"]
+
+
+def ingest_command(args):
+    from shewhart_app.components.service import ingest
+
+    batch_size = args.batch_size or content.INGEST_BATCH_SIZE
+    fmt = args.format or _guess_format(args.path)
+    with _open(args.path) as stream:
+        records = ingest.read_records(stream, fmt)
+        if args.url:
+            total = _post_batches(args.url, args.kind, records, batch_size)
+        elif args.kind == "measurements":
+            total = ingest.ingest_measurements(
+                map(ingest.measurement_row, records), batch_size, args.copy
+            )
+        else:
+            total = ingest.ingest_individual_values(
+                map(ingest.individual_row, records), batch_size, args.copy
+            )
+    print(f"Inserted {total} rows")
+
+
+def migrate_command(args):
+    from shewhart_app.components.service.migrations import upgrade
+    from shewhart_app.components.service.session import engine
+
+    applied = upgrade(engine)
+    for version, description in applied:
+        print(f"Applied {version}: {description}")
+    if not applied:
+        print("Schema is up to date")
+
+
+def check_plans_command(args):
+    from shewhart_app.components.service.queries import check_refresh_plans
+    from shewhart_app.components.service.session import session_scope
+
+    with session_scope() as session:
+        report = check_refresh_plans(
+            session, args.binding_id, args.chart_ids, args.limit
+        )
+    failed = False
+    for name, verdict, plan in report:
+        print(f"{name}: {verdict}")
+        for line in plan:
+            print(f"    {line}")
+        failed = failed or verdict != "index-only"
+    if failed:
+        sys.exit(1)
+
+
+def rebuild_subgroups_command(args):
+    from shewhart_app.components.service.subgroups import rebuild_subgroup_stats
+
+    total = rebuild_subgroup_stats(args.chart_ids)
+    print(f"Rebuilt {total} subgroup rows")
+
+
+def backtest_command(args):
+    from shewhart_app.components.service.backtest import run_backtest
+
+    summary = run_backtest(args.binding_id, args.chart_id, args.output, args.chunk_size)
+    target = args.output or "backtest_hits"
+    print(
+        f"{summary.series} series: {summary.points} points, "
+        f"{summary.hits} rule hits -> {target}"
+    )
+
+
+def _format_bytes(size):
+    if size is None:
+        return "unknown"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def retention_command(args):
+    from shewhart_app.components.service.retention import run_retention
+
+    # С --every команда работает как долгоживущее задание обслуживания
+    while True:
+        for report in run_retention(args.max_age_days, args.archive):
+            print(
+                f"{report.table}: {report.rows} rows rolled up into "
+                f"{report.rollup_rows} rollup rows, "
+                f"{report.partitions} partitions dropped, "
+                f"{_format_bytes(report.reclaimed_bytes)} reclaimed"
+            )
+        if not args.every:
+            return
+        sys.stdout.flush()
+        time.sleep(args.every)
+
+
+def partition_command(args):
+    from shewhart_app.components.service.retention import partition_tables
+
+    try:
+        converted = partition_tables(args.months_ahead)
+    except RuntimeError as error:
+        sys.exit(str(error))
+    for table in converted:
+        print(f"Partitioned {table} by month")
+    if not converted:
+        print("Tables are already partitioned")
+
+
+def evaluate_command(args):
+    from shewhart_app.components.service import cache, spc
+    from shewhart_app.components.service.models import Binding
+    from shewhart_app.components.service.session import session_scope
+
+    binding_ids = args.binding_ids
+    if not binding_ids:
+        with session_scope() as session:
+            binding_ids = [
+                binding_id
+                for (binding_id,) in session.query(Binding.id).order_by(Binding.id)
+            ]
+    series = [cache.recent_measurements(binding_id) for binding_id in binding_ids]
+    # Все связки одним проходом: матрица связки x точки, хвосты - NaN
+    evaluation = spc.evaluate_p_chart(
+        spc.pad_series([rows["proportion"] for rows in series]),
+        spc.pad_series([rows["sample_size"] for rows in series]),
+    )
+    for binding_id, rows, center, hits in zip(
+        binding_ids, series, evaluation.limits.center, evaluation.hits
+    ):
+        print(
+            f"binding {binding_id}: {len(rows)} points, "
+            f"p_bar={center:.4f}, {len(hits)} rule hits"
+        )
+
+
+def serve_command(args):
+    # Процесс заменяется gunicorn с настройками из gunicorn_conf.py
+    os.execvp(
+        "gunicorn",
+        ["gunicorn", "-c", "python:shewhart_app.gunicorn_conf", *args.gunicorn_args],
+    )
+
+
+def bench_command(args):
+    from shewhart_app import benchmarks
+
+    report = benchmarks.run(args.sizes, args.subgroup_sizes, args.repeat)
+    benchmarks.save(report, args.output)
+    for result in report["results"]:
+        print(
+            f"{result['benchmark']:<16} n={result['size']:<8} "
+            f"k={result['subgroup_size'] or '-':<3} "
+            f"min={result['min_s'] * 1000:10.3f} ms "
+            f"{result['ns_per_point']:8.1f} ns/point"
+        )
+    print(f"Saved {len(report['results'])} results to {args.output}")
+    if args.compare:
+        _, regressions = benchmarks.compare(
+            benchmarks.load(args.compare), report, args.threshold
+        )
+        for (name, size, subgroup_size), ratio in regressions:
+            print(f"REGRESSION {name} n={size} k={subgroup_size}: x{ratio:.2f}")
+        if regressions:
+            sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m shewhart_app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser(
+        "ingest", help="bulk load measurements from CSV or JSON lines"
+    )
+    ingest_parser.add_argument("kind", choices=sorted(ENDPOINTS))
+    ingest_parser.add_argument("path", help="input file, '-' for stdin")
+    ingest_parser.add_argument("--format", choices=["csv", "jsonl", "json"])
+    ingest_parser.add_argument("--batch-size", type=int)
+    ingest_parser.add_argument(
+        "--copy", action="store_true", help="use COPY FROM STDIN on Postgres"
+    )
+    ingest_parser.add_argument(
+        "--url",
+        help="send batches to a running server (e.g. http://localhost:8050) "
+        "instead of writing to the database directly",
+    )
+    ingest_parser.set_defaults(handler=ingest_command)
+
+    migrate_parser = commands.add_parser("migrate", help="apply schema migrations")
+    migrate_parser.set_defaults(handler=migrate_command)
+
+    plans_parser = commands.add_parser(
+        "check-plans",
+        help="EXPLAIN the refresh queries, fail unless they are index-only range scans",
+    )
+    plans_parser.add_argument("--binding-id", type=int, default=1)
+    plans_parser.add_argument(
+        "--chart-ids",
+        type=_int_list,
+        default=[1, 2],
+    )
+    plans_parser.add_argument("--limit", type=int, default=content.MAX_POINTS * 10)
+    plans_parser.set_defaults(handler=check_plans_command)
+
+    rebuild_parser = commands.add_parser(
+        "rebuild-subgroups", help="recompute subgroup statistics from raw values"
+    )
+    rebuild_parser.add_argument("--chart-ids", type=_int_list)
+    rebuild_parser.set_defaults(handler=rebuild_subgroups_command)
+
+    backtest_parser = commands.add_parser(
+        "backtest", help="stream a series' full history through the rule detectors"
+    )
+    backtest_parser.add_argument("--binding-id", type=int, required=True)
+    backtest_parser.add_argument(
+        "--chart-id", type=int, help="individual values of a chart instead of p"
+    )
+    backtest_parser.add_argument(
+        "--output", help="write hits to a .csv or JSON lines file, not the table"
+    )
+    backtest_parser.add_argument("--chunk-size", type=int)
+    backtest_parser.set_defaults(handler=backtest_command)
+
+    retention_parser = commands.add_parser(
+        "retention", help="roll up and delete raw rows older than the retention age"
+    )
+    retention_parser.add_argument(
+        "--max-age-days",
+        type=float,
+        help=f"default {content.RETENTION_MAX_AGE_DAYS:g}",
+    )
+    retention_parser.add_argument(
+        "--archive", help="directory for CSV copies of the deleted rows"
+    )
+    retention_parser.add_argument(
+        "--every", type=float, help="repeat every N seconds instead of exiting"
+    )
+    retention_parser.set_defaults(handler=retention_command)
+
+    partition_parser = commands.add_parser(
+        "partition", help="convert the raw tables to monthly partitions (Postgres)"
+    )
+    partition_parser.add_argument("--months-ahead", type=int)
+    partition_parser.set_defaults(handler=partition_command)
+
+    evaluate_parser = commands.add_parser(
+        "evaluate", help="evaluate p-charts of all bindings in one vectorized pass"
+    )
+    evaluate_parser.add_argument("--binding-ids", type=_int_list)
+    evaluate_parser.set_defaults(handler=evaluate_command)
+
+    serve_parser = commands.add_parser(
+        "serve", help="run the app under gunicorn with preloaded workers"
+    )
+    serve_parser.add_argument("gunicorn_args", nargs=argparse.REMAINDER)
+    serve_parser.set_defaults(handler=serve_command)
+
+    bench_parser = commands.add_parser(
+        "bench", help="time detectors and control-limit math on synthetic series"
+    )
+    bench_parser.add_argument("--sizes", type=_int_list)
+    bench_parser.add_argument("--subgroup-sizes", type=_subgroup_sizes)
+    bench_parser.add_argument("--repeat", type=int, default=5)
+    bench_parser.add_argument("--output", default="benchmarks.json")
+    bench_parser.add_argument(
+        "--compare", help="previous results file; exit 1 on regressions"
+    )
+    bench_parser.add_argument("--threshold", type=float, default=1.25)
+    bench_parser.set_defaults(handler=bench_command)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
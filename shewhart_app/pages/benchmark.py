@@ -0,0 +1,141 @@
+import time
+
+import dash
+from dash import dcc, html, dash_table, callback, clientside_callback
+import dash_bootstrap_components as dbc
+import numpy as np
+from dash.dependencies import Input, Output, State
+
+from shewhart_app.components.figures import (
+    constant_trace,
+    control_figure,
+    values_trace,
+)
+
+dash.register_page(__name__, path="/benchmark")
+
+SIZES = [1000, 10000, 100000, 1000000]
+# None - выбор по WEBGL_MIN_POINTS, как на рабочих страницах
+RENDERERS = {"auto": None, "svg": False, "webgl": True}
+
+layout = dbc.Container(
+    [
+        html.H1("Rendering Benchmark", className="mb-4"),
+        dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        dbc.Label("Points"),
+                        dcc.Dropdown(
+                            id="benchmark-size",
+                            options=SIZES,
+                            value=SIZES[0],
+                            clearable=False,
+                        ),
+                    ],
+                    width=4,
+                ),
+                dbc.Col(
+                    [
+                        dbc.Label("Renderer"),
+                        dcc.RadioItems(
+                            id="benchmark-renderer",
+                            options=list(RENDERERS),
+                            value="auto",
+                            inline=True,
+                        ),
+                    ],
+                    width=4,
+                ),
+                dbc.Col(
+                    dbc.Button(
+                        "Run", id="benchmark-run", color="primary", className="mt-4"
+                    ),
+                    width=4,
+                ),
+            ],
+            className="mb-3",
+        ),
+        dcc.Store(id="benchmark-figure"),
+        # Скрытый график нужен только чтобы загрузился plotly.js; замер идет
+        # на отдельном div, куда рисуем напрямую через Plotly.react
+        dcc.Graph(id="benchmark-loader", style={"display": "none"}),
+        html.Div(id="benchmark-canvas"),
+        dash_table.DataTable(
+            id="benchmark-results",
+            columns=[
+                {"name": "Points", "id": "size"},
+                {"name": "Renderer", "id": "renderer"},
+                {"name": "Build, ms", "id": "build_ms"},
+                {"name": "Render, ms", "id": "render_ms"},
+            ],
+            data=[],
+        ),
+    ]
+)
+
+
+@callback(
+    Output("benchmark-figure", "data"),
+    [Input("benchmark-run", "n_clicks")],
+    [State("benchmark-size", "value"), State("benchmark-renderer", "value")],
+    prevent_initial_call=True,
+)
+def build_benchmark_figure(n_clicks, size, renderer):
+    started = time.perf_counter()
+    values = np.random.default_rng(n_clicks).normal(0.1, 0.01, size)
+    center = values.mean()
+    sigma = values.std()
+    figure = control_figure(
+        [
+            values_trace(
+                values,
+                "Value",
+                webgl=RENDERERS[renderer],
+                mode="lines+markers",
+                line=dict(color="blue"),
+            ),
+            constant_trace(center, size, "Mean Value"),
+            constant_trace(
+                center + 3 * sigma, size, "UCL", line=dict(dash="dash", color="red")
+            ),
+            constant_trace(
+                center - 3 * sigma, size, "LCL", line=dict(dash="dash", color="red")
+            ),
+        ],
+        f"{size} points",
+        "Value",
+        [],
+    )
+    return {
+        "figure": figure,
+        "size": size,
+        "renderer": renderer,
+        "build_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+# Время отрисовки меряется в браузере: от Plotly.react до следующего кадра
+clientside_callback(
+    """
+    async function(payload, results) {
+        if (!payload) {
+            return window.dash_clientside.no_update;
+        }
+        const canvas = document.getElementById("benchmark-canvas");
+        const started = performance.now();
+        await Plotly.react(canvas, payload.figure.data, payload.figure.layout);
+        await new Promise(requestAnimationFrame);
+        const row = {
+            size: payload.size,
+            renderer: payload.renderer,
+            build_ms: payload.build_ms,
+            render_ms: Math.round((performance.now() - started) * 10) / 10,
+        };
+        return [row].concat(results || []);
+    }
+    """,
+    Output("benchmark-results", "data"),
+    [Input("benchmark-figure", "data")],
+    [State("benchmark-results", "data")],
+)
@@ -3,7 +3,8 @@ import dash
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 from shewhart_app.components.service.models import Binding
-from shewhart_app.components.service.session import Session
+from shewhart_app.components.service.metrics import timed_callback
+from shewhart_app.components.service.session import session_scope
 from shewhart_app.components.navbar import Navbar
 
 dash.register_page(__name__, path="/")
@@ -35,18 +36,16 @@ layout = dbc.Container(
     [Input("add-binding-button", "n_clicks")],
     [State("binding-name", "value")],
 )
+@timed_callback
 def manage_bindings(n_clicks, binding_name):
-    session = Session()
+    with session_scope() as session:
+        # Если имя связки предоставлено, добавляем его в базу данных
+        if n_clicks and binding_name:
+            session.add(Binding(name=binding_name))
+            session.flush()
 
-    # Если имя связки предоставлено, добавляем его в базу данных
-    if n_clicks and binding_name:
-        new_binding = Binding(name=binding_name)
-        session.add(new_binding)
-        session.commit()
-
-    # Получаем список всех связок
-    bindings = session.query(Binding).all()
-    session.close()
+        # Получаем список всех связок
+        bindings = session.query(Binding).all()
 
     binding_elements = []
     for binding in bindings:
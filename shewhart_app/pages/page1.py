@@ -3,65 +3,62 @@ import re
 import dash
 from dash import dcc, html, dash_table, callback
 import dash_bootstrap_components as dbc
-import numpy as np
-import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State, MATCH, ALL
+from dash.exceptions import PreventUpdate
 
-from shewhart_app.components.service.detectors import (
-    detect_trends,
-    detect_shifts,
-    detect_asterisks,
-)
 from shewhart_app.components.service.models import (
-    Measurement,
-    Base,
-    IndividualMeasurement,
     Chart,
     Binding,
 )
-from shewhart_app.components.service.session import Session, engine
+from shewhart_app.components.service.metrics import timed_callback
+from shewhart_app.components.service.session import session_scope
+from shewhart_app.components.service import ingest, writer
 import shewhart_app.components.content as content
 from shewhart_app.components.navbar import Navbar
+from shewhart_app.components.charts import (
+    p_chart,
+    time_p_chart,
+    time_range_options,
+    time_window,
+)
 
-Base.metadata.create_all(engine)
 MAX_POINTS = content.MAX_POINTS
 
 dash.register_page(__name__, path_template="/bindings/<bid>/input")
 
 
 def layout(bid=None):
-    session = Session()
     binding_id = int(bid)
-    binding = session.query(Binding).filter_by(id=binding_id).one_or_none()
-    name = binding.name
+    with session_scope() as session:
+        binding = session.query(Binding).filter_by(id=binding_id).one_or_none()
+        name = binding.name
+        charts = list(binding.charts)
     charts_data_input_forms = []
-    if binding and binding.charts:
-        for chart in binding.charts:
-            chart_form = dbc.Row(
-                [
-                    dbc.Col(
-                        [
-                            html.H4(chart.name),
-                            dbc.Label("Enter Data for " + chart.name),
-                            dbc.Input(
-                                id={"type": "input-data", "index": chart.id},
-                                type="number",
-                                step="any",
-                                className="mb-2",
-                            ),
-                            dbc.Button(
-                                "Add Data to " + chart.name,
-                                id={"type": "add-data-button", "index": chart.id},
-                                color="primary",
-                                className="mb-3",
-                            ),
-                        ],
-                        width=4,
-                    ),
-                ]
-            )
-            charts_data_input_forms.append(chart_form)
-    session.close()
+    for chart in charts:
+        chart_form = dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        html.H4(chart.name),
+                        dbc.Label("Enter Data for " + chart.name),
+                        dbc.Input(
+                            id={"type": "input-data", "index": chart.id},
+                            type="number",
+                            step="any",
+                            className="mb-2",
+                        ),
+                        dbc.Button(
+                            "Add Data to " + chart.name,
+                            id={"type": "add-data-button", "index": chart.id},
+                            color="primary",
+                            className="mb-3",
+                        ),
+                    ],
+                    width=4,
+                ),
+            ]
+        )
+        charts_data_input_forms.append(chart_form)
     return dbc.Container(
         [
             html.H1(
@@ -107,7 +104,16 @@ def layout(bid=None):
                     ),
                 ]
             ),
+            dcc.Dropdown(
+                id="time-range",
+                options=time_range_options(),
+                value="latest",
+                clearable=False,
+                className="mb-2",
+            ),
             dcc.Graph(id=f"p-chart"),
+            dcc.Store(id="p-chart-state"),
+            dcc.Store(id="time-window"),
             html.Div(id=f"data-added-signal", style={"display": "none"}),
             dcc.Interval(
                 id=f"interval-component",
@@ -147,15 +153,13 @@ def layout(bid=None):
     [Input("create-new-chart-button", "n_clicks")],
     [State("input-new-chart-name", "value"), State("bid", "value")],
 )
+@timed_callback
 def create_new_chart(n_clicks, chart_name, bid):
     print("here")
     if n_clicks and chart_name:
         binding_id = int(bid)
-        session = Session()
-        new_chart = Chart(name=chart_name, binding_id=binding_id)
-        session.add(new_chart)
-        session.commit()
-        session.close()
+        with session_scope() as session:
+            session.add(Chart(name=chart_name, binding_id=binding_id))
         return "Chart Created"
     return ""
 
@@ -169,17 +173,21 @@ def create_new_chart(n_clicks, chart_name, bid):
         State("bid", "value"),
     ],
 )
+@timed_callback
 def add_data_to_database(n_clicks, proportion, sample_size, bid):
     binding_id = int(bid)
 
     if n_clicks and proportion is not None and sample_size is not None:
-        session = Session()
-        new_measurement = Measurement(
-            proportion=proportion, sample_size=sample_size, binding_id=binding_id
+        row = ingest.measurement_row(
+            {
+                "binding_id": binding_id,
+                "proportion": proportion,
+                "sample_size": sample_size,
+            }
         )
-        session.add(new_measurement)
-        session.commit()
-        session.close()
+        # Запись идет пачкой вместе с соседними запросами; ответ - после
+        # коммита, чтобы обновление графика уже увидело новую точку
+        writer.submit_measurement(row).result(content.WRITE_ACK_TIMEOUT)
         return "True"  # данные успешно добавлены
     return "False"
 
@@ -194,6 +202,7 @@ def add_data_to_database(n_clicks, proportion, sample_size, bid):
         State("bid", "value"),
     ],
 )
+@timed_callback
 def add_individual_data_to_database(all_clicks, all_input_values, bid):
     ctx = dash.callback_context
     if not ctx.triggered:
@@ -211,152 +220,54 @@ def add_individual_data_to_database(all_clicks, all_input_values, bid):
             binding_id = int(bid)
             chart_id = int(chart_id)  # Преобразуем chart_id в int
 
-            session = Session()
-            new_measurement = IndividualMeasurement(
-                value=input_value, binding_id=binding_id, chart_id=chart_id
+            row = ingest.individual_row(
+                {"binding_id": binding_id, "chart_id": chart_id, "value": input_value}
             )
-            session.add(new_measurement)
-            session.commit()
-            session.close()
+            writer.submit_individual_value(row).result(content.WRITE_ACK_TIMEOUT)
             return "True"  # данные успешно добавлены
     return "False"
 
 
 @callback(
-    [Output("table", "data"), Output("p-chart", "figure")],
+    Output("time-window", "data"),
+    [Input("time-range", "value"), Input("p-chart", "relayoutData")],
+    [State("time-window", "data")],
+)
+@timed_callback
+def select_time_window(preset, relayout, window):
+    if dash.ctx.triggered_id == "time-range":
+        relayout = None
+    return time_window(preset, relayout, window)
+
+
+@callback(
+    [
+        Output("table", "data"),
+        Output("p-chart", "figure"),
+        Output("p-chart-state", "data"),
+    ],
     [
         Input("data-added-signal", "children"),
         Input("interval-component", "n_intervals"),
+        Input("time-window", "data"),
     ],
-    State("bid", "value"),
+    [State("bid", "value"), State("p-chart-state", "data")],
 )
-def update_chart(data_added, n_intervals, bid):
-    binding_id = int(bid)
-    session = Session()
-    recent_measurements = (
-        session.query(Measurement)
-        .filter_by(binding_id=binding_id)
-        .order_by(Measurement.id.desc())
-        .limit(MAX_POINTS)
-    )
-    recent_measurements = recent_measurements[::-1]
-    session.close()
+@timed_callback
+def update_chart(data_added, n_intervals, window, bid, shown):
+    if window:
+        # Диапазон по времени не едет за новыми точками - перерисовываем
+        # только при смене окна или вводе; состояние сбрасываем, чтобы
+        # возврат к последним точкам прислал полный figure
+        if dash.ctx.triggered_id == "interval-component":
+            raise PreventUpdate
+        return dash.no_update, time_p_chart(int(bid), window), None
+    measurements, figure, state = p_chart(int(bid), shown)
 
-    # Обновление текстового поля и графика
+    # Обновление текстового поля; в таблице только последние MAX_POINTS
+    # строк, даже если график строится по длинной истории
     table_data = [
-        {"proportion": m.proportion, "sample_size": m.sample_size}
-        for m in recent_measurements
+        {"proportion": float(m["proportion"]), "sample_size": int(m["sample_size"])}
+        for m in measurements[-MAX_POINTS:]
     ]
-
-    proportions = [m.proportion for m in recent_measurements]
-    sample_sizes = [m.sample_size for m in recent_measurements]
-
-    proportions = np.array(proportions)
-    sample_sizes = np.array(sample_sizes)
-
-    p_bar = np.sum(proportions * sample_sizes) / np.sum(sample_sizes)
-    sigmas = np.sqrt(p_bar * (1 - p_bar) / sample_sizes)
-    UCLs = p_bar + 3 * sigmas
-    sig2 = p_bar + 2 * sigmas
-    sig1 = p_bar + sigmas
-    LCLs = np.maximum(0, p_bar - 3 * sigmas)
-    lsig2 = np.maximum(0, p_bar - 2 * sigmas)
-    lsig1 = np.maximum(0, p_bar - sigmas)
-
-    annotations = []
-    is_trend, trend_text = detect_trends(proportions)
-    is_shift, shift_text = detect_shifts(proportions, p_bar)
-    is_asterisk, asterisk_text = detect_asterisks(proportions, p_bar)
-
-    if is_trend:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=trend_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-40,
-            )
-        )
-    if is_shift:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=shift_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-70,
-            )
-        )
-    if is_asterisk:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=asterisk_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-100,
-            )
-        )
-
-    figure = {
-        "data": [
-            go.Scatter(
-                y=proportions,
-                mode="lines+markers",
-                name="Proportion",
-                line=dict(color="blue"),
-            ),
-            go.Scatter(
-                y=[p_bar for _ in proportions], mode="lines", name="Mean Proportion"
-            ),
-            go.Scatter(
-                y=UCLs,
-                mode="lines",
-                name="UCL (+3σ)",
-                line=dict(dash="dash", color="red"),
-            ),
-            go.Scatter(
-                y=sig2, mode="lines", name="2σ", line=dict(dash="dash", color="orange")
-            ),
-            go.Scatter(
-                y=sig1, mode="lines", name="σ", line=dict(dash="dash", color="purple")
-            ),
-            go.Scatter(
-                y=lsig1, mode="lines", name="-σ", line=dict(dash="dash", color="purple")
-            ),
-            go.Scatter(
-                y=lsig2,
-                mode="lines",
-                name="-2σ",
-                line=dict(dash="dash", color="orange"),
-            ),
-            go.Scatter(
-                y=LCLs,
-                mode="lines",
-                name="LCL (-3σ)",
-                line=dict(dash="dash", color="red"),
-            ),
-        ],
-        "layout": go.Layout(
-            title="Custom p-Chart with Floating Control Limits",
-            xaxis=dict(title="Sample Number"),
-            yaxis=dict(title="Proportion"),
-            showlegend=True,
-            annotations=annotations,
-        ),
-    }
-
-    return table_data, figure
+    return table_data, figure, state
@@ -1,30 +1,35 @@
 import dash
 from dash import dcc, html, dash_table, callback
 import dash_bootstrap_components as dbc
-import numpy as np
-import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State, ALL
 from dash.exceptions import PreventUpdate
 
-from shewhart_app.components.service.detectors import (
-    detect_trends,
-    detect_shifts,
-    detect_asterisks,
-    detect_asterisks_x,
-    detect_shifts_x,
-    detect_trends_x,
-)
 from shewhart_app.components.service.models import (
-    Measurement,
     Base,
-    IndividualMeasurement,
     Binding,
     Chart,
 )
-from shewhart_app.components.service.session import Session, engine
+from shewhart_app.components.service import cache
+from shewhart_app.components.service.limits import (
+    binding_keys,
+    freeze_binding,
+    frozen_limits,
+    unfreeze_binding,
+)
+from shewhart_app.components.service.metrics import timed_callback
+from shewhart_app.components.service.session import session_scope
 import shewhart_app.components.content as content
 from shewhart_app.components.service.constants import *
 from shewhart_app.components.navbar import Navbar
+from shewhart_app.components.charts import (
+    p_chart,
+    render,
+    subgroup_charts,
+    time_p_chart,
+    time_range_options,
+    time_subgroup_charts,
+    time_window,
+)
 
 MAX_POINTS = content.MAX_POINTS
 SAMPLE_SIZE = 5
@@ -69,19 +74,26 @@ def generate_chart_containers(charts):
 
 
 def layout(bid=None):
-    session = Session()
-    binding = session.query(Binding).filter_by(id=bid).first()
-    charts = binding.charts if binding else []
-
-    # chart_ids = [chart.id for chart in charts]
-    name = binding.name
-    session.close()
+    with session_scope() as session:
+        binding = session.query(Binding).filter_by(id=bid).first()
+        charts = list(binding.charts) if binding else []
+        name = binding.name
     chart_containers = generate_chart_containers(charts)
     return dbc.Container(
         [
             html.H1(f"View {name}", className="mb-4"),
             html.Div(id="placeholder-x", style={"display": "none"}),
+            dcc.Dropdown(
+                id="time-range-page2",
+                options=time_range_options(),
+                value="latest",
+                clearable=False,
+                className="mb-2",
+            ),
             dcc.Graph(id="p-chart-page2"),
+            dcc.Store(id="p-chart-page2-state"),
+            dcc.Store(id="x-charts-state"),
+            dcc.Store(id="time-window-page2"),
             dbc.Row(
                 [
                     dbc.Col(
@@ -103,6 +115,26 @@ def layout(bid=None):
                         ],
                         width=4,
                     ),
+                    dbc.Col(
+                        [
+                            dbc.Label("Control Limits"),
+                            html.Br(),
+                            # Заморозка берет текущее окно как базовую фазу
+                            dbc.Button(
+                                "Freeze Limits",
+                                id="freeze-limits-button",
+                                color="secondary",
+                                className="me-2",
+                            ),
+                            dbc.Button(
+                                "Unfreeze Limits",
+                                id="unfreeze-limits-button",
+                                color="light",
+                            ),
+                            html.Div(id="limits-status", className="mt-2"),
+                        ],
+                        width=8,
+                    ),
                 ]
             ),
             html.Div(chart_containers, id="charts-container"),
@@ -122,134 +154,42 @@ def layout(bid=None):
 
 
 @callback(
-    Output("p-chart-page2", "figure"),
-    [Input("interval-component-page2", "n_intervals")],
-    State("bid", "value"),
+    Output("time-window-page2", "data"),
+    [
+        Input("time-range-page2", "value"),
+        Input("p-chart-page2", "relayoutData"),
+        Input({"type": "x-chart", "index": ALL}, "relayoutData"),
+        Input({"type": "r-chart", "index": ALL}, "relayoutData"),
+        Input({"type": "s-chart", "index": ALL}, "relayoutData"),
+    ],
+    [State("time-window-page2", "data")],
 )
-def update_chart_page2(n_intervals, bid):
-    binding_id = int(bid)
-    session = Session()
-    recent_measurements = (
-        session.query(Measurement)
-        .filter_by(binding_id=binding_id)
-        .order_by(Measurement.id.desc())
-        .limit(MAX_POINTS)
-    )
-    recent_measurements = recent_measurements[::-1]  # если требуется обратный порядок
-    session.close()
-
-    proportions = [m.proportion for m in recent_measurements]
-    sample_sizes = [m.sample_size for m in recent_measurements]
-
-    proportions = np.array(proportions)
-    sample_sizes = np.array(sample_sizes)
+@timed_callback
+def select_time_window(preset, p_relayout, x_relayout, r_relayout, s_relayout, window):
+    # Зум любого графика страницы задает общий диапазон для всех карт
+    relayout = None
+    if dash.ctx.triggered_id != "time-range-page2":
+        relayout = dash.ctx.triggered[0]["value"]
+    return time_window(preset, relayout, window)
 
-    p_bar = np.sum(proportions * sample_sizes) / np.sum(sample_sizes)
-    sigmas = np.sqrt(p_bar * (1 - p_bar) / sample_sizes)
-    UCLs = p_bar + 3 * sigmas
-    sig2 = p_bar + 2 * sigmas
-    sig1 = p_bar + sigmas
-    LCLs = np.maximum(0, p_bar - 3 * sigmas)
-    lsig2 = np.maximum(0, p_bar - 2 * sigmas)
-    lsig1 = np.maximum(0, p_bar - sigmas)
 
-    annotations = []
-    is_trend, trend_text = detect_trends(proportions)
-    is_shift, shift_text = detect_shifts(proportions, p_bar)
-    is_asterisk, asterisk_text = detect_asterisks(proportions, p_bar)
-
-    if is_trend:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=trend_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-40,
-            )
-        )
-    if is_shift:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=shift_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-70,
-            )
-        )
-    if is_asterisk:
-        annotations.append(
-            dict(
-                x=len(proportions) - 1,
-                y=proportions[-1],
-                xref="x",
-                yref="y",
-                text=asterisk_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-100,
-            )
-        )
-
-    figure = {
-        "data": [
-            go.Scatter(
-                y=proportions,
-                mode="lines+markers",
-                name="Proportion",
-                line=dict(color="blue"),
-            ),
-            go.Scatter(
-                y=[p_bar for _ in proportions], mode="lines", name="Mean Proportion"
-            ),
-            go.Scatter(
-                y=UCLs,
-                mode="lines",
-                name="UCL (+3σ)",
-                line=dict(dash="dash", color="red"),
-            ),
-            go.Scatter(
-                y=sig2, mode="lines", name="2σ", line=dict(dash="dash", color="orange")
-            ),
-            go.Scatter(
-                y=sig1, mode="lines", name="σ", line=dict(dash="dash", color="purple")
-            ),
-            go.Scatter(
-                y=lsig1, mode="lines", name="-σ", line=dict(dash="dash", color="purple")
-            ),
-            go.Scatter(
-                y=lsig2,
-                mode="lines",
-                name="-2σ",
-                line=dict(dash="dash", color="orange"),
-            ),
-            go.Scatter(
-                y=LCLs,
-                mode="lines",
-                name="LCL (-3σ)",
-                line=dict(dash="dash", color="red"),
-            ),
-        ],
-        "layout": go.Layout(
-            title="Custom p-Chart with Floating Control Limits",
-            xaxis=dict(title="Sample Number"),
-            yaxis=dict(title="Proportion"),
-            showlegend=True,
-            annotations=annotations,
-        ),
-    }
-
-    return figure
+@callback(
+    [Output("p-chart-page2", "figure"), Output("p-chart-page2-state", "data")],
+    [
+        Input("interval-component-page2", "n_intervals"),
+        Input("limits-status", "children"),
+        Input("time-window-page2", "data"),
+    ],
+    [State("bid", "value"), State("p-chart-page2-state", "data")],
+)
+@timed_callback
+def update_chart_page2(n_intervals, limits_status, window, bid, shown):
+    if window:
+        if dash.ctx.triggered_id == "interval-component-page2":
+            raise PreventUpdate
+        return time_p_chart(int(bid), window), None
+    _, figure, state = p_chart(int(bid), shown)
+    return figure, state
 
 
 # @callback(
@@ -282,332 +222,126 @@ def update_chart_page2(n_intervals, bid):
         Output({"type": "x-chart", "index": ALL}, "figure"),
         Output({"type": "r-chart", "index": ALL}, "figure"),
         Output({"type": "s-chart", "index": ALL}, "figure"),
+        Output("x-charts-state", "data"),
     ],
     [
         Input("interval-component-x-s-charts", "n_intervals"),
         Input("update-chart-button", "n_clicks"),
+        Input("limits-status", "children"),
+        Input("time-window-page2", "data"),
     ],
     [
         State("bid", "value"),
         State("input-subgroup-size", "value"),
         State({"type": "x-chart", "index": ALL}, "id"),
+        State("x-charts-state", "data"),
     ],
 )
-def update_x_chart(n_intervals, n_clicks, bid, sample_size, chart_ids):
-    # print(chart_ids)
-    binding_id = int(bid)
-    session = Session()
-
+@timed_callback
+def update_x_chart(
+    n_intervals, n_clicks, limits_status, window, bid, sample_size, chart_ids, shown
+):
     if not chart_ids:
         raise PreventUpdate
 
-    x_figures = []
-    r_figures = []
-    s_figures = []
-
-    for chart_id in chart_ids:
-        chart_id = chart_id["index"]
-
-        individual_measurements = (
-            session.query(IndividualMeasurement)
-            .filter_by(binding_id=binding_id, chart_id=chart_id)
-            .order_by(IndividualMeasurement.id.desc())
-            .limit(MAX_POINTS * sample_size)
-            .all()
-        )
-
-        individual_measurements_list = np.array(
-            [data.value for data in individual_measurements]
-        )
-        individual_measurements_list = individual_measurements_list[::-1]
-        # print(individual_measurements_list)
-
-        session.close()
+    if sample_size not in SUBGROUP_SIZES:
+        raise PreventUpdate
 
-        # Группировка данных в подгруппы
-        grouped_measurements = [
-            individual_measurements_list[i : i + sample_size]
-            for i in range(0, len(individual_measurements_list), sample_size)
-            if len(individual_measurements_list[i : i + sample_size]) == sample_size
+    chart_ids = [chart_id["index"] for chart_id in chart_ids]
+    if window:
+        # Диапазон по времени: полные figure без состояния, как у p-карты
+        if dash.ctx.triggered_id == "interval-component-x-s-charts":
+            raise PreventUpdate
+        charts = [
+            time_subgroup_charts(int(bid), chart_id, sample_size, window)
+            for chart_id in chart_ids
         ]
-
-        # Расчет средних значений и стандартных отклонений для каждой подгруппы
-        subgroup_means = np.array(
-            [np.mean(subgroup) for subgroup in grouped_measurements]
+        return (
+            [chart["x"] for chart in charts],
+            [chart["r"] for chart in charts],
+            [chart["s"] for chart in charts],
+            None,
         )
-        subgroup_stddevs = np.array(
-            [np.std(subgroup, ddof=1) for subgroup in grouped_measurements]
-        )
-        x_mean = np.mean(subgroup_means)
-
-        a2 = A2_values.get(sample_size, A2_values[5])
-        x_ucl = np.ones((len(subgroup_means),), dtype=int) * x_mean + a2 * np.mean(
-            subgroup_stddevs
-        )
-        x_lcl = np.ones((len(subgroup_means),), dtype=int) * x_mean - a2 * np.mean(
-            subgroup_stddevs
-        )
-
-        annotations = []
-        is_trend, trend_text = detect_trends_x(subgroup_means)
-
-        is_shift, shift_text = detect_shifts_x(subgroup_means, x_mean)
-        is_asterisk, asterisk_text = detect_asterisks_x(subgroup_means, x_mean)
+    # Карты считает фоновый планировщик, здесь только готовые снимки. Окна
+    # еще не загруженных чартов догружаем одним запросом до сборки снимков,
+    # иначе холодная страница делала бы запрос на каждый чарт
+    cache.recent_subgroup_stats(chart_ids, sample_size)
+    snapshots = [subgroup_charts(chart_id, sample_size) for chart_id in chart_ids]
+    chart_states = [
+        {name: part.state for name, part in snapshot.parts.items()}
+        for snapshot in snapshots
+    ]
+
+    # Состояние клиента - размер подгруппы и нарисованное окно каждого чарта;
+    # при смене размера подгруппы все графики перестраиваются целиком
+    if not shown or shown["subgroup_size"] != sample_size:
+        shown = {"subgroup_size": sample_size, "charts": {}}
+    if all(
+        shown["charts"].get(str(chart_id)) == chart_state
+        for chart_id, chart_state in zip(chart_ids, chart_states)
+    ):
+        raise PreventUpdate
 
-        if is_trend:
-            annotations.append(
-                dict(
-                    x=len(subgroup_means) - 1,
-                    y=subgroup_means[-1],
-                    xref="x",
-                    yref="y",
-                    text=trend_text,
-                    showarrow=True,
-                    arrowhead=7,
-                    ax=0,
-                    ay=-40,
+    figures = {"x": [], "r": [], "s": []}
+    state = {"subgroup_size": sample_size, "charts": {}}
+
+    for chart_id, snapshot, chart_state in zip(chart_ids, snapshots, chart_states):
+        chart_shown = shown["charts"].get(str(chart_id))
+        state["charts"][str(chart_id)] = chart_state
+        if chart_shown == chart_state:
+            for name in figures:
+                figures[name].append(dash.no_update)
+            continue
+        chart_shown = chart_shown or {"x": None, "r": None, "s": None}
+        for name in figures:
+            figures[name].append(render(snapshot, name, chart_shown[name]))
+    return figures["x"], figures["r"], figures["s"], state
+
+
+def describe_limits(binding_id, chart_ids, sample_size):
+    items = []
+    for key in binding_keys(binding_id, chart_ids, sample_size):
+        frozen = frozen_limits(key)
+        name = "p-chart" if key[0] == "p" else f"Chart {key[1]} X/R/S"
+        if frozen is None:
+            items.append(html.Li(f"{name}: floating limits"))
+        elif key[0] == "p":
+            items.append(
+                html.Li(
+                    f"{name}: phase {frozen.phase}, p̄={frozen.p_bar:.4f} "
+                    f"from {frozen.baseline_points} points"
                 )
             )
-        if is_shift:
-            annotations.append(
-                dict(
-                    x=len(subgroup_means) - 1,
-                    y=subgroup_means[-1],
-                    xref="x",
-                    yref="y",
-                    text=shift_text,
-                    showarrow=True,
-                    arrowhead=7,
-                    ax=0,
-                    ay=-70,
+        else:
+            items.append(
+                html.Li(
+                    f"{name}: phase {frozen.phase}, X̄={frozen.x_bar:.4f}, "
+                    f"R̄={frozen.r_bar:.4f}, S̄={frozen.s_bar:.4f} "
+                    f"from {frozen.baseline_points} subgroups"
                 )
             )
-        if is_asterisk:
-            annotations.append(
-                dict(
-                    x=len(subgroup_means) - 1,
-                    y=subgroup_means[-1],
-                    xref="x",
-                    yref="y",
-                    text=asterisk_text,
-                    showarrow=True,
-                    arrowhead=7,
-                    ax=0,
-                    ay=-100,
-                )
-            )
-
-        x_figure = {
-            "data": [
-                go.Scatter(
-                    y=subgroup_means,
-                    mode="lines+markers",
-                    name="Value",
-                    line=dict(color="blue"),
-                ),
-                go.Scatter(y=[x_mean for _ in subgroup_means], name="Mean Value"),
-                go.Scatter(
-                    y=x_ucl,
-                    mode="lines",
-                    name="UCL",
-                    line=dict(dash="dash", color="red"),
-                ),
-                go.Scatter(
-                    y=x_lcl,
-                    mode="lines",
-                    name="LCL",
-                    line=dict(dash="dash", color="red"),
-                ),
-            ],
-            "layout": go.Layout(
-                title="X-Chart",
-                xaxis=dict(title="Sample Number"),
-                yaxis=dict(title="Value"),
-                showlegend=True,
-                annotations=annotations,
-            ),
-        }
-        r_figure = update_r_chart(grouped_measurements, sample_size)
-        s_figure = update_s_chart(grouped_measurements, sample_size)
-        x_figures.append(x_figure)
-        r_figures.append(r_figure)
-        s_figures.append(s_figure)
-    return x_figures, r_figures, s_figures
-
-
-def update_r_chart(grouped_measurements, sample_size):
-    subgroup_ranges = np.array(
-        [max(subgroup) - min(subgroup) for subgroup in grouped_measurements]
-    )
-    r_mean = np.mean(subgroup_ranges)
-    r_ucl = (
-        np.ones((len(subgroup_ranges),), dtype=int) * D4_values[sample_size] * r_mean
-    )
-    r_lcl = (
-        np.ones((len(subgroup_ranges),), dtype=int) * D3_values[sample_size] * r_mean
-    )
-
-    annotations = []
-    is_trend, trend_text = detect_trends_x(subgroup_ranges)
-    is_shift, shift_text = detect_shifts_x(subgroup_ranges, r_mean)
-    is_asterisk, asterisk_text = detect_asterisks_x(subgroup_ranges, r_mean)
-
-    # Создание R-чарта
-    if is_trend:
-        annotations.append(
-            dict(
-                x=len(subgroup_ranges) - 1,
-                y=subgroup_ranges[-1],
-                xref="x",
-                yref="y",
-                text=trend_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-40,
-            )
-        )
-    if is_shift:
-        annotations.append(
-            dict(
-                x=len(subgroup_ranges) - 1,
-                y=subgroup_ranges[-1],
-                xref="x",
-                yref="y",
-                text=shift_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-70,
-            )
-        )
-    if is_asterisk:
-        annotations.append(
-            dict(
-                x=len(subgroup_ranges) - 1,
-                y=subgroup_ranges[-1],
-                xref="x",
-                yref="y",
-                text=asterisk_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-100,
-            )
-        )
-
-    figure = {
-        "data": [
-            go.Scatter(
-                y=subgroup_ranges,
-                mode="lines+markers",
-                name="Standard Deviation",
-                line=dict(color="blue"),
-            ),
-            go.Scatter(y=[r_mean for _ in subgroup_ranges], name="Mean Value"),
-            go.Scatter(
-                y=r_ucl, mode="lines", name="UCL", line=dict(dash="dash", color="red")
-            ),
-            go.Scatter(
-                y=r_lcl, mode="lines", name="LCL", line=dict(dash="dash", color="red")
-            ),
-        ],
-        "layout": go.Layout(
-            title="R-Chart",
-            xaxis=dict(title="Sample Number"),
-            yaxis=dict(title="Standart Deviation"),
-            showlegend=True,
-            annotations=annotations,
-        ),
-    }
-
-    return figure
+    return html.Ul(items)
 
 
-def update_s_chart(grouped_measurements, sample_size):
-    subgroup_stddevs = np.array(
-        [np.std(subgroup, ddof=1) for subgroup in grouped_measurements]
-    )
-    s_mean = np.mean(subgroup_stddevs)
-    s_ucl = (
-        np.ones((len(subgroup_stddevs),), dtype=int) * B4_values[sample_size] * s_mean
-    )
-    s_lcl = (
-        np.ones((len(subgroup_stddevs),), dtype=int) * B3_values[sample_size] * s_mean
-    )
-
-    annotations = []
-    is_trend, trend_text = detect_trends_x(subgroup_stddevs)
-    is_shift, shift_text = detect_shifts_x(subgroup_stddevs, s_mean)
-    is_asterisk, asterisk_text = detect_asterisks_x(subgroup_stddevs, s_mean)
-
-    # Создание R-чарта
-    if is_trend:
-        annotations.append(
-            dict(
-                x=len(subgroup_stddevs) - 1,
-                y=subgroup_stddevs[-1],
-                xref="x",
-                yref="y",
-                text=trend_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-40,
-            )
-        )
-    if is_shift:
-        annotations.append(
-            dict(
-                x=len(subgroup_stddevs) - 1,
-                y=subgroup_stddevs[-1],
-                xref="x",
-                yref="y",
-                text=shift_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-70,
-            )
-        )
-    if is_asterisk:
-        annotations.append(
-            dict(
-                x=len(subgroup_stddevs) - 1,
-                y=subgroup_stddevs[-1],
-                xref="x",
-                yref="y",
-                text=asterisk_text,
-                showarrow=True,
-                arrowhead=7,
-                ax=0,
-                ay=-100,
-            )
-        )
-
-    figure = {
-        "data": [
-            go.Scatter(
-                y=subgroup_stddevs,
-                mode="lines+markers",
-                name="Standard Deviation",
-                line=dict(color="blue"),
-            ),
-            go.Scatter(y=[s_mean for _ in subgroup_stddevs], name="Mean Value"),
-            go.Scatter(
-                y=s_ucl, mode="lines", name="UCL", line=dict(dash="dash", color="red")
-            ),
-            go.Scatter(
-                y=s_lcl, mode="lines", name="LCL", line=dict(dash="dash", color="red")
-            ),
-        ],
-        "layout": go.Layout(
-            title="S-Chart",
-            xaxis=dict(title="Sample Number"),
-            yaxis=dict(title="Standart Deviation"),
-            showlegend=True,
-            annotations=annotations,
-        ),
-    }
+@callback(
+    Output("limits-status", "children"),
+    [
+        Input("freeze-limits-button", "n_clicks"),
+        Input("unfreeze-limits-button", "n_clicks"),
+        Input("input-subgroup-size", "value"),
+    ],
+    [State("bid", "value"), State({"type": "x-chart", "index": ALL}, "id")],
+)
+@timed_callback
+def update_limits(freeze_clicks, unfreeze_clicks, sample_size, bid, chart_ids):
+    if sample_size not in SUBGROUP_SIZES:
+        raise PreventUpdate
 
-    return figure
+    binding_id = int(bid)
+    chart_ids = [chart_id["index"] for chart_id in chart_ids]
+    # Пересчет границ - только по кнопке: базовая фаза - текущее окно
+    if dash.ctx.triggered_id == "freeze-limits-button":
+        freeze_binding(binding_id, chart_ids, sample_size)
+    elif dash.ctx.triggered_id == "unfreeze-limits-button":
+        unfreeze_binding(binding_id, chart_ids, sample_size)
+    return describe_limits(binding_id, chart_ids, sample_size)
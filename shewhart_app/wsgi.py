@@ -0,0 +1,11 @@
+from shewhart_app.app import app
+from shewhart_app.components.service.migrations import upgrade
+from shewhart_app.components.service.session import engine
+
+# С preload_app модуль импортируется один раз в мастере gunicorn, поэтому
+# миграции выполняются до запуска воркеров; соединения мастера закрываем,
+# чтобы воркеры не унаследовали их через fork
+upgrade(engine)
+engine.dispose()
+
+server = app.server
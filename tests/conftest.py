@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+import pytest
+
+# Движок создается при импорте session, поэтому база задается до импорта
+# модулей приложения
+_directory = tempfile.mkdtemp()
+os.environ["SHEWHART_DB_URL"] = "sqlite:///" + os.path.join(_directory, "test.db")
+os.environ["SHEWHART_CACHE_BACKEND"] = "memory"
+
+
+@pytest.fixture(scope="session")
+def engine():
+    from shewhart_app.components.service.migrations import upgrade
+    from shewhart_app.components.service.session import engine
+
+    upgrade(engine)
+    return engine
+
+
+@pytest.fixture
+def database(engine):
+    from shewhart_app.components.service import cache, models
+
+    yield engine
+    with engine.begin() as connection:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    cache.series_cache.clear()
@@ -0,0 +1,70 @@
+import numpy as np
+
+from shewhart_app.components.service.cache import (
+    DiskSeriesCache,
+    RingBuffer,
+    merge_rows,
+)
+from shewhart_app.components.service.queries import MEASUREMENT_DTYPE
+
+
+def rows(ids):
+    ids = np.asarray(ids)
+    return np.array([(i, i / 100, 10) for i in ids.tolist()], dtype=MEASUREMENT_DTYPE)
+
+
+def test_ring_buffer_keeps_last_rows_across_wraparound():
+    buffer = RingBuffer(5, MEASUREMENT_DTYPE)
+    for start in range(1, 13, 3):
+        buffer.extend(rows(range(start, start + 3)))
+    assert buffer.latest()["id"].tolist() == [8, 9, 10, 11, 12]
+    assert buffer.latest(2)["id"].tolist() == [11, 12]
+    assert buffer.last_id == 12
+
+
+def test_ring_buffer_merges_late_rows_in_id_order():
+    buffer = RingBuffer(5, MEASUREMENT_DTYPE)
+    buffer.extend(rows([5]))
+    buffer.extend(rows([3, 1]))
+    assert buffer.latest()["id"].tolist() == [1, 3, 5]
+    buffer.extend(rows([4, 6, 7]))
+    assert buffer.latest()["id"].tolist() == [3, 4, 5, 6, 7]
+
+
+def test_ring_buffer_drops_late_rows_below_full_window():
+    buffer = RingBuffer(3, MEASUREMENT_DTYPE)
+    buffer.extend(rows([5, 6, 7]))
+    buffer.extend(rows([2]))
+    assert buffer.latest()["id"].tolist() == [5, 6, 7]
+
+
+def test_ring_buffer_ignores_repeated_rows():
+    buffer = RingBuffer(4, MEASUREMENT_DTYPE)
+    buffer.extend(rows([1, 2, 3]))
+    buffer.extend(rows([2, 3, 4]))
+    assert buffer.latest()["id"].tolist() == [1, 2, 3, 4]
+
+
+def test_merge_rows_matches_sorted_union():
+    generator = np.random.default_rng(1)
+    current = rows(np.sort(generator.choice(1000, 50, replace=False)))
+    for _ in range(50):
+        batch = rows(generator.choice(1000, 20))
+        merged = merge_rows(current, batch, 60)
+        expected = np.unique(np.concatenate((current["id"], batch["id"])))[-60:]
+        assert merged["id"].tolist() == expected.tolist()
+        current = merged
+
+
+def test_disk_cache_matches_ring_buffer(tmp_path):
+    cache = DiskSeriesCache(str(tmp_path / "cache.db"), 10)
+    buffer = RingBuffer(50, MEASUREMENT_DTYPE)
+    key = ("p", 1)
+    cache.begin_load(key)
+    cache.finish_load(key, rows(range(1, 31)), 50, MEASUREMENT_DTYPE)
+    buffer.extend(rows(range(1, 31)))
+    for batch in ([31, 32], [40], [35, 33], list(range(41, 80)), [34]):
+        cache.append(key, rows(batch))
+        buffer.extend(rows(batch))
+        assert cache.get(key)["id"].tolist() == buffer.latest()["id"].tolist()
+    assert cache.get(key, 5)["id"].tolist() == buffer.latest(5)["id"].tolist()
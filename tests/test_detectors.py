@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from shewhart_app.components.service.detectors import ChunkedDetector, detect_rules
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 50, 1000])
+def test_chunked_detector_matches_detect_rules(chunk_size):
+    generator = np.random.default_rng(chunk_size)
+    # Длинные серии: медленные волны и ступени поверх шума
+    points = np.arange(600)
+    values = np.round(
+        np.sin(points / 15) + (points // 90 % 2) + generator.normal(0, 0.3, 600), 1
+    )
+    values[100:120] = np.arange(20)
+    ids = 10 + 3 * points
+    center = float(values.mean())
+
+    detector = ChunkedDetector(center)
+    hits = []
+    for start in range(0, len(values), chunk_size):
+        hits += detector.feed(
+            ids[start : start + chunk_size], values[start : start + chunk_size]
+        )
+    hits += detector.close()
+
+    expected = detect_rules(values, center)
+    assert expected
+    assert sorted(
+        (hit.rule, hit.start, hit.end, hit.direction) for hit in hits
+    ) == sorted(expected)
+    for hit in hits:
+        assert (hit.start_key, hit.end_key) == (ids[hit.start], ids[hit.end])
+    assert detector.count == len(values)
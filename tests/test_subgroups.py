@@ -0,0 +1,80 @@
+import random
+
+from sqlalchemy import insert, select
+
+from shewhart_app.components.service import cache, subgroups
+from shewhart_app.components.service.models import (
+    Binding,
+    Chart,
+    IndividualMeasurement,
+    SubgroupStatistic,
+)
+from shewhart_app.components.service.session import session_scope
+
+
+def _statistics():
+    with session_scope() as session:
+        return session.execute(
+            select(
+                SubgroupStatistic.subgroup_size,
+                SubgroupStatistic.subgroup_index,
+                SubgroupStatistic.last_measurement_id,
+                SubgroupStatistic.mean,
+                SubgroupStatistic.range,
+                SubgroupStatistic.stddev,
+            ).order_by(
+                SubgroupStatistic.subgroup_size, SubgroupStatistic.subgroup_index
+            )
+        ).all()
+
+
+def test_late_commits_rebuild_shifted_subgroups(database):
+    generator = random.Random(1)
+    with session_scope() as session:
+        binding = Binding(name="binding")
+        session.add(binding)
+        session.flush()
+        chart = Chart(name="chart", binding_id=binding.id)
+        session.add(chart)
+        session.flush()
+        binding_id, chart_id = binding.id, chart.id
+
+    # Пачки коммитятся не по порядку id: каждая опоздавшая сдвигает
+    # подгруппы, уже посчитанные по более поздним id
+    for ids in (
+        range(1, 40),
+        range(60, 90),
+        range(40, 60),
+        range(90, 93),
+        range(200, 240),
+        [150],
+        range(241, 300),
+    ):
+        with session_scope() as session:
+            session.execute(
+                insert(IndividualMeasurement),
+                [
+                    {
+                        "id": i,
+                        "binding_id": binding_id,
+                        "chart_id": chart_id,
+                        "value": generator.gauss(10, 2),
+                    }
+                    for i in ids
+                ],
+            )
+        subgroups.update_subgroup_stats(binding_id, [chart_id])
+    updated = _statistics()
+    cached = {
+        size: cache.recent_subgroup_stats([chart_id], size)[chart_id]
+        for size in (2, 5, 10)
+    }
+
+    subgroups.rebuild_subgroup_stats([chart_id])
+    rebuilt = _statistics()
+    assert updated == rebuilt
+    for size, rows in cached.items():
+        expected = [row for row in rebuilt if row.subgroup_size == size]
+        assert rows["id"].tolist() == [
+            row.subgroup_index for row in expected[-len(rows) :]
+        ]
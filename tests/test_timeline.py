@@ -0,0 +1,43 @@
+import datetime
+
+from sqlalchemy import select
+
+from shewhart_app.components.service.models import Binding, Measurement
+from shewhart_app.components.service.session import session_scope
+from shewhart_app.components.service.timeline import bucket_expression
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def test_bucket_expression_keeps_boundary_points_in_their_bucket(database):
+    width = 3600
+    boundary = datetime.datetime(2024, 3, 1, 12)
+    times = [
+        boundary - datetime.timedelta(seconds=1),
+        boundary,
+        boundary + datetime.timedelta(seconds=width - 1),
+        boundary + datetime.timedelta(seconds=width),
+    ]
+    with session_scope() as session:
+        binding = Binding(name="binding")
+        session.add(binding)
+        session.flush()
+        session.add_all(
+            Measurement(
+                binding_id=binding.id,
+                proportion=0.1,
+                sample_size=10,
+                measurement_time=time,
+            )
+            for time in times
+        )
+        session.flush()
+        dialect_name = session.get_bind().dialect.name
+        bucket = bucket_expression(dialect_name, Measurement.measurement_time, width)
+        buckets = session.scalars(
+            select(bucket)
+            .where(Measurement.binding_id == binding.id)
+            .order_by(Measurement.id)
+        ).all()
+    first = int((boundary - EPOCH).total_seconds()) // width
+    assert [int(value) for value in buckets] == [first - 1, first, first, first + 1]